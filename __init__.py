@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import Pool
 from .transaction import PaymentGatewayAuthorize, \
-    AddPaymentProfile, AuthorizeNetTransaction
-from .party import Party, Address, PaymentProfile
+    AddPaymentProfile, AuthorizeNetTransaction, TransactionLog
+from .party import Party, Address, PaymentProfile, AuthorizeNetCustomer, \
+    ContactMechanism, Country, Subdivision
+from .webhook import AuthorizeNetEvent
 
 
 def register():
     Pool.register(
         PaymentGatewayAuthorize,
         AuthorizeNetTransaction,
+        TransactionLog,
         PaymentProfile,
         Party,
         Address,
+        AuthorizeNetCustomer,
+        ContactMechanism,
+        Country,
+        Subdivision,
+        AuthorizeNetEvent,
         module='payment_gateway_authorize_net', type_='model'
     )
     Pool.register(
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    breaker
+
+    Circuit breaker of the calls to authorize.net.
+
+    The breaker of a gateway opens when too many of its recent calls failed
+    or were slow, and then refuses the calls at once instead of letting them
+    wait for the timeout. After a while it lets a single probe call through
+    (half-open) and closes again if it succeeds. The options are read from
+    the `authorize_net` section of the configuration.
+
+    :license: see LICENSE for details.
+"""
+import threading
+import time
+from collections import deque
+
+from authorize.exceptions import AuthorizeConnectionError
+from trytond.config import config
+
+__all__ = [
+    'CircuitBreaker', 'CircuitOpenError', 'get_circuit_breaker',
+    'CLOSED', 'OPEN', 'HALF_OPEN',
+]
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(AuthorizeConnectionError):
+    """
+    The call was not sent because the circuit breaker of the gateway is
+    open
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Track the failures and the durations of the calls of a gateway.
+
+    :param failure_ratio: Ratio of failed or slow calls which opens the
+        breaker.
+    :param min_calls: Number of calls within the window needed to open the
+        breaker.
+    :param window: Seconds during which the calls are tracked.
+    :param slow_call: Seconds after which a call counts as failed.
+    :param open_duration: Seconds the breaker stays open before a probe.
+    """
+
+    def __init__(
+            self, failure_ratio=0.5, min_calls=10, window=60, slow_call=10,
+            open_duration=30):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_duration = open_duration
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.state = CLOSED
+        self.opened_at = None
+        self.probing = False
+
+    def get_state(self):
+        """
+        Return the state of the breaker: closed, open or half-open
+        """
+        with self.lock:
+            if self.state == OPEN and \
+                    time.time() - self.opened_at >= self.open_duration:
+                return HALF_OPEN
+            return self.state
+
+    def allow(self):
+        """
+        Return whether a call can be sent. In half-open state only one probe
+        call is allowed at a time.
+        """
+        with self.lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.open_duration:
+                    return False
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+
+    def record(self, failed, duration):
+        """
+        Record the outcome of a call allowed by the breaker
+        """
+        failed = failed or duration > self.slow_call
+        now = time.time()
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = CLOSED
+                    self.calls.clear()
+                return
+            self.calls.append((now, failed))
+            while self.calls and now - self.calls[0][0] > self.window:
+                self.calls.popleft()
+            failures = sum(1 for _, f in self.calls if f)
+            if len(self.calls) >= self.min_calls and \
+                    failures >= self.failure_ratio * len(self.calls):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.calls.clear()
+
+
+def get_circuit_breaker():
+    """
+    Return a circuit breaker set from the configuration
+    """
+    return CircuitBreaker(
+        failure_ratio=config.getfloat(
+            'authorize_net', 'breaker_failure_ratio', default=0.5
+        ),
+        min_calls=config.getint(
+            'authorize_net', 'breaker_min_calls', default=10
+        ),
+        window=config.getfloat('authorize_net', 'breaker_window', default=60),
+        slow_call=config.getfloat(
+            'authorize_net', 'breaker_slow_call', default=10
+        ),
+        open_duration=config.getfloat(
+            'authorize_net', 'breaker_open_duration', default=30
+        ),
+    )
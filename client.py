@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+    client
+
+    :license: see LICENSE for details.
+"""
+import datetime
+import httplib
+import socket
+import threading
+import time
+from urlparse import urlparse
+from uuid import uuid4
+
+import xml.etree.cElementTree as E
+from authorize.apis.authorize_api import AuthorizeAPI
+from authorize.configuration import Configuration
+from authorize.exceptions import AuthorizeConnectionError, \
+    AuthorizeResponseError
+from authorize.response_parser import parse_response
+from authorize.schemas import CreateCreditCardSchema, \
+    RefundTransactionSchema
+from trytond.config import config
+
+from .breaker import CircuitOpenError, get_circuit_breaker
+from .ratelimit import get_token_bucket
+from .retry import RetryBudget, get_retry_policy
+
+__all__ = [
+    'AuthorizeNetClient', 'AuthorizeNotSentError', 'get_client',
+    'drop_client',
+]
+
+
+class AuthorizeNotSentError(AuthorizeConnectionError):
+    """
+    The call could not be sent to authorize.net, no connection could be
+    opened, so it was not processed
+    """
+
+
+class AuthorizeNetClient(AuthorizeAPI):
+    """
+    An authorize.net API client which keeps its HTTP connections alive.
+
+    It has the same interface as `authorize.Configuration.api`, so calls are
+    made with `client.transaction.sale(...)`, `client.customer.create(...)`
+    and so on.
+
+    HTTP connections can not be shared between threads, so every thread
+    using the client gets its own connection.
+
+    The calls which get no answer are retried following the retry policy,
+    within the retry budget of the client. Transactions are retried with a
+    duplicate window so that authorize.net refuses a retry of a transaction
+    it already processed: the call is then reported as without answer, it
+    never charges twice. A call which never reached authorize.net, as no
+    connection could be opened, fails with `AuthorizeNotSentError`.
+
+    When the circuit breaker of the client is open, the calls fail at once
+    with `CircuitOpenError`. Every request sent waits for a token of the
+    rate limit of the merchant account, if there is one.
+    """
+
+    def __init__(self, environment, login_id, transaction_key):
+        super(AuthorizeNetClient, self).__init__(
+            Configuration(environment, login_id, transaction_key)
+        )
+        url = urlparse(environment)
+        if url.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self._host = url.netloc
+        self._path = url.path or '/'
+        self._local = threading.local()
+
+        # Build the authentication element before the client is shared
+        # between threads
+        self._client_auth = self.client_auth
+
+        self.retry_policy = get_retry_policy()
+        self.retry_budget = RetryBudget(
+            config.getfloat('authorize_net', 'retry_budget', default=0.2)
+        )
+        self.duplicate_window = config.getint(
+            'authorize_net', 'duplicate_window', default=120
+        )
+        self.timeout = config.getfloat(
+            'authorize_net', 'timeout', default=30
+        )
+        self.breaker = get_circuit_breaker()
+        self.rate_limiter = get_token_bucket(environment, login_id)
+
+    def _get_connection(self):
+        """
+        Return the connection of the current thread and whether it was
+        already used.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection, True
+        connection = self._local.connection = self._connection_class(
+            self._host, timeout=self.timeout
+        )
+        return connection, False
+
+    def _drop_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+    def _post(self, body, retry_body):
+        """
+        Post the body to authorize.net and return the response body and
+        whether it was sent again on a new connection, as `retry_body`.
+        """
+        resent = False
+        while True:
+            connection, reused = self._get_connection()
+            if connection.sock is None:
+                try:
+                    connection.connect()
+                except socket.error:
+                    self._drop_connection()
+                    raise AuthorizeNotSentError(
+                        'Error connecting to authorize.net.'
+                    )
+            try:
+                connection.request(
+                    'POST', self._path, body, {'Content-Type': 'text/xml'}
+                )
+                response = connection.getresponse()
+                data = response.read()
+            except httplib.BadStatusLine as exc:
+                self._drop_connection()
+                # An empty status line, reported with a message by the
+                # recent versions of httplib
+                line = exc.line.strip("'")
+                if reused and (
+                        not line or line.startswith('No status line')):
+                    # The server closed the kept alive connection, most
+                    # likely without reading the request, so it is sent
+                    # again. It may have been processed, so it is sent like
+                    # a retry, which authorize.net refuses as duplicate.
+                    body = retry_body
+                    resent = True
+                    continue
+                raise AuthorizeConnectionError(
+                    'Error processing XML request.'
+                )
+            except (httplib.HTTPException, socket.error):
+                self._drop_connection()
+                raise AuthorizeConnectionError(
+                    'Error processing XML request.'
+                )
+            if response.status >= 400:
+                self._drop_connection()
+                raise AuthorizeConnectionError(
+                    'Error processing XML request.'
+                )
+            if response.will_close:
+                self._drop_connection()
+            return data, resent
+
+    def _get_retry_body(self, call):
+        """
+        Return the body of the retries of the call. Transactions are sent
+        again with the duplicate window set so that authorize.net refuses
+        them if it processed the previous attempt.
+        """
+        if call.tag != 'createTransactionRequest':
+            return E.tostring(call)
+        xact = call.find('transactionRequest')
+        settings = E.Element('transactionSettings')
+        setting = E.SubElement(settings, 'setting')
+        E.SubElement(setting, 'settingName').text = 'duplicateWindow'
+        E.SubElement(setting, 'settingValue').text = str(
+            self.duplicate_window
+        )
+        # The settings come before the user fields
+        user_fields = xact.find('userFields')
+        xact.insert(
+            list(xact).index(user_fields) if user_fields is not None
+            else len(xact), settings
+        )
+        return E.tostring(call)
+
+    def _post_with_retry(self, call):
+        """
+        Post the call, retrying it when it gets no answer, and return the
+        response body and whether the call was sent more than once.
+        """
+        body = E.tostring(call)
+        retry_body = self._get_retry_body(call)
+        self.retry_budget.deposit()
+        start = time.time()
+        attempt = 1
+        # Whether an attempt may have reached authorize.net
+        sent = False
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                data, resent = self._post(body, retry_body)
+                return data, resent or sent
+            except AuthorizeConnectionError as exc:
+                not_sent = isinstance(exc, AuthorizeNotSentError)
+                delay = self.retry_policy.get_delay(attempt, start)
+                if delay is None or not self.retry_budget.withdraw():
+                    if sent and not_sent:
+                        raise AuthorizeConnectionError(
+                            'Error processing XML request.'
+                        )
+                    raise
+                sent = sent or not not_sent
+            body = retry_body
+            time.sleep(delay)
+            attempt += 1
+
+    def _make_call(self, call):
+        """
+        Make a call to the authorize.net server with the XML.
+        """
+        is_transaction = call.tag == 'createTransactionRequest'
+        if is_transaction:
+            # Identifies the attempts of the call in the logs of the gateway
+            ref_id = E.Element('refId')
+            ref_id.text = uuid4().hex[:20]
+            call.insert(1, ref_id)
+        if not self.breaker.allow():
+            raise CircuitOpenError('Authorize.net is unavailable.')
+        start = time.time()
+        failed = True
+        try:
+            data, retried = self._post_with_retry(call)
+            failed = False
+        finally:
+            self.breaker.record(failed, time.time() - start)
+        response_json = parse_response(E.fromstring(data))
+
+        # Transaction response errors
+        try:
+            error = response_json.transaction_response.errors[0]
+        except (KeyError, AttributeError):
+            pass
+        else:
+            if is_transaction and retried and error.error_code == '11':
+                # A previous attempt was processed but its answer was lost,
+                # the outcome of the transaction is unknown
+                raise AuthorizeConnectionError(
+                    'Error processing XML request.'
+                )
+            raise AuthorizeResponseError(
+                error.error_code, error.error_text, response_json
+            )
+
+        if response_json.messages[0].result_code != 'Ok':
+            error = response_json.messages[0].message
+            raise AuthorizeResponseError(error.code, error.text, response_json)
+
+        return response_json
+
+    def create_credit_card(self, customer_id, params, validation_mode=None):
+        """
+        Store a card on the customer profile like `credit_card.create`. With
+        a `validation_mode`, `testMode` or `liveMode`, the card is validated
+        by the same call and it is not stored if the validation fails.
+        """
+        card = self.credit_card._deserialize(CreateCreditCardSchema(), params)
+        request = self.credit_card._create_request(customer_id, card)
+        if validation_mode:
+            E.SubElement(request, 'validationMode').text = validation_mode
+        return self._make_call(request)
+
+    def refund_transaction(self, params, invoice_number=None):
+        """
+        Refund a settled transaction like `transaction.refund`, with the
+        invoice number by which the refund is found at authorize.net when
+        its answer is lost.
+        """
+        refund = self.transaction._deserialize(
+            RefundTransactionSchema(), params
+        )
+        request = self.transaction._refund_request(refund)
+        if invoice_number:
+            order = E.SubElement(request.find('transactionRequest'), 'order')
+            E.SubElement(order, 'invoiceNumber').text = invoice_number
+        return self._make_call(request)
+
+    def list_transactions(self, batch_id=None, page_size=1000):
+        """
+        Iterate over the transactions of the settled batch, or over the
+        unsettled transactions without batch, fetching them a page of
+        `page_size` at a time.
+        """
+        page = 1
+        while True:
+            if batch_id:
+                request = self._base_request('getTransactionListRequest')
+                E.SubElement(request, 'batchId').text = batch_id
+            else:
+                request = self._base_request(
+                    'getUnsettledTransactionListRequest'
+                )
+            # The oldest first, so that new transactions do not shift the
+            # pages
+            sorting = E.SubElement(request, 'sorting')
+            E.SubElement(sorting, 'orderBy').text = 'submitTimeUTC'
+            E.SubElement(sorting, 'orderDescending').text = 'false'
+            paging = E.SubElement(request, 'paging')
+            E.SubElement(paging, 'limit').text = str(page_size)
+            E.SubElement(paging, 'offset').text = str(page)
+            transactions = self._make_call(request).get('transactions') or []
+            for transaction in transactions:
+                yield transaction
+            if len(transactions) < page_size:
+                return
+            page += 1
+
+    def list_settled_batches(self, start, end):
+        """
+        Iterate over the batches settled between the datetimes, in UTC, the
+        most recent first. The batches are fetched 31 days at a time, the
+        longest period authorize.net accepts.
+        """
+        while end > start:
+            first = max(start, end - datetime.timedelta(days=31))
+            request = self._base_request('getSettledBatchListRequest')
+            E.SubElement(request, 'firstSettlementDate').text = \
+                first.strftime('%Y-%m-%dT%H:%M:%SZ')
+            E.SubElement(request, 'lastSettlementDate').text = \
+                end.strftime('%Y-%m-%dT%H:%M:%SZ')
+            batches = self._make_call(request).get('batch_list') or []
+            for batch in reversed(batches):
+                yield batch
+            end = first
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(key, environment, login_id, transaction_key):
+    """
+    Return the client stored under the key, a new one is created if there is
+    none or if it was created with other credentials.
+    """
+    credentials = (environment, login_id, transaction_key)
+    with _clients_lock:
+        cached = _clients.get(key)
+        if cached is None or cached[0] != credentials:
+            cached = _clients[key] = (
+                credentials, AuthorizeNetClient(*credentials)
+            )
+        return cached[1]
+
+
+def drop_client(key):
+    """
+    Forget the client stored under the key. Calls in progress finish with
+    the client they already have.
+    """
+    with _clients_lock:
+        _clients.pop(key, None)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    importer
+
+    Import the cards on file of the customers of another processor into the
+    customer profiles of an authorize.net gateway.
+
+    The file, CSV or JSON lines, is read as a stream and imported by chunks,
+    each of them committed with the position reached in a checkpoint file,
+    so that an interrupted import resumes where it stopped::
+
+        python -m trytond.modules.payment_gateway_authorize_net.importer \\
+            -d database -g 1 cards.csv
+
+    :license: see LICENSE for details.
+"""
+import csv
+import json
+import logging
+import os
+from itertools import islice
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['read_cards', 'chunked', 'import_cards']
+
+logger = logging.getLogger(__name__)
+
+
+def read_cards(path):
+    """
+    Iterate over the rows of the file as dictionaries, from the header of
+    a CSV file (`.csv`) or from every line of a JSON lines file
+    """
+    with open(path, 'rb') as file_:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(file_):
+                yield dict(
+                    (k, v.decode('utf-8') if v else None)
+                    for k, v in row.iteritems()
+                )
+        else:
+            for line in file_:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def chunked(rows, size):
+    """
+    Iterate over the lists of `size` rows
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _read_checkpoint(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as file_:
+        return json.load(file_)['rows']
+
+
+def _write_checkpoint(path, rows):
+    # Written aside then renamed, so that the checkpoint is never partial
+    with open(path + '.tmp', 'w') as file_:
+        json.dump({'rows': rows}, file_)
+    os.rename(path + '.tmp', path)
+
+
+def import_cards(
+        gateway, path, chunk_size=500, validate=False, checkpoint=None,
+        commit=True):
+    """
+    Import the cards of the file into the gateway by chunks of `chunk_size`
+    rows with `PaymentProfile.import_authorize_net_cards`.
+
+    After every chunk the transaction is committed, if `commit` is set, and
+    the number of rows done is written to the `checkpoint` file, by default
+    the path of the file followed by `.checkpoint`. The import starts after
+    the rows of the checkpoint.
+
+    Returns the number of rows `imported` and `failed` by this run.
+    """
+    PaymentProfile = Pool().get('party.payment_profile')
+
+    if checkpoint is None:
+        checkpoint = path + '.checkpoint'
+    done = _read_checkpoint(checkpoint)
+    report = {'imported': 0, 'failed': 0}
+    rows = islice(read_cards(path), done, None)
+    for chunk in chunked(rows, chunk_size):
+        failures = PaymentProfile.import_authorize_net_cards(
+            gateway, chunk, validate=validate
+        )
+        for row, exc in failures:
+            logger.warning(
+                'Card of party %s not imported: %s', row.get('party'), exc
+            )
+        if commit:
+            Transaction().commit()
+        done += len(chunk)
+        _write_checkpoint(checkpoint, done)
+        report['imported'] += len(chunk) - len(failures)
+        report['failed'] += len(failures)
+        logger.info('%s rows of %s done', done, path)
+    return report
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Import cards on file into an authorize.net gateway'
+    )
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument(
+        '-g', '--gateway', dest='gateway', type=int, required=True
+    )
+    parser.add_argument(
+        '--chunk-size', dest='chunk_size', type=int, default=500
+    )
+    parser.add_argument('--validate', dest='validate', action='store_true')
+    parser.add_argument('path')
+    options = parser.parse_args()
+
+    from trytond.config import config
+    config.update_etc(options.config or os.environ.get('TRYTOND_CONFIG'))
+    logging.basicConfig(level=logging.INFO)
+
+    Pool(options.database).init()
+    with Transaction().start(options.database, 0):
+        Gateway = Pool().get('payment_gateway.gateway')
+        report = import_cards(
+            Gateway(options.gateway), options.path,
+            chunk_size=options.chunk_size, validate=options.validate
+        )
+    logger.info('%(imported)s cards imported, %(failed)s failed', report)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,21 +4,111 @@
 
     :license: see LICENSE for details.
 """
-import authorize
+import hashlib
+import json
+import logging
+import re
+from itertools import chain
+
 from authorize.exceptions import AuthorizeInvalidError, \
     AuthorizeResponseError
 
-from trytond.model import fields
+from trytond import backend
+from trytond.cache import Cache
+from trytond.model import ModelSQL, Unique, fields
 from trytond.rpc import RPC
 from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+from .breaker import CircuitOpenError
+from .timing import timer
+from .utils import map_concurrently
 
 __metaclass__ = PoolMeta
-__all__ = ['Party', 'Address', 'PaymentProfile']
+__all__ = [
+    'Party', 'Address', 'PaymentProfile', 'AuthorizeNetCustomer',
+    'ContactMechanism', 'Country', 'Subdivision',
+]
+
+logger = logging.getLogger(__name__)
+
+# authorize.net answers a duplicate customer profile with its id
+DUPLICATE_CUSTOMER_RE = re.compile(r'duplicate record with ID (\d+)')
+
+# Attribute of the transaction holding the address payloads
+AUTHORIZE_ADDRESS_CACHE = '_authorize_net_addresses'
+
+ADDRESS_FIELDS = (
+    'first_name', 'last_name', 'company', 'address', 'city', 'state', 'zip',
+    'country', 'phone_number', 'fax_number',
+)
+
+
+def get_address_digest(address):
+    """
+    Return the digest of the content of an authorize.net address, from the
+    data sent or from a customer profile
+    """
+    return hashlib.sha1(json.dumps([
+        unicode(address.get(name) or '') for name in ADDRESS_FIELDS
+    ])).hexdigest()
+
+
+def get_address_payloads():
+    """
+    Return the dictionary of the address payloads cached in the current
+    transaction, by address id, write date and name
+    """
+    transaction = Transaction()
+    payloads = getattr(transaction, AUTHORIZE_ADDRESS_CACHE, None)
+    if payloads is None:
+        payloads = {}
+        setattr(transaction, AUTHORIZE_ADDRESS_CACHE, payloads)
+    return payloads
+
+
+def clear_address_payloads():
+    """
+    Clear the address payloads cached in the current transaction, when a
+    party, contact mechanism, country or subdivision they are built from
+    is changed
+    """
+    get_address_payloads().clear()
+
+
+def get_card_expiry(row):
+    """
+    Return the expiry month and year of the card of an imported row, as
+    `MM` and `YYYY`
+    """
+    expiry_year = str(row['expiry_year'])
+    if len(expiry_year) == 2:
+        expiry_year = '20' + expiry_year
+    return str(row['expiry_month']).zfill(2), expiry_year
 
 
 class Party:
     __name__ = 'party.party'
 
+    # (party id, gateway id) -> customer profile id, cleared when payment
+    # profiles or provisioned customers are written
+    _authorize_net_customer_cache = Cache(
+        'party.party.authorize_net_customer_id', context=False
+    )
+    # (gateway id, customer profile id) -> payment profile ids on
+    # authorize.net at the last sync
+    _authorize_net_payments_cache = Cache(
+        'party.party.authorize_net_payment_ids', context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(Party, cls).__setup__()
+        cls._error_messages.update({
+            'authorize_net_unavailable': 'Authorize.net is temporarily '
+            'unavailable, please try again in a few minutes.',
+        })
+
     def _get_authorize_net_customer_id(self, gateway_id):
         """
         Extracts and returns customer id from party's payment profile
@@ -26,32 +116,261 @@ class Party:
 
         :param gateway_id: The gateway ID to which the customer id is associated
         """
-        PaymentProfile = Pool().get('party.payment_profile')
+        pool = Pool()
+        PaymentProfile = pool.get('party.payment_profile')
+        Customer = pool.get('party.authorize_net.customer')
+
+        key = (self.id, gateway_id)
+        customer_id = self._authorize_net_customer_cache.get(key)
+        if customer_id is not None:
+            return customer_id
 
-        payment_profiles = PaymentProfile.search([
+        payment_profiles = PaymentProfile.search_read([
             ('party', '=', self.id),
             ('authorize_profile_id', '!=', None),
             ('gateway', '=', gateway_id),
-        ])
+        ], limit=1, fields_names=['authorize_profile_id'])
         if payment_profiles:
-            return payment_profiles[0].authorize_profile_id
-        return None
+            customer_id = payment_profiles[0]['authorize_profile_id']
+        else:
+            customers = Customer.search_read([
+                ('party', '=', self.id),
+                ('gateway', '=', gateway_id),
+            ], limit=1, fields_names=['customer_id'])
+            if not customers:
+                # Parties without profile are not cached, their profile is
+                # likely to be created soon
+                return None
+            customer_id = customers[0]['customer_id']
+        return self._authorize_net_customer_cache.set(key, customer_id)
 
-    def create_auth_profile(self):
+    def create_auth_profile(self, gateway=None):
         """
         Creates a customer profile on authorize.net and returns
         created profile's ID
+
+        :param gateway: The gateway on which the profile is created, by
+            default the only authorize.net gateway
         """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        if gateway is None:
+            gateway = Gateway.get_default_authorize_net_gateway()
+        client = gateway.get_authorize_client()
         try:
-            customer = authorize.Customer.create({
-                'description': self.name,
-                'email': self.email,
-            })
+            with timer('create_auth_profile.gateway'):
+                customer = client.customer.create({
+                    'description': self.name,
+                    'email': self.email,
+                })
+        except CircuitOpenError:
+            self.raise_user_error('authorize_net_unavailable')
         except (AuthorizeInvalidError, AuthorizeResponseError) as exc:
             self.raise_user_error(unicode(exc))
 
         return customer.customer_id
 
+    def add_authorize_net_payment_id(self, gateway, customer_id, payment_id):
+        """
+        Add a payment profile created on authorize.net to the snapshot of
+        the customer profile
+        """
+        key = (gateway.id, customer_id)
+        remote_ids = self._authorize_net_payments_cache.get(key)
+        if remote_ids is not None:
+            self._authorize_net_payments_cache.set(
+                key, tuple(sorted(set(remote_ids) | {payment_id}))
+            )
+
+    def sync_authorize_net_payments(self, gateway, customer_id, refresh=False):
+        """
+        Delete the payment profiles of the customer profile on authorize.net
+        which are not used by a payment profile of the party and return
+        their ids.
+
+        The remote payment ids are kept as a snapshot so that the unused
+        ones are found without fetching the customer profile. It is fetched
+        when there is no snapshot, when it gives nothing to delete or when
+        `refresh` is set. The deletions are made concurrently.
+
+        :param gateway: The gateway of the customer profile
+        :param customer_id: The customer profile id on authorize.net
+        :param refresh: Fetch the customer profile even with a snapshot
+        """
+        key = (gateway.id, customer_id)
+        local_ids = set(p.provider_reference for p in self.payment_profiles)
+        client = gateway.get_authorize_client()
+
+        remote_ids = None if refresh else \
+            self._authorize_net_payments_cache.get(key)
+        deleted = []
+        if remote_ids is not None:
+            remote_ids = set(remote_ids)
+            deleted, missing = self._delete_authorize_net_payments(
+                client, customer_id, remote_ids - local_ids
+            )
+            remote_ids.difference_update(deleted, missing)
+        if not deleted:
+            # The snapshot is missing or outdated
+            with timer('sync_authorize_net_payments.gateway'):
+                customer_details = client.customer.details(customer_id)
+            remote_ids = set(
+                p.payment_id
+                for p in customer_details.profile.get('payments', [])
+            )
+            deleted, missing = self._delete_authorize_net_payments(
+                client, customer_id, remote_ids - local_ids
+            )
+            remote_ids.difference_update(deleted, missing)
+        self._authorize_net_payments_cache.set(
+            key, tuple(sorted(remote_ids))
+        )
+        return deleted
+
+    @staticmethod
+    def _delete_authorize_net_payments(client, customer_id, payment_ids):
+        """
+        Delete the payment profiles on authorize.net concurrently and return
+        the ids deleted and the ids which were already missing
+        """
+        def delete(payment_id):
+            with timer('sync_authorize_net_payments.gateway'):
+                client.credit_card.delete(customer_id, payment_id)
+
+        payment_ids = list(payment_ids)
+        deleted, missing = [], []
+        for payment_id, (_, exc) in zip(
+                payment_ids, map_concurrently(delete, payment_ids)):
+            if exc is None:
+                deleted.append(payment_id)
+            elif isinstance(exc, AuthorizeResponseError) and \
+                    'E00040' in unicode(exc):
+                missing.append(payment_id)
+            else:
+                logger.warning(
+                    'Unable to delete the payment profile %s of the '
+                    'customer profile %s: %s', payment_id, customer_id, exc
+                )
+        return deleted, missing
+
+    @classmethod
+    def create_auth_profiles(cls, parties, gateway):
+        """
+        Create the customer profiles of the parties on authorize.net with
+        concurrent calls and record their ids in one write. Parties which
+        already have a customer profile on the gateway are skipped.
+
+        The merchant customer id sent is the id of the party, so a run which
+        was interrupted after the profiles were created on authorize.net
+        recovers their ids from the duplicate errors when it is run again.
+
+        Return the list of (party, exception) of the parties which failed.
+
+        :param parties: The parties to create customer profiles for
+        :param gateway: The gateway on which the profiles are created
+        """
+        pool = Pool()
+        PaymentProfile = pool.get('party.payment_profile')
+        Customer = pool.get('party.authorize_net.customer')
+
+        with timer('create_auth_profiles.request'):
+            party_ids = [p.id for p in parties]
+            existing = set(
+                p['party'] for p in PaymentProfile.search_read([
+                    ('party', 'in', party_ids),
+                    ('authorize_profile_id', '!=', None),
+                    ('gateway', '=', gateway.id),
+                ], fields_names=['party'])
+            )
+            existing.update(
+                c['party'] for c in Customer.search_read([
+                    ('party', 'in', party_ids),
+                    ('gateway', '=', gateway.id),
+                ], fields_names=['party'])
+            )
+            parties = [p for p in parties if p.id not in existing]
+            params = [{
+                'merchant_id': str(p.id),
+                'description': p.name,
+                'email': p.email,
+            } for p in parties]
+
+        # Clients and records are resolved here, the threads only make the
+        # calls to authorize.net
+        client = gateway.get_authorize_client()
+
+        def create(data):
+            try:
+                with timer('create_auth_profiles.gateway'):
+                    return client.customer.create(data).customer_id
+            except AuthorizeResponseError as exc:
+                match = DUPLICATE_CUSTOMER_RE.search(unicode(exc))
+                if 'E00039' in unicode(exc) and match:
+                    return match.group(1)
+                raise
+
+        outcomes = map_concurrently(create, params)
+
+        to_create, failures = [], []
+        for party, (customer_id, exc) in zip(parties, outcomes):
+            if exc is not None:
+                failures.append((party, exc))
+                continue
+            to_create.append({
+                'party': party.id,
+                'gateway': gateway.id,
+                'customer_id': customer_id,
+            })
+        with timer('create_auth_profiles.save'):
+            if to_create:
+                Customer.create(to_create)
+        return failures
+
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+        clear_address_payloads()
+
+
+class AuthorizeNetCustomer(ModelSQL):
+    'Authorize.net Customer Profile'
+    __name__ = 'party.authorize_net.customer'
+
+    party = fields.Many2One(
+        'party.party', 'Party', ondelete='CASCADE', select=True,
+        required=True
+    )
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', ondelete='CASCADE',
+        select=True, required=True
+    )
+    customer_id = fields.Char('Customer Profile ID', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AuthorizeNetCustomer, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('party_gateway_uniq', Unique(t, t.party, t.gateway),
+                'A party can only have one customer profile per gateway.'),
+        ]
+
+    @classmethod
+    def create(cls, vlist):
+        customers = super(AuthorizeNetCustomer, cls).create(vlist)
+        Pool().get('party.party')._authorize_net_customer_cache.clear()
+        return customers
+
+    @classmethod
+    def write(cls, *args):
+        super(AuthorizeNetCustomer, cls).write(*args)
+        Pool().get('party.party')._authorize_net_customer_cache.clear()
+
+    @classmethod
+    def delete(cls, customers):
+        super(AuthorizeNetCustomer, cls).delete(customers)
+        Pool().get('party.party')._authorize_net_customer_cache.clear()
+
 
 class Address:
     __name__ = 'party.address'
@@ -60,48 +379,135 @@ class Address:
         'Authorize.net ID', readonly=True
     )
 
-    def send_to_authorize(self, profile_id):
+    # (gateway id, customer profile id) -> (content digest, address id) of
+    # the shipping addresses uploaded to authorize.net
+    _authorize_net_address_cache = Cache(
+        'party.address.authorize_net_addresses', context=False
+    )
+
+    def send_to_authorize(self, profile_id, gateway=None):
         """
         Helpler method which creates a new address record on
         authorize.net servers and returns it's ID.
 
+        An address with the same content already uploaded to the customer
+        profile is reused without any call to authorize.net.
+
         :param profile_id: The profile_id of customer profile for
             which you want to create address. Required if create=True
+        :param gateway: The gateway of the customer profile, found from the
+            profile by default
         """
-        Address = Pool().get('party.address')
+        pool = Pool()
+        Address = pool.get('party.address')
+        Gateway = pool.get('payment_gateway.gateway')
 
+        if gateway is None:
+            gateway = Gateway.get_default_authorize_net_gateway(profile_id)
+        key = (gateway.id, profile_id)
+        client = gateway.get_authorize_client()
+        with timer('send_to_authorize.request'):
+            address_data = self.get_authorize_address()
+            digest = get_address_digest(address_data)
+            index = dict(self._authorize_net_address_cache.get(key) or ())
+        address_id = index.get(digest)
         for try_count in range(2):
-            try:
-                address = authorize.Address.create(
-                    profile_id, self.get_authorize_address()
-                )
+            if address_id:
                 break
+            try:
+                with timer('send_to_authorize.gateway'):
+                    address_id = client.address.create(
+                        profile_id, address_data
+                    ).address_id
             except AuthorizeResponseError as exc:
+                if try_count == 0 and 'E00039' in unicode(exc):
+                    # The duplicate is the address already uploaded
+                    address_id = exc.full_response.get('address_id') or \
+                        self.index_authorize_addresses(
+                            profile_id, gateway).get(digest)
+                    if address_id:
+                        break
                 if try_count == 0 and (
                         'E00039' in unicode(exc) or
                         'E00043' in unicode(exc)
                 ):
-                    # Delete all addresses on authorize.net
-                    self.delete_authorize_addresses(profile_id)
+                    # Delete the unused addresses on authorize.net
+                    self.delete_authorize_addresses(profile_id, gateway)
+                    address_id = dict(
+                        self._authorize_net_address_cache.get(key) or ()
+                    ).get(digest)
                     continue
                 self.raise_user_error(unicode(exc))
             except AuthorizeInvalidError as exc:
                 self.raise_user_error(unicode(exc))
 
-        address_id = address.address_id
+        index = dict(self._authorize_net_address_cache.get(key) or ())
+        index[digest] = address_id
+        self._authorize_net_address_cache.set(key, tuple(index.items()))
 
-        Address.write([self], {
-            'authorize_id': address_id,
-        })
+        with timer('send_to_authorize.save'):
+            Address.write([self], {
+                'authorize_id': address_id,
+            })
         return address_id
 
+    def index_authorize_addresses(self, profile_id, gateway):
+        """
+        Fetch the shipping addresses of the customer profile on authorize.net
+        and return the index of their ids by content digest
+        """
+        client = gateway.get_authorize_client()
+        with timer('index_authorize_addresses.gateway'):
+            customer_details = client.customer.details(profile_id)
+        index = dict(
+            (get_address_digest(a), a.address_id)
+            for a in customer_details.profile.get('addresses', [])
+        )
+        self._authorize_net_address_cache.set(
+            (gateway.id, profile_id), tuple(index.items())
+        )
+        return index
+
+    @classmethod
+    def write(cls, *args):
+        super(Address, cls).write(*args)
+        ids = set(a.id for a in chain(*args[::2]))
+        payloads = get_address_payloads()
+        for key in [k for k in payloads if k[0] in ids]:
+            del payloads[key]
+
     def get_authorize_address(self, name=None):
         """
         Returns address as a dictionary to send to authorize.net
 
+        The dictionaries are cached in the transaction by address id and
+        write date, and cleared when a party, contact mechanism, country or
+        subdivision is written.
+
         :param name: Name to send as first name in address.
             Default is party's name.
         """
+        if self.id is None or self.id < 0:
+            return self._get_authorize_address(name)
+        payloads = get_address_payloads()
+        key = (self.id, self.write_date, name)
+        if key not in payloads:
+            payloads[key] = self._get_authorize_address(name)
+        return payloads[key].copy()
+
+    @classmethod
+    def get_authorize_addresses(cls, addresses, name=None):
+        """
+        Returns the dictionaries of `get_authorize_address` for many
+        addresses. The addresses are browsed together so that their party,
+        country and subdivision are read once for all of them.
+        """
+        return [
+            a.get_authorize_address(name)
+            for a in cls.browse([a.id for a in addresses])
+        ]
+
+    def _get_authorize_address(self, name=None):
         name = name or self.name or self.party.name
 
         try:
@@ -123,31 +529,94 @@ class Address:
             'fax_number': self.party.fax,
         }
 
-    def delete_authorize_addresses(self, profile_id):
+    def delete_authorize_addresses(self, profile_id, gateway=None):
         """
-        Delete all shipping addresses for customer on authorize.net
+        Delete the shipping addresses of the customer on authorize.net which
+        are not used by any address and return their ids. The deletions are
+        made concurrently.
+
+        The gateway of the customer profile is found from the profile by
+        default.
         """
-        Address = Pool().get('party.address')
+        pool = Pool()
+        Address = pool.get('party.address')
+        Gateway = pool.get('payment_gateway.gateway')
 
-        customer_details = authorize.Customer.details(profile_id)
-        address_ids = [
-            a.address_id for a in customer_details.profile.addresses
-        ]
-        for address_id in address_ids:
-            authorize.Address.delete(profile_id, address_id)
+        if gateway is None:
+            gateway = Gateway.get_default_authorize_net_gateway(profile_id)
 
-        # Set authorize_id none for all party addresses
-        Address.write(list(self.party.addresses), {
-            'authorize_id': None,
-        })
+        client = gateway.get_authorize_client()
+        index = self.index_authorize_addresses(profile_id, gateway)
+        remote_ids = set(index.values())
+        with timer('delete_authorize_addresses.request'):
+            used_ids = set(a['authorize_id'] for a in Address.search_read([
+                ('authorize_id', 'in', list(remote_ids)),
+            ], fields_names=['authorize_id']))
+            stale_ids = list(remote_ids - used_ids)
+
+        def delete(address_id):
+            with timer('delete_authorize_addresses.gateway'):
+                client.address.delete(profile_id, address_id)
+
+        deleted = []
+        for address_id, (_, exc) in zip(
+                stale_ids, map_concurrently(delete, stale_ids)):
+            if exc is None:
+                deleted.append(address_id)
+            else:
+                logger.warning(
+                    'Unable to delete the shipping address %s of the '
+                    'customer profile %s: %s', address_id, profile_id, exc
+                )
+
+        self._authorize_net_address_cache.set(
+            (gateway.id, profile_id), tuple(
+                (digest, address_id) for digest, address_id in index.items()
+                if address_id not in deleted
+            )
+        )
+
+        # The addresses of the party which are no more on authorize.net
+        # must be sent again
+        with timer('delete_authorize_addresses.save'):
+            addresses = [
+                a for a in self.party.addresses
+                if a.authorize_id and a.authorize_id not in remote_ids
+            ]
+            if addresses:
+                Address.write(addresses, {
+                    'authorize_id': None,
+                })
+        return deleted
 
 
 class PaymentProfile:
     __name__ = 'party.payment_profile'
 
     authorize_profile_id = fields.Char(
-        'Authorize.net Profile ID', readonly=True
+        'Authorize.net Profile ID', readonly=True, select=True
     )
+    authorize_net_validation_state = fields.Selection([
+        (None, ''),
+        ('pending', 'Pending'),
+        ('valid', 'Valid'),
+        ('invalid', 'Invalid'),
+    ], 'Card Validation', readonly=True, select=True,
+        help='The validation of the card by Authorize.net. The cards of the '
+        'gateways which defer it are validated by a scheduled task.'
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentProfile, cls).__register__(module_name)
+
+        # The customer profile of a party is searched on the three columns
+        table = TableHandler(cls, module_name)
+        table.index_action(
+            ['party', 'gateway', 'authorize_profile_id'], action='add'
+        )
 
     @classmethod
     def __setup__(cls):
@@ -157,6 +626,29 @@ class PaymentProfile:
                 instantiate=0, readonly=False
             )
         })
+        cls._error_messages.update({
+            'authorize_net_unavailable': 'Authorize.net is temporarily '
+            'unavailable, please try again in a few minutes.',
+        })
+
+    @classmethod
+    def create(cls, vlist):
+        profiles = super(PaymentProfile, cls).create(vlist)
+        if any(v.get('authorize_profile_id') for v in vlist):
+            Pool().get('party.party')._authorize_net_customer_cache.clear()
+        return profiles
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentProfile, cls).write(*args)
+        names = {'party', 'gateway', 'authorize_profile_id', 'active'}
+        if any(names & set(values) for values in args[1::2]):
+            Pool().get('party.party')._authorize_net_customer_cache.clear()
+
+    @classmethod
+    def delete(cls, profiles):
+        super(PaymentProfile, cls).delete(profiles)
+        Pool().get('party.party')._authorize_net_customer_cache.clear()
 
     @classmethod
     def create_profile_using_authorize_net_nonce(
@@ -175,55 +667,50 @@ class PaymentProfile:
         customer_info = nonce_data['customerInformation']
         card_info = nonce_data['encryptedCardData']
 
+        timer_name = 'create_profile_using_authorize_net_nonce'
+
         party = Party(user_id)
         gateway = PaymentGateway(gateway_id)
         assert gateway.provider == 'authorize_net'
-        gateway.get_authorize_client()
+        client = gateway.get_authorize_client()
 
-        customer_id = party._get_authorize_net_customer_id(
-            gateway.id
-        )
+        with timer('%s.request' % timer_name):
+            customer_id = party._get_authorize_net_customer_id(
+                gateway.id
+            )
         if not customer_id:
-            customer_id = party.create_auth_profile()
+            customer_id = party.create_auth_profile(gateway)
 
-        card_data = {
-            'opaque_data': {
-                'data_descriptor': opaque_data['dataDescriptor'],
-                'data_value': opaque_data['dataValue'],
+        with timer('%s.request' % timer_name):
+            card_data = {
+                'opaque_data': {
+                    'data_descriptor': opaque_data['dataDescriptor'],
+                    'data_value': opaque_data['dataValue'],
+                }
             }
-        }
-        if address_id:
-            address_data = Address(address_id).get_authorize_address()
-            card_data['billing'] = address_data
+            if address_id:
+                address_data = Address(address_id).get_authorize_address()
+                card_data['billing'] = address_data
 
         try:
-            credit_card = authorize.CreditCard.create(
-                customer_id, card_data
-            )
+            with timer('%s.gateway' % timer_name):
+                credit_card = client.credit_card.create(
+                    customer_id, card_data
+                )
+        except CircuitOpenError:
+            cls.raise_user_error('authorize_net_unavailable')
         except AuthorizeInvalidError as exc:
             cls.raise_user_error(unicode(exc))
         except AuthorizeResponseError as exc:
             if 'E00039' in unicode(exc):
-                # Delete all unused payment profiles on authorize.net
-                customer_details = authorize.Customer.details(customer_id)
-                auth_payment_ids = set([
-                    p.payment_id for p in customer_details.profile.payments
-                ])
-                if party.payment_profiles:
-                    local_payment_ids = set([
-                        p.provider_reference for p in party.payment_profiles  # noqa
-                    ])
-                    ids_to_delete = auth_payment_ids.difference(
-                        local_payment_ids
-                    )
-                else:
-                    ids_to_delete = auth_payment_ids
-
-                if ids_to_delete:
-                    for payment_id in ids_to_delete:
-                        authorize.CreditCard.delete(customer_id, payment_id)
+                # Delete the unused payment profiles on authorize.net
+                party.sync_authorize_net_payments(gateway, customer_id)
             cls.raise_user_error(unicode(exc))
 
+        party.add_authorize_net_payment_id(
+            gateway, customer_id, credit_card.payment_id
+        )
+
         name = (
             customer_info.get('firstName', '') +
             customer_info.get('lastName', '')
@@ -232,15 +719,328 @@ class PaymentProfile:
         if len(expiry_year) == 2:
             expiry_year = '20' + expiry_year
 
-        profile, = PaymentProfile.create([{
-            'name': name or party.name,
+        with timer('%s.save' % timer_name):
+            profile, = PaymentProfile.create([{
+                'name': name or party.name,
+                'party': party.id,
+                'address': address_id or party.addresses[0].id,
+                'gateway': gateway.id,
+                'last_4_digits': card_info['cardNumber'][-4:],
+                'expiry_month': expiry_month,
+                'expiry_year': expiry_year,
+                'provider_reference': credit_card.payment_id,
+                'authorize_profile_id': customer_id,
+            }])
+        return profile.id
+
+    @classmethod
+    def validate_authorize_net_profiles(cls, batch_size=1000):
+        """
+        Validate the cards of the profiles added to the gateways which defer
+        their validation, `batch_size` profiles at a time with concurrent
+        calls. It is called by a scheduled task.
+
+        The cards refused by authorize.net are marked invalid and their
+        profiles deactivated. The profiles which got no answer stay pending
+        until the next run.
+        """
+        name = 'validate_authorize_net_profiles'
+        last_id = 0
+        while True:
+            profiles = cls.search([
+                ('authorize_net_validation_state', '=', 'pending'),
+                ('id', '>', last_id),
+            ], order=[('id', 'ASC')], limit=batch_size)
+            if not profiles:
+                break
+            last_id = profiles[-1].id
+
+            with timer('%s.request' % name):
+                clients = dict(
+                    (p.gateway.id, p.gateway.get_authorize_client())
+                    for p in profiles
+                )
+                params = [(
+                    p.gateway.id, p.authorize_profile_id,
+                    p.provider_reference,
+                    p.gateway.get_authorize_net_validation_mode(),
+                ) for p in profiles]
+
+            def call(item):
+                gateway_id, customer_id, payment_id, validation_mode = item
+                with timer('%s.gateway' % name):
+                    return clients[gateway_id].credit_card.validate(
+                        customer_id, payment_id,
+                        {'validation_mode': validation_mode}
+                    )
+
+            valid, invalid = [], []
+            for profile, (_, exc) in zip(
+                    profiles, map_concurrently(call, params)):
+                if exc is None:
+                    valid.append(profile)
+                elif isinstance(
+                        exc, (AuthorizeResponseError, AuthorizeInvalidError)):
+                    logger.warning(
+                        'Card of payment profile %s is invalid: %s',
+                        profile.id, exc
+                    )
+                    invalid.append(profile)
+                else:
+                    logger.warning(
+                        'Card of payment profile %s not validated: %s',
+                        profile.id, exc
+                    )
+            to_write = []
+            if valid:
+                to_write.extend([
+                    valid, {'authorize_net_validation_state': 'valid'}
+                ])
+            if invalid:
+                to_write.extend([invalid, {
+                    'authorize_net_validation_state': 'invalid',
+                    'active': False,
+                }])
+            with timer('%s.save' % name):
+                if to_write:
+                    cls.write(*to_write)
+
+    @classmethod
+    def import_authorize_net_cards(cls, gateway, rows, validate=False):
+        """
+        Upload the cards of the rows to the gateway, creating the customer
+        profiles of their parties if needed, with concurrent calls, then
+        create their payment profiles together.
+
+        A row is a dictionary with the `party` code, the cardholder `name`,
+        the `expiry_month` and `expiry_year`, and either the card `number`
+        with its optional `csc` or the `data_descriptor` and `data_value` of
+        a token with the `last_4_digits` of the card. The cards are
+        validated by authorize.net only with `validate`. The rows of the
+        parties without address fail before any call. A card uploaded by
+        an interrupted run is recovered from the duplicate error and its
+        payment profile is not created again.
+
+        Returns the list of `(row, exception)` of the rows which failed.
+        """
+        Party = Pool().get('party.party')
+        name = 'import_authorize_net_cards'
+
+        with timer('%s.request' % name):
+            parties = dict((p.code, p) for p in Party.search([
+                ('code', 'in', list(set(r.get('party') for r in rows))),
+            ]))
+        failures = []
+        for row in rows:
+            party = parties.get(row.get('party'))
+            if party is None:
+                failures.append(
+                    (row, ValueError('Unknown party %s' % row.get('party')))
+                )
+            elif not party.addresses:
+                failures.append(
+                    (row, ValueError('Party %s has no address' % party.code))
+                )
+        rows = [
+            r for r in rows
+            if r.get('party') in parties and parties[r['party']].addresses
+        ]
+        parties = dict((r['party'], parties[r['party']]) for r in rows)
+
+        failed = dict(
+            (p.id, exc) for p, exc in Party.create_auth_profiles(
+                parties.values(), gateway
+            )
+        )
+        failures.extend(
+            (r, failed[parties[r['party']].id]) for r in rows
+            if parties[r['party']].id in failed
+        )
+        rows = [r for r in rows if parties[r['party']].id not in failed]
+
+        with timer('%s.request' % name):
+            customer_ids = cls._get_authorize_net_customer_ids(
+                parties.values(), gateway
+            )
+            params = [(
+                customer_ids[parties[r['party']].id],
+                cls._get_authorize_net_card_data(r, parties[r['party']])
+            ) for r in rows]
+
+        client = gateway.get_authorize_client()
+        validation_mode = gateway.get_authorize_net_validation_mode()
+
+        def upload(item):
+            customer_id, data = item
+            try:
+                with timer('%s.gateway' % name):
+                    payment_id = client.credit_card.create(
+                        customer_id, data
+                    ).payment_id
+            except AuthorizeResponseError as exc:
+                payment_id = 'E00039' in unicode(exc) and \
+                    exc.full_response.get('payment_id')
+                if not payment_id:
+                    raise
+            if validate:
+                validation = {'validation_mode': validation_mode}
+                if data.get('credit_card', {}).get('card_code'):
+                    validation['card_code'] = data['credit_card']['card_code']
+                with timer('%s.gateway' % name):
+                    client.credit_card.validate(
+                        customer_id, payment_id, validation
+                    )
+            return payment_id
+
+        uploaded = []
+        for row, (customer_id, _), (payment_id, exc) in zip(
+                rows, params, map_concurrently(upload, params)):
+            if exc is not None:
+                failures.append((row, exc))
+                continue
+            uploaded.append((row, customer_id, payment_id))
+        with timer('%s.save' % name):
+            cls._create_imported_profiles(gateway, parties, uploaded)
+        return failures
+
+    @classmethod
+    def _create_imported_profiles(cls, gateway, parties, uploaded):
+        """
+        Create the payment profiles of the uploaded cards, except those
+        already created by an interrupted run
+
+        :param parties: Dictionary of the parties by code
+        :param uploaded: List of `(row, customer_id, payment_id)`
+        """
+        existing = set(
+            (p.authorize_profile_id, p.provider_reference)
+            for p in cls.search([
+                ('gateway', '=', gateway.id),
+                ('provider_reference', 'in', [
+                    payment_id for _, _, payment_id in uploaded
+                ]),
+            ])
+        )
+        vlist = []
+        for row, customer_id, payment_id in uploaded:
+            if (customer_id, payment_id) in existing:
+                continue
+            existing.add((customer_id, payment_id))
+            party = parties[row['party']]
+            party.add_authorize_net_payment_id(
+                gateway, customer_id, payment_id
+            )
+            vlist.append(cls._get_imported_profile_values(
+                row, party, gateway, customer_id, payment_id
+            ))
+        if vlist:
+            cls.create(vlist)
+
+    @classmethod
+    def _get_authorize_net_customer_ids(cls, parties, gateway):
+        """
+        Return the customer profile ids of the parties on the gateway by
+        party id, read in bulk
+        """
+        Customer = Pool().get('party.authorize_net.customer')
+
+        party_ids = [p.id for p in parties]
+        customer_ids = dict(
+            (c['party'], c['customer_id']) for c in Customer.search_read([
+                ('party', 'in', party_ids),
+                ('gateway', '=', gateway.id),
+            ], fields_names=['party', 'customer_id'])
+        )
+        # The payment profiles come first, like in
+        # `Party._get_authorize_net_customer_id`
+        customer_ids.update(
+            (p['party'], p['authorize_profile_id'])
+            for p in cls.search_read([
+                ('party', 'in', party_ids),
+                ('authorize_profile_id', '!=', None),
+                ('gateway', '=', gateway.id),
+            ], fields_names=['party', 'authorize_profile_id'])
+        )
+        return customer_ids
+
+    @staticmethod
+    def _get_authorize_net_card_data(row, party):
+        """
+        Return the data of the payment profile of an imported row
+        """
+        if row.get('number'):
+            data = {
+                'credit_card': {
+                    'card_number': row['number'],
+                    'expiration_date': '%s/%s' % get_card_expiry(row),
+                },
+            }
+            if row.get('csc'):
+                data['credit_card']['card_code'] = str(row['csc'])
+        else:
+            data = {
+                'opaque_data': {
+                    'data_descriptor': row.get('data_descriptor'),
+                    'data_value': row.get('data_value'),
+                },
+            }
+        data['billing'] = party.addresses[0].get_authorize_address(
+            row.get('name')
+        )
+        return data
+
+    @staticmethod
+    def _get_imported_profile_values(
+            row, party, gateway, customer_id, payment_id):
+        expiry_month, expiry_year = get_card_expiry(row)
+        return {
+            'name': row.get('name') or party.name,
             'party': party.id,
-            'address': address_id or party.addresses[0].id,
+            'address': party.addresses[0].id,
             'gateway': gateway.id,
-            'last_4_digits': card_info['cardNumber'][-4:],
+            'last_4_digits': (
+                row.get('number') or row.get('last_4_digits') or ''
+            )[-4:],
             'expiry_month': expiry_month,
             'expiry_year': expiry_year,
-            'provider_reference': credit_card.payment_id,
+            'provider_reference': payment_id,
             'authorize_profile_id': customer_id,
-        }])
-        return profile.id
+        }
+
+
+class ContactMechanism:
+    __name__ = 'party.contact_mechanism'
+
+    @classmethod
+    def create(cls, vlist):
+        mechanisms = super(ContactMechanism, cls).create(vlist)
+        clear_address_payloads()
+        return mechanisms
+
+    @classmethod
+    def write(cls, *args):
+        super(ContactMechanism, cls).write(*args)
+        clear_address_payloads()
+
+    @classmethod
+    def delete(cls, mechanisms):
+        super(ContactMechanism, cls).delete(mechanisms)
+        clear_address_payloads()
+
+
+class Country:
+    __name__ = 'country.country'
+
+    @classmethod
+    def write(cls, *args):
+        super(Country, cls).write(*args)
+        clear_address_payloads()
+
+
+class Subdivision:
+    __name__ = 'country.subdivision'
+
+    @classmethod
+    def write(cls, *args):
+        super(Subdivision, cls).write(*args)
+        clear_address_payloads()
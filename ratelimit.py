@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    ratelimit
+
+    Token bucket pacing the calls to authorize.net of a merchant account.
+
+    The bucket is kept in a file locked while it is updated, so that it is
+    shared by the threads and the processes of a node. The rate is set by
+    the `rate_limit` option of the `authorize_net` section of the
+    configuration, in calls per second, and the bucket holds up to
+    `rate_limit_burst` calls. There is no limit without rate.
+
+    :license: see LICENSE for details.
+"""
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from trytond.config import config
+
+__all__ = ['TokenBucket', 'get_token_bucket']
+
+_STATE = struct.Struct('dd')
+
+
+class TokenBucket(object):
+    """
+    Token bucket stored in the file at `path`.
+
+    :param rate: Tokens added per second.
+    :param capacity: Maximum number of tokens, the size of a burst.
+    """
+
+    def __init__(self, path, rate, capacity=None):
+        self.path = path
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.lock = threading.Lock()
+
+    def _take(self, fd):
+        """
+        Take a token from the state of the file and return 0, or return the
+        seconds to wait for the next token
+        """
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, _STATE.size)
+        now = time.time()
+        if len(data) == _STATE.size:
+            tokens, updated = _STATE.unpack(data)
+            tokens = min(
+                self.capacity, tokens + max(now - updated, 0) * self.rate
+            )
+        else:
+            tokens = self.capacity
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / self.rate
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, _STATE.pack(tokens, now))
+        return wait
+
+    def acquire(self):
+        """
+        Wait until a token is available and take it
+        """
+        while True:
+            with self.lock:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                    wait = self._take(fd)
+                finally:
+                    # Closing the file releases the lock
+                    os.close(fd)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+def get_token_bucket(environment, login_id):
+    """
+    Return the token bucket of the merchant account set in the
+    configuration, None if there is no limit
+    """
+    rate = config.getfloat('authorize_net', 'rate_limit', default=0)
+    if not rate:
+        return None
+    directory = config.get(
+        'authorize_net', 'rate_limit_dir', default=tempfile.gettempdir()
+    )
+    name = hashlib.sha1(
+        '%s\n%s' % (environment, login_id)
+    ).hexdigest()
+    return TokenBucket(
+        os.path.join(directory, 'authorize_net-%s.bucket' % name),
+        rate,
+        config.getfloat('authorize_net', 'rate_limit_burst', default=rate),
+    )
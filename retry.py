@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    retry
+
+    Retry policy of the calls to authorize.net which got no answer: a
+    connection error, a timeout or a 5xx response.
+
+    The calls are retried after a jittered exponential backoff, within a
+    deadline so that the latency stays bounded, and every client has a
+    retry budget so that an outage does not multiply the load on the
+    gateway. The options are read from the `authorize_net` section of the
+    configuration.
+
+    :license: see LICENSE for details.
+"""
+import random
+import threading
+import time
+
+from trytond.config import config
+
+__all__ = ['RetryPolicy', 'RetryBudget', 'get_retry_policy']
+
+
+class RetryPolicy(object):
+    """
+    Give the delays before the retries of a call.
+
+    :param attempts: Maximum number of calls, the first one included.
+    :param base_delay: Seconds before the first retry, doubled at every
+        retry.
+    :param max_delay: Maximum seconds before a retry.
+    :param deadline: Seconds after the first call after which there is no
+        more retry.
+    """
+
+    def __init__(self, attempts=3, base_delay=0.1, max_delay=2, deadline=10):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def get_delay(self, attempt, start):
+        """
+        Return the seconds to wait before the retry following the failure
+        of the call number `attempt` (from 1), or None if the call must not
+        be retried.
+
+        :param start: Time of the first call
+        """
+        if attempt >= self.attempts:
+            return None
+        # Full jitter spreads the retries of concurrent calls
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+        if time.time() + delay - start > self.deadline:
+            return None
+        return delay
+
+
+class RetryBudget(object):
+    """
+    Allow a number of retries proportional to the number of calls: every
+    call adds `ratio` to the budget and every retry takes 1. The budget
+    starts at `minimum` retries and can not exceed twice that.
+    """
+
+    def __init__(self, ratio=0.2, minimum=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.lock = threading.Lock()
+        self.tokens = float(minimum)
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.minimum * 2)
+
+    def withdraw(self):
+        """
+        Take a retry from the budget, return False if it is spent
+        """
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def get_retry_policy():
+    """
+    Return the retry policy set in the configuration
+    """
+    return RetryPolicy(
+        attempts=config.getint('authorize_net', 'retry_attempts', default=3),
+        base_delay=config.getfloat(
+            'authorize_net', 'retry_base_delay', default=0.1
+        ),
+        max_delay=config.getfloat(
+            'authorize_net', 'retry_max_delay', default=2
+        ),
+        deadline=config.getfloat(
+            'authorize_net', 'retry_deadline', default=10
+        ),
+    )
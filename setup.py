@@ -38,6 +38,37 @@ class SQLiteTest(Command):
         sys.exit(-1)
 
 
+class Benchmark(Command):
+    """
+    Benchmark the authorize.net methods against the mock server on SQLite
+    """
+    description = "Benchmark against the mock authorize.net server"
+
+    user_options = [
+        ('count=', None, 'number of calls of every method'),
+        ('latency=', None, 'seconds waited by the server before answering'),
+        ('rows=', None, 'number of records among which the lookups are '
+            'measured, with and without index'),
+    ]
+
+    def initialize_options(self):
+        self.count = 100
+        self.latency = 0
+        self.rows = 0
+
+    def finalize_options(self):
+        self.count = int(self.count)
+        self.latency = float(self.latency)
+        self.rows = int(self.rows)
+
+    def run(self):
+        os.environ['TRYTOND_DATABASE_URI'] = 'sqlite://'
+        os.environ['DB_NAME'] = ':memory:'
+
+        from tests.benchmark import main
+        main(self.count, self.latency, self.rows)
+
+
 config = ConfigParser.ConfigParser()
 config.readfp(open('tryton.cfg'))
 info = dict(config.items('tryton'))
@@ -114,5 +145,6 @@ setup(
     test_loader='trytond.test_loader:Loader',
     cmdclass={
         'test': SQLiteTest,
+        'benchmark': Benchmark,
     },
 )
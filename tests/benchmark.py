@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+
+    Throughput and latency of the authorize.net methods, measured against
+    the mock server so that it can run without the sandbox::
+
+        python setup.py benchmark --count=200 --latency=0.05
+
+    :license: see LICENSE for details.
+"""
+import math
+import random
+import time
+
+from sql import Table
+from trytond import backend
+from trytond.tests.test_tryton import POOL, drop_create, install_module, \
+    with_transaction
+from trytond.transaction import Transaction
+
+from trytond.modules.payment_gateway_authorize_net.timing import \
+    MemorySink, set_sink
+from trytond.modules.payment_gateway_authorize_net.tests.mock_server import \
+    mock_authorize_net
+from trytond.modules.payment_gateway_authorize_net.tests.test_transaction \
+    import TestTransaction
+
+__all__ = ['percentile', 'measure', 'run', 'run_lookups']
+
+
+def percentile(durations, percent):
+    """
+    Return the percentile of the sorted durations (nearest rank)
+    """
+    index = int(math.ceil(len(durations) * percent / 100.0)) - 1
+    return durations[max(index, 0)]
+
+
+def measure(func, items):
+    """
+    Call `func` on every item one after the other and return the number of
+    calls per second with the median and 99th percentile of their durations
+    """
+    durations = []
+    start = time.time()
+    for item in items:
+        call_start = time.time()
+        func(item)
+        durations.append(time.time() - call_start)
+    total = time.time() - start
+    durations.sort()
+    return {
+        'count': len(durations),
+        'throughput': len(durations) / total if total else 0,
+        'p50': percentile(durations, 50),
+        'p99': percentile(durations, 99),
+    }
+
+
+def _create_transactions(fixture, count):
+    PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+    return PaymentTransaction.create([{
+        'party': fixture.party1.id,
+        'address': fixture.party1.addresses[0].id,
+        'payment_profile': fixture.payment_profile.id,
+        'gateway': fixture.auth_net_gateway.id,
+        'amount': random.randint(1, 100),
+        'credit_account': fixture.party1.account_receivable.id,
+    } for _ in xrange(count)])
+
+
+def _add_payment_profile(fixture, party):
+    ProfileWizard = POOL.get(
+        'party.party.payment_profile.add', type='wizard'
+    )
+
+    wizard = ProfileWizard(ProfileWizard.create()[0])
+    wizard.card_info.owner = party.name
+    wizard.card_info.number = fixture.card_data1.number
+    wizard.card_info.expiry_month = fixture.card_data1.expiry_month
+    wizard.card_info.expiry_year = fixture.card_data1.expiry_year
+    wizard.card_info.csc = fixture.card_data1.csc
+    wizard.card_info.gateway = fixture.auth_net_gateway
+    wizard.card_info.provider = fixture.auth_net_gateway.provider
+    wizard.card_info.address = party.addresses[0]
+    wizard.card_info.party = party
+    return wizard.transition_add_authorize_net()
+
+
+@with_transaction()
+def run(count=100):
+    """
+    Return the measures of `authorize_authorize_net`,
+    `capture_authorize_net` and `transition_add_authorize_net` made `count`
+    times each
+    """
+    Party = POOL.get('party.party')
+
+    # The fixtures of the tests give a company, accounts, a gateway and a
+    # party with a payment profile
+    fixture = TestTransaction('setup_defaults')
+    fixture.setUp()
+    fixture.setup_defaults()
+
+    results = []
+    with Transaction().set_context(company=fixture.company.id):
+        results.append(('authorize_authorize_net', measure(
+            lambda t: t.authorize_authorize_net(),
+            _create_transactions(fixture, count)
+        )))
+        results.append(('capture_authorize_net', measure(
+            lambda t: t.capture_authorize_net(),
+            _create_transactions(fixture, count)
+        )))
+
+        parties = Party.create([{
+            'name': 'Benchmark party %d' % i,
+            'addresses': [('create', [{
+                'name': 'Benchmark party %d' % i,
+                'street': 'Benchmark Street',
+                'city': 'Benchmark City',
+            }])],
+        } for i in xrange(count)])
+        results.append(('transition_add_authorize_net', measure(
+            lambda p: _add_payment_profile(fixture, p), parties
+        )))
+    return results
+
+
+def _copy_rows(model, record, rows, **columns):
+    """
+    Insert `rows` copies of the row of the record, with the columns set to
+    the value given by their function for the number of the copy
+    """
+    table = Table(model._table)
+    cursor = Transaction().connection.cursor()
+    cursor.execute(*table.select(where=table.id == record.id))
+    names = [d[0] for d in cursor.description]
+    row = dict(zip(names, cursor.fetchone()))
+    names = [n for n in names if n != 'id']
+    for start in xrange(0, rows, 1000):
+        values = []
+        for i in xrange(start, min(start + 1000, rows)):
+            row.update((n, f(i)) for n, f in columns.iteritems())
+            values.append([row[n] for n in names])
+        cursor.execute(*table.insert(
+            [getattr(table, n) for n in names], values
+        ))
+
+
+def _measure_index(model, columns, func, items):
+    """
+    Return the measures of `func` called on the items with and without the
+    index of the model on the columns
+    """
+    TableHandler = backend.get('TableHandler')
+
+    table = TableHandler(model)
+    index_name = '%s_%s_index' % (model._table, '_'.join(columns))
+    assert index_name in table._indexes
+    indexed = measure(func, items)
+    cursor = Transaction().connection.cursor()
+    cursor.execute('DROP INDEX "%s"' % index_name)
+    try:
+        scan = measure(func, items)
+    finally:
+        cursor.execute('CREATE INDEX "%s" ON "%s" (%s)' % (
+            index_name, model._table, ','.join('"%s"' % c for c in columns)
+        ))
+    return indexed, scan
+
+
+@with_transaction()
+def run_lookups(rows=100000, count=200):
+    """
+    Return the measures of `count` lookups among `rows` records, with and
+    without their index: transactions by reference, payment profiles by
+    authorize.net profile and the customer profile of a party.
+    """
+    PaymentTransaction = POOL.get('payment_gateway.transaction')
+    PaymentProfile = POOL.get('party.payment_profile')
+
+    fixture = TestTransaction('setup_defaults')
+    fixture.setUp()
+    fixture.setup_defaults()
+    party = fixture.party1
+
+    with Transaction().set_context(company=fixture.company.id):
+        transaction, = _create_transactions(fixture, 1)
+    _copy_rows(
+        PaymentTransaction, transaction, rows, provider_reference=str
+    )
+    # The profiles of the party on many gateways, SQLite does not check the
+    # foreign keys
+    _copy_rows(
+        PaymentProfile, fixture.payment_profile, rows,
+        authorize_profile_id=lambda i: 'P%d' % i,
+        gateway=lambda i: 1000 + i,
+    )
+
+    results = []
+    references = [str(random.randrange(rows)) for _ in xrange(count)]
+    results.append(('provider_reference',) + _measure_index(
+        PaymentTransaction, ['provider_reference'],
+        lambda r: PaymentTransaction.search([
+            ('provider_reference', '=', r),
+        ]), references
+    ))
+    profile_ids = ['P%d' % random.randrange(rows) for _ in xrange(count)]
+    results.append(('authorize_profile_id',) + _measure_index(
+        PaymentProfile, ['authorize_profile_id'],
+        lambda p: PaymentProfile.search([
+            ('authorize_profile_id', '=', p),
+        ]), profile_ids
+    ))
+    # The search of Party._get_authorize_net_customer_id
+    gateway_ids = [1000 + random.randrange(rows) for _ in xrange(count)]
+    results.append(('party, gateway, authorize_profile_id',) + _measure_index(
+        PaymentProfile, ['party', 'gateway', 'authorize_profile_id'],
+        lambda g: PaymentProfile.search_read([
+            ('party', '=', party.id),
+            ('authorize_profile_id', '!=', None),
+            ('gateway', '=', g),
+        ], limit=1, fields_names=['authorize_profile_id']), gateway_ids
+    ))
+    return results
+
+
+def main(count=100, latency=0, rows=0):
+    drop_create()
+    install_module('payment_gateway_authorize_net')
+    sink = MemorySink()
+    set_sink(sink)
+    try:
+        with mock_authorize_net(latency=latency):
+            results = run(count)
+            lookups = run_lookups(rows, count) if rows else []
+    finally:
+        set_sink(None)
+
+    print '%-30s %8s %10s %10s %10s' % (
+        'method', 'calls', 'calls/s', 'p50 (ms)', 'p99 (ms)'
+    )
+    for name, result in results:
+        print '%-30s %8d %10.1f %10.2f %10.2f' % (
+            name, result['count'], result['throughput'],
+            result['p50'] * 1000, result['p99'] * 1000,
+        )
+
+    if lookups:
+        print
+        print '%-40s %8s %14s %14s' % (
+            'lookup', 'calls', 'index p50 (ms)', 'scan p50 (ms)'
+        )
+        for name, indexed, scan in lookups:
+            print '%-40s %8d %14.3f %14.3f' % (
+                name, indexed['count'], indexed['p50'] * 1000,
+                scan['p50'] * 1000,
+            )
+
+    print
+    print '%-45s %8s %10s %10s %10s' % (
+        'phase', 'count', 'total (s)', 'p50 (ms)', 'p99 (ms)'
+    )
+    for name, timing in sorted(sink.summary().iteritems()):
+        print '%-45s %8d %10.2f %10.2f %10.2f' % (
+            name, timing['count'], timing['total'],
+            timing['p50'] * 1000, timing['p99'] * 1000,
+        )
+
+
+if __name__ == '__main__':
+    main()
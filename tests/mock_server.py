@@ -0,0 +1,961 @@
+# -*- coding: utf-8 -*-
+"""
+    mock_server
+
+    An in-process server answering the authorize.net XML API, to run tests
+    and benchmarks without the sandbox.
+
+    .. code-block:: python
+
+        with mock_authorize_net(latency=0.05) as server:
+            # The gateways in test mode now talk to the mock server
+            server.inject('createTransactionRequest', 'declined')
+            ...
+
+    :license: see LICENSE for details.
+"""
+import itertools
+import socket
+import threading
+import time
+import xml.etree.cElementTree as E
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from trytond.config import config
+
+__all__ = ['AuthorizeNetMockServer', 'mock_authorize_net']
+
+NAMESPACE = 'AnetApi/xml/v1/schema/AnetApiSchema.xsd'
+
+ERROR_TEXTS = {
+    'E00001': 'An error occurred during processing. Please try again.',
+    'E00003': 'The request is not supported.',
+    'E00027': 'The transaction was unsuccessful.',
+    'E00039': 'A duplicate record already exists.',
+    'E00040': 'The record cannot be found.',
+    'E00042': 'You cannot add more than 10 payment profiles.',
+    'E00043': 'You cannot add more than 100 shipping addresses.',
+}
+
+# Outcomes of a transaction which are not errors of the request
+DECLINED = 'declined'
+HELD_FOR_REVIEW = 'held-for-review'
+
+# Outcomes of the HTTP exchange: a 503 answer without processing the
+# request, or a request processed whose answer is lost
+UNAVAILABLE = 'unavailable'
+LOST = 'lost'
+
+# Status given by getTransactionDetailsRequest for the mock states
+TRANSACTION_STATUS = {
+    'authorized': 'authorizedPendingCapture',
+    'captured': 'capturedPendingSettlement',
+    'settled': 'settledSuccessfully',
+    'voided': 'voided',
+    'refunded': 'refundPendingSettlement',
+    'refund-settled': 'refundSettledSuccessfully',
+    'declined': 'declined',
+    'held': 'FDSPendingReview',
+    'review-failed': 'failedReview',
+}
+
+# States of the transactions which wait for the settlement of the batch
+UNSETTLED_STATES = ('authorized', 'captured', 'refunded', 'held')
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+MAX_PAYMENT_PROFILES = 10
+
+
+def _tag(name):
+    return '{%s}%s' % (NAMESPACE, name)
+
+
+def _build(parent, children):
+    """
+    Add the children, a list of `(tag, value)`, to the parent element. A
+    value can be a text or a list of children.
+    """
+    for tag, value in children:
+        element = E.SubElement(parent, tag)
+        if isinstance(value, list):
+            _build(element, value)
+        elif value is not None:
+            element.text = unicode(value)
+    return parent
+
+
+def _fields(element):
+    """
+    Return the text children of the element as a list of `(tag, text)`
+    """
+    if element is None:
+        return []
+    return [
+        (child.tag.split('}')[-1], child.text)
+        for child in element if len(child) == 0
+    ]
+
+
+def _mask(card_number):
+    return 'XXXX' + (card_number or '')[-4:]
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = {}
+        self.closing = False
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(
+            target=self.process_request_thread,
+            args=(request, client_address)
+        )
+        thread.daemon = True
+        self.connections[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        self.connections.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def handle_error(self, request, client_address):
+        if not self.closing:
+            HTTPServer.handle_error(self, request, client_address)
+
+    def close_connections(self):
+        """
+        Close the kept alive connections and wait for their threads
+        """
+        self.closing = True
+        for request, thread in self.connections.items():
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and the body together, small writes wait for the
+    # delayed acknowledgement of the client
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, response = self.server.mock.dispatch(body)
+        if response is None:
+            # The answer is lost with the connection
+            self.close_connection = True
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AuthorizeNetMockServer(object):
+    """
+    Mock of the authorize.net XML API listening on a local port.
+
+    Every request is recorded in `requests` as `(login, request name)` and
+    the transactions and customer profiles it creates are kept per login, so
+    that tests can check which merchant account a call was made with.
+
+    :param latency: Seconds waited before answering every request.
+    :param max_addresses: Number of shipping addresses a customer profile
+        can have before E00043 is returned.
+    """
+
+    def __init__(
+            self, host='127.0.0.1', port=0, latency=0, max_addresses=100):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(40000000)
+        self.latency = latency
+        self.max_addresses = max_addresses
+        self.requests = []
+        self.injections = {}
+        self.transactions = {}
+        self.customers = {}
+        self.batches = {}
+        # Submission time of the transactions
+        self.submitted = {}
+        # Transactions by their duplicate key, see `duplicate_key`
+        self.recent = {}
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%d/xml/v1/request.api' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def next_id(self):
+        with self.lock:
+            return str(next(self.ids))
+
+    def inject(self, name, outcome, times=1):
+        """
+        Give the outcome to the next `times` requests with the given name.
+
+        The outcome is either an error code like `E00039` or `E00043`, which
+        fails the request, `declined` or `held-for-review` for the
+        transaction and validation requests, `unavailable` to answer with a
+        503 error or `lost` to process the request and close the connection
+        without answer.
+        """
+        with self.lock:
+            self.injections.setdefault(name, []).extend([outcome] * times)
+
+    def settle_batch(self, settled_at=None):
+        """
+        Settle the captured transactions, as authorize.net does every night.
+        The transactions which do not wait for a capture or a review are put
+        in a batch of their merchant account settled at `settled_at`, a UTC
+        datetime which defaults to now.
+        """
+        settled_at = settled_at or datetime.utcnow()
+        batch_ids = {}
+        with self.lock:
+            for transaction in self.transactions.itervalues():
+                if transaction.get('batch_id') or \
+                        transaction['state'] in ('authorized', 'held'):
+                    continue
+                if transaction['login'] not in batch_ids:
+                    batch_id = batch_ids[transaction['login']] = \
+                        str(next(self.ids))
+                    self.batches[batch_id] = {
+                        'login': transaction['login'],
+                        'settled_at': settled_at,
+                    }
+                transaction['batch_id'] = batch_ids[transaction['login']]
+                transaction['state'] = {
+                    'captured': 'settled',
+                    'refunded': 'refund-settled',
+                }.get(transaction['state'], transaction['state'])
+
+    def review(self, trans_id, approve=True):
+        """
+        Approve or decline a transaction held for review
+        """
+        with self.lock:
+            transaction = self.transactions[trans_id]
+            assert transaction['state'] == 'held'
+            if not approve:
+                transaction['state'] = 'review-failed'
+            elif transaction['type'] == 'authOnlyTransaction':
+                transaction['state'] = 'authorized'
+            else:
+                transaction['state'] = 'captured'
+
+    def dispatch(self, body):
+        """
+        Return the HTTP status and the XML answer to the XML request, None
+        if the answer is lost
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        request = E.fromstring(body)
+        name = request.tag.split('}')[-1]
+        login = request.findtext(
+            '%s/%s' % (_tag('merchantAuthentication'), _tag('name'))
+        )
+        with self.lock:
+            self.requests.append((login, name))
+            injected = self.injections.get(name)
+            outcome = injected.pop(0) if injected else None
+
+        if outcome == UNAVAILABLE:
+            return 503, ''
+        if outcome and outcome.startswith('E'):
+            return 200, self.error(name, outcome)
+        handler = getattr(self, 'on_%s' % name, None)
+        if handler is None:
+            return 200, self.error(name, 'E00003')
+        if outcome == LOST:
+            handler(login, request, None)
+            return 200, None
+        return 200, handler(login, request, outcome)
+
+    def response(
+            self, name, children=None, code='I00001', text='Successful.'):
+        """
+        Return a response to the request with the given name
+        """
+        response = E.Element(name.replace('Request', 'Response'))
+        response.set('xmlns', NAMESPACE)
+        _build(response, [
+            ('messages', [
+                ('resultCode', 'Ok' if code.startswith('I') else 'Error'),
+                ('message', [('code', code), ('text', text)]),
+            ]),
+        ] + (children or []))
+        return E.tostring(response)
+
+    def error(self, name, code, text=None, children=None):
+        if text is None:
+            text = ERROR_TEXTS.get(code, 'Injected error.')
+        return self.response(name, children, code=code, text=text)
+
+    def transaction_response(
+            self, name, trans_id, response_code='1', errors=None,
+            ref_trans_id=None):
+        """
+        Return the response to a createTransactionRequest
+        """
+        transaction_response = [
+            ('responseCode', response_code),
+            ('authCode', 'MOCK01' if response_code == '1' else ''),
+            ('avsResultCode', 'Y'),
+            ('cvvResultCode', 'P'),
+            ('transId', trans_id),
+            ('refTransID', ref_trans_id or ''),
+            ('testRequest', '0'),
+            ('accountNumber', 'XXXX1111'),
+            ('accountType', 'Visa'),
+        ]
+        if errors:
+            transaction_response.append(('errors', [
+                ('error', [('errorCode', c), ('errorText', t)])
+                for c, t in errors
+            ]))
+            return self.error(name, 'E00027', children=[
+                ('transactionResponse', transaction_response)
+            ])
+
+        if response_code == '4':
+            message = (
+                '252',
+                'Your order has been received. Thank you for your business!'
+            )
+        else:
+            message = ('1', 'This transaction has been approved.')
+        transaction_response.append(('messages', [
+            ('message', [
+                ('code', message[0]),
+                ('description', message[1]),
+            ]),
+        ]))
+        return self.response(name, [
+            ('transactionResponse', transaction_response)
+        ])
+
+    def direct_response(self, response_code, trans_id, amount=''):
+        """
+        Return the comma separated direct response of a validation
+        """
+        values = [''] * 40
+        values[0] = response_code
+        values[1] = '1'
+        values[2] = response_code
+        values[3] = {
+            '1': 'This transaction has been approved.',
+            '2': 'This transaction has been declined.',
+        }[response_code]
+        values[4] = 'MOCK01' if response_code == '1' else ''
+        values[5] = 'Y'
+        values[6] = trans_id
+        values[9] = amount
+        values[11] = 'auth_only'
+        values[38] = 'P'
+        return ','.join(values)
+
+    def get_customer(self, login, customer_id):
+        with self.lock:
+            customer = self.customers.get(customer_id)
+        if customer is None or customer['login'] != login:
+            return None
+        return customer
+
+    def has_payment(self, login, customer_id, payment_id):
+        customer = self.get_customer(login, customer_id)
+        return customer is not None and payment_id in customer['payments']
+
+    def on_createTransactionRequest(self, login, request, outcome):
+        name = 'createTransactionRequest'
+        xact = request.find(_tag('transactionRequest'))
+        xact_type = xact.findtext(_tag('transactionType'))
+        ref_trans_id = xact.findtext(_tag('refTransId'))
+        try:
+            amount = Decimal(xact.findtext(_tag('amount')) or '0')
+        except InvalidOperation:
+            amount = Decimal('0')
+
+        profile = xact.find(_tag('profile'))
+        if profile is not None and not self.has_payment(
+                login, profile.findtext(_tag('customerProfileId')),
+                profile.findtext('%s/%s' % (
+                    _tag('paymentProfile'), _tag('paymentProfileId')
+                ))):
+            return self.error(name, 'E00040')
+
+        original = None
+        if xact_type in (
+                'priorAuthCaptureTransaction', 'voidTransaction',
+                'refundTransaction'):
+            with self.lock:
+                original = self.transactions.get(ref_trans_id)
+            if original is None or original['login'] != login:
+                return self.transaction_response(
+                    name, '0', '3', [('16', 'The transaction cannot be found.')]
+                )
+            if not amount and xact_type != 'refundTransaction':
+                amount = original['amount']
+
+        if xact_type != 'voidTransaction' and amount <= 0:
+            return self.transaction_response(
+                name, '0', '3', [('5', 'A valid amount is required.')]
+            )
+        key = self.duplicate_key(login, xact)
+        error = self.check_reference(xact_type, original, amount) or \
+            self.check_duplicate(key, xact)
+        if error:
+            return self.transaction_response(name, '0', '3', [error])
+
+        response_code = {
+            DECLINED: '2',
+            HELD_FOR_REVIEW: '4',
+        }.get(outcome, '1')
+        trans_id = self.next_id()
+        state = {
+            '2': 'declined',
+            '4': 'held',
+        }.get(response_code) or {
+            'authOnlyTransaction': 'authorized',
+            'voidTransaction': 'voided',
+            'refundTransaction': 'refunded',
+        }.get(xact_type, 'captured')
+        with self.lock:
+            self.recent[key] = (time.time(), trans_id)
+            self.transactions[trans_id] = {
+                'login': login,
+                'type': xact_type,
+                'amount': amount,
+                'state': state,
+                'ref_trans_id': ref_trans_id,
+                'response_code': response_code,
+                'invoice_number': xact.findtext(
+                    '%s/%s' % (_tag('order'), _tag('invoiceNumber'))
+                ),
+            }
+            self.submitted[trans_id] = datetime.utcnow()
+            if original is not None and response_code == '1':
+                original['state'] = {
+                    'priorAuthCaptureTransaction': 'captured',
+                    'voidTransaction': 'voided',
+                }.get(xact_type, original['state'])
+                if xact_type == 'refundTransaction':
+                    original['refunded'] = \
+                        original.get('refunded', Decimal('0')) + amount
+
+        if response_code == '2':
+            return self.transaction_response(
+                name, trans_id, '2',
+                [('2', 'This transaction has been declined.')],
+                ref_trans_id=ref_trans_id
+            )
+        return self.transaction_response(
+            name, trans_id, response_code, ref_trans_id=ref_trans_id
+        )
+
+    @staticmethod
+    def duplicate_key(login, xact):
+        """
+        Return what authorize.net compares to find duplicate transactions:
+        the type, the amount, the card or profile and the referenced
+        transaction
+        """
+        return (login,) + tuple(
+            E.tostring(element) for element in (
+                xact.find(_tag(name)) for name in (
+                    'transactionType', 'amount', 'payment', 'profile',
+                    'refTransId', 'order',
+                )
+            ) if element is not None
+        )
+
+    def check_duplicate(self, key, xact):
+        """
+        Return the error if a transaction with the same key was sent within
+        the duplicate window set in the transaction
+        """
+        window = 0
+        for setting in xact.findall(
+                '%s/%s' % (_tag('transactionSettings'), _tag('setting'))):
+            if setting.findtext(_tag('settingName')) == 'duplicateWindow':
+                window = int(setting.findtext(_tag('settingValue')) or 0)
+        with self.lock:
+            last = self.recent.get(key)
+        if window and last and time.time() - last[0] < window:
+            return ('11', 'A duplicate transaction has been submitted.')
+        return None
+
+    def check_reference(self, xact_type, original, amount):
+        """
+        Return the error `(code, text)` if the transaction referenced by the
+        request can not be captured, voided or refunded.
+        """
+        if xact_type == 'priorAuthCaptureTransaction' and (
+                original['type'] != 'authOnlyTransaction' or
+                original['state'] != 'authorized' or
+                amount > original['amount']):
+            return (
+                '47', 'The amount requested for settlement cannot be '
+                'greater than the original amount authorized.'
+            )
+        if xact_type == 'voidTransaction':
+            if original['state'] == 'voided':
+                return ('310', 'This transaction has already been voided.')
+            if original['state'] not in ('authorized', 'captured', 'held'):
+                return ('16', 'The transaction cannot be found.')
+        if xact_type == 'refundTransaction':
+            if original['state'] != 'settled':
+                return (
+                    '54', 'The referenced transaction does not meet the '
+                    'criteria for issuing a credit.'
+                )
+            if amount + original.get('refunded', 0) > original['amount']:
+                return (
+                    '55', 'The sum of credits against the referenced '
+                    'transaction would exceed original debit amount.'
+                )
+        return None
+
+    def on_getTransactionDetailsRequest(self, login, request, outcome):
+        name = 'getTransactionDetailsRequest'
+        trans_id = request.findtext(_tag('transId'))
+        with self.lock:
+            transaction = dict(self.transactions.get(trans_id) or {})
+        if not transaction or transaction['login'] != login:
+            return self.error(name, 'E00040')
+        return self.response(name, [
+            ('transaction', [
+                ('transId', trans_id),
+                ('refTransId', transaction['ref_trans_id']),
+                ('transactionType', transaction['type']),
+                ('transactionStatus', TRANSACTION_STATUS[transaction['state']]),
+                ('responseCode', transaction['response_code']),
+                ('authAmount', transaction['amount']),
+                ('settleAmount', transaction['amount']),
+            ]),
+        ])
+
+    def list_response(self, name, request, transactions):
+        """
+        Return the page of the transactions, a list of `(trans_id,
+        transaction)` in submission order, asked by the paging of the
+        request
+        """
+        limit = int(request.findtext(
+            '%s/%s' % (_tag('paging'), _tag('limit'))
+        ) or 1000)
+        offset = int(request.findtext(
+            '%s/%s' % (_tag('paging'), _tag('offset'))
+        ) or 1)
+        page = transactions[(offset - 1) * limit:offset * limit]
+        return self.response(name, [
+            ('transactions', [
+                ('transaction', [(tag, value) for tag, value in [
+                    ('transId', trans_id),
+                    ('submitTimeUTC', self.submitted[trans_id].strftime(
+                        DATETIME_FORMAT
+                    )),
+                    ('transactionStatus',
+                        TRANSACTION_STATUS[transaction['state']]),
+                    ('invoiceNumber', transaction['invoice_number']),
+                    ('accountType', 'Visa'),
+                    ('accountNumber', 'XXXX1111'),
+                    ('settleAmount', transaction['amount']),
+                ] if value is not None]) for trans_id, transaction in page
+            ]),
+            ('totalNumInResultSet', len(transactions)),
+        ])
+
+    def get_transactions(self, login, batch_id):
+        with self.lock:
+            return sorted(
+                (trans_id, dict(transaction))
+                for trans_id, transaction in self.transactions.iteritems()
+                if transaction['login'] == login and
+                transaction.get('batch_id') == batch_id
+            )
+
+    def on_getUnsettledTransactionListRequest(self, login, request, outcome):
+        return self.list_response(
+            'getUnsettledTransactionListRequest', request,
+            self.get_transactions(login, None)
+        )
+
+    def on_getTransactionListRequest(self, login, request, outcome):
+        name = 'getTransactionListRequest'
+        batch_id = request.findtext(_tag('batchId'))
+        with self.lock:
+            batch = self.batches.get(batch_id)
+        if batch is None or batch['login'] != login:
+            return self.error(name, 'E00040')
+        return self.list_response(
+            name, request, self.get_transactions(login, batch_id)
+        )
+
+    def on_getSettledBatchListRequest(self, login, request, outcome):
+        first = datetime.strptime(
+            request.findtext(_tag('firstSettlementDate')), DATETIME_FORMAT
+        )
+        last = datetime.strptime(
+            request.findtext(_tag('lastSettlementDate')), DATETIME_FORMAT
+        )
+        with self.lock:
+            batches = sorted(
+                (batch_id, batch)
+                for batch_id, batch in self.batches.iteritems()
+                if batch['login'] == login and
+                first <= batch['settled_at'] <= last
+            )
+        return self.response('getSettledBatchListRequest', [
+            ('batchList', [
+                ('batch', [
+                    ('batchId', batch_id),
+                    ('settlementTimeUTC', batch['settled_at'].strftime(
+                        DATETIME_FORMAT
+                    )),
+                    ('settlementState', 'settledSuccessfully'),
+                    ('paymentMethod', 'creditCard'),
+                ]) for batch_id, batch in batches
+            ]),
+        ])
+
+    def add_payment(self, customer, payment_profile):
+        """
+        Store the payment profile element on the customer and return its id,
+        or the error code if it can not be added.
+        """
+        card = payment_profile.find(
+            '%s/%s' % (_tag('payment'), _tag('creditCard'))
+        )
+        if card is not None:
+            card_number = card.findtext(_tag('cardNumber'))
+            expiration_date = card.findtext(_tag('expirationDate'))
+        else:
+            # Accept.js nonce, there is no card number to compare
+            card_number = payment_profile.findtext('%s/%s/%s' % (
+                _tag('payment'), _tag('opaqueData'), _tag('dataValue')
+            ))
+            expiration_date = 'XXXX'
+        payment = {
+            'card_number': card_number,
+            'expiration_date': expiration_date,
+            'bill_to': _fields(payment_profile.find(_tag('billTo'))),
+        }
+        with self.lock:
+            payments = customer['payments']
+            for payment_id, other in payments.iteritems():
+                if other['card_number'] == card_number and \
+                        other['bill_to'] == payment['bill_to']:
+                    return 'E00039', payment_id
+            if len(payments) >= MAX_PAYMENT_PROFILES:
+                return 'E00042', None
+            payment_id = str(next(self.ids))
+            payments[payment_id] = payment
+        return None, payment_id
+
+    def add_address(self, customer, address):
+        """
+        Store the address element on the customer and return its id, or the
+        error code if it can not be added.
+        """
+        address = _fields(address)
+        with self.lock:
+            addresses = customer['addresses']
+            for address_id, other in addresses.iteritems():
+                if other == address:
+                    return 'E00039', address_id
+            if len(addresses) >= self.max_addresses:
+                return 'E00043', None
+            address_id = str(next(self.ids))
+            addresses[address_id] = address
+        return None, address_id
+
+    def on_createCustomerProfileRequest(self, login, request, outcome):
+        name = 'createCustomerProfileRequest'
+        profile = request.find(_tag('profile'))
+        key = (
+            profile.findtext(_tag('merchantCustomerId')),
+            profile.findtext(_tag('description')),
+            profile.findtext(_tag('email')),
+        )
+        customer_id = self.next_id()
+        with self.lock:
+            for other_id, other in self.customers.iteritems():
+                if other['login'] == login and other['key'] == key:
+                    return self.error(
+                        name, 'E00039',
+                        'A duplicate record with ID %s already exists.'
+                        % other_id
+                    )
+            customer = self.customers[customer_id] = {
+                'login': login,
+                'key': key,
+                'payments': {},
+                'addresses': {},
+            }
+        payment_ids = [
+            self.add_payment(customer, p)[1]
+            for p in profile.findall(_tag('paymentProfiles'))
+        ]
+        address_ids = [
+            self.add_address(customer, a)[1]
+            for a in profile.findall(_tag('shipToList'))
+        ]
+        return self.response(name, [
+            ('customerProfileId', customer_id),
+            ('customerPaymentProfileIdList', [
+                ('numericString', i) for i in payment_ids
+            ]),
+            ('customerShippingAddressIdList', [
+                ('numericString', i) for i in address_ids
+            ]),
+            ('validationDirectResponseList', []),
+        ])
+
+    def on_getCustomerProfileRequest(self, login, request, outcome):
+        name = 'getCustomerProfileRequest'
+        customer_id = request.findtext(_tag('customerProfileId'))
+        customer = self.get_customer(login, customer_id)
+        if customer is None:
+            return self.error(name, 'E00040')
+        merchant_id, description, email = customer['key']
+        with self.lock:
+            payments = sorted(customer['payments'].items())
+            addresses = sorted(customer['addresses'].items())
+        return self.response(name, [
+            ('profile', [
+                ('merchantCustomerId', merchant_id),
+                ('description', description),
+                ('email', email),
+                ('customerProfileId', customer_id),
+            ] + [
+                ('paymentProfiles', self.payment_profile(payment_id, payment))
+                for payment_id, payment in payments
+            ] + [
+                ('shipToList', address + [('customerAddressId', address_id)])
+                for address_id, address in addresses
+            ]),
+        ])
+
+    def on_deleteCustomerProfileRequest(self, login, request, outcome):
+        name = 'deleteCustomerProfileRequest'
+        customer_id = request.findtext(_tag('customerProfileId'))
+        if self.get_customer(login, customer_id) is None:
+            return self.error(name, 'E00040')
+        with self.lock:
+            del self.customers[customer_id]
+        return self.response(name)
+
+    def on_getCustomerProfileIdsRequest(self, login, request, outcome):
+        with self.lock:
+            customer_ids = sorted(
+                i for i, c in self.customers.iteritems()
+                if c['login'] == login
+            )
+        return self.response('getCustomerProfileIdsRequest', [
+            ('ids', [('numericString', i) for i in customer_ids]),
+        ])
+
+    def payment_profile(self, payment_id, payment):
+        return [
+            ('customerPaymentProfileId', payment_id),
+            ('billTo', payment['bill_to']),
+            ('payment', [
+                ('creditCard', [
+                    ('cardNumber', _mask(payment['card_number'])),
+                    ('expirationDate', 'XXXX'),
+                ]),
+            ]),
+        ]
+
+    def on_createCustomerPaymentProfileRequest(self, login, request, outcome):
+        name = 'createCustomerPaymentProfileRequest'
+        customer_id = request.findtext(_tag('customerProfileId'))
+        customer = self.get_customer(login, customer_id)
+        if customer is None:
+            return self.error(name, 'E00040')
+        validation = request.findtext(_tag('validationMode'))
+        if validation and outcome == DECLINED:
+            # The card is not stored when its validation fails
+            return self.error(
+                name, 'E00027', 'This transaction has been declined.', [
+                    ('validationDirectResponse', self.direct_response(
+                        '2', self.next_id(), '0.00'
+                    )),
+                ]
+            )
+        code, payment_id = self.add_payment(
+            customer, request.find(_tag('paymentProfile'))
+        )
+        children = [
+            ('customerProfileId', customer_id),
+            ('customerPaymentProfileId', payment_id),
+        ]
+        if validation and not code:
+            children.append(('validationDirectResponse', self.direct_response(
+                '1', self.next_id(), '0.00'
+            )))
+        if code == 'E00039':
+            return self.error(
+                name, code,
+                'A duplicate customer payment profile already exists.',
+                children
+            )
+        if code:
+            return self.error(name, code)
+        return self.response(name, children)
+
+    def on_getCustomerPaymentProfileRequest(self, login, request, outcome):
+        name = 'getCustomerPaymentProfileRequest'
+        customer = self.get_customer(
+            login, request.findtext(_tag('customerProfileId'))
+        )
+        payment_id = request.findtext(_tag('customerPaymentProfileId'))
+        if customer is None or payment_id not in customer['payments']:
+            return self.error(name, 'E00040')
+        return self.response(name, [
+            ('paymentProfile', self.payment_profile(
+                payment_id, customer['payments'][payment_id]
+            )),
+        ])
+
+    def on_validateCustomerPaymentProfileRequest(
+            self, login, request, outcome):
+        name = 'validateCustomerPaymentProfileRequest'
+        customer = self.get_customer(
+            login, request.findtext(_tag('customerProfileId'))
+        )
+        payment_id = request.findtext(_tag('customerPaymentProfileId'))
+        if customer is None or payment_id not in customer['payments']:
+            return self.error(name, 'E00040')
+        if outcome == DECLINED:
+            return self.error(
+                name, 'E00027', 'This transaction has been declined.', [
+                    ('directResponse', self.direct_response(
+                        '2', self.next_id(), '0.00'
+                    )),
+                ]
+            )
+        return self.response(name, [
+            ('directResponse', self.direct_response(
+                '1', self.next_id(), '0.00'
+            )),
+        ])
+
+    def on_deleteCustomerPaymentProfileRequest(
+            self, login, request, outcome):
+        name = 'deleteCustomerPaymentProfileRequest'
+        customer = self.get_customer(
+            login, request.findtext(_tag('customerProfileId'))
+        )
+        payment_id = request.findtext(_tag('customerPaymentProfileId'))
+        with self.lock:
+            if customer is None or \
+                    customer['payments'].pop(payment_id, None) is None:
+                return self.error(name, 'E00040')
+        return self.response(name)
+
+    def on_createCustomerShippingAddressRequest(
+            self, login, request, outcome):
+        name = 'createCustomerShippingAddressRequest'
+        customer_id = request.findtext(_tag('customerProfileId'))
+        customer = self.get_customer(login, customer_id)
+        if customer is None:
+            return self.error(name, 'E00040')
+        code, address_id = self.add_address(
+            customer, request.find(_tag('address'))
+        )
+        children = [
+            ('customerProfileId', customer_id),
+            ('customerAddressId', address_id),
+        ]
+        if code == 'E00039':
+            return self.error(
+                name, code,
+                'A duplicate customer shipping address already exists.',
+                children
+            )
+        if code:
+            return self.error(name, code)
+        return self.response(name, children)
+
+    def on_getCustomerShippingAddressRequest(self, login, request, outcome):
+        name = 'getCustomerShippingAddressRequest'
+        customer = self.get_customer(
+            login, request.findtext(_tag('customerProfileId'))
+        )
+        address_id = request.findtext(_tag('customerAddressId'))
+        if customer is None or address_id not in customer['addresses']:
+            return self.error(name, 'E00040')
+        return self.response(name, [
+            ('address', customer['addresses'][address_id] + [
+                ('customerAddressId', address_id)
+            ]),
+        ])
+
+    def on_deleteCustomerShippingAddressRequest(
+            self, login, request, outcome):
+        name = 'deleteCustomerShippingAddressRequest'
+        customer = self.get_customer(
+            login, request.findtext(_tag('customerProfileId'))
+        )
+        address_id = request.findtext(_tag('customerAddressId'))
+        with self.lock:
+            if customer is None or \
+                    customer['addresses'].pop(address_id, None) is None:
+                return self.error(name, 'E00040')
+        return self.response(name)
+
+
+@contextmanager
+def mock_authorize_net(**kwargs):
+    """
+    Start a mock server and use it as the test environment of the gateways
+    """
+    if not config.has_section('authorize_net'):
+        config.add_section('authorize_net')
+    with AuthorizeNetMockServer(**kwargs) as server:
+        config.set('authorize_net', 'test_url', server.url)
+        try:
+            yield server
+        finally:
+            config.remove_option('authorize_net', 'test_url')
@@ -1,20 +1,52 @@
 # -*- coding: utf-8 -*-
 import unittest
 import datetime
+import hashlib
+import hmac
+import json
 import random
+import os
+import shutil
+import socket
+import tempfile
+import time
 import authorize
+import yaml
+from StringIO import StringIO
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from datetime import date
 
 from trytond.tests.test_tryton import (
-    USER, CONTEXT, POOL,
+    USER, CONTEXT, POOL, DB_NAME,
     ModuleTestCase, with_transaction
 )
 import trytond.tests.test_tryton
+from trytond import backend
+from trytond.config import config
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 
+from trytond.modules.payment_gateway_authorize_net.importer import \
+    import_cards
+from trytond.modules.payment_gateway_authorize_net.party import \
+    get_address_digest, get_address_payloads
+from trytond.modules.payment_gateway_authorize_net.breaker import \
+    CircuitBreaker, CircuitOpenError
+from trytond.modules.payment_gateway_authorize_net.ratelimit import \
+    TokenBucket, get_token_bucket
+from trytond.modules.payment_gateway_authorize_net.retry import \
+    RetryPolicy
+from trytond.modules.payment_gateway_authorize_net.transaction import \
+    _LogBuffer
+from trytond.modules.payment_gateway_authorize_net.utils import \
+    map_concurrently
+from trytond.modules.payment_gateway_authorize_net.timing import \
+    MemorySink, StatsdSink, set_sink, timer
+from trytond.modules.payment_gateway_authorize_net import webhook
+from trytond.modules.payment_gateway_authorize_net.tests.mock_server import \
+    mock_authorize_net
+
 
 class TestTransaction(ModuleTestCase):
     """
@@ -173,7 +205,7 @@ class TestTransaction(ModuleTestCase):
             test=True
         )
         self.auth_net_gateway.save()
-        self.auth_net_gateway.get_authorize_client()
+        self.client = self.auth_net_gateway.get_authorize_client()
 
         # Create parties
         self.party1, = self.Party.create([{
@@ -230,8 +262,8 @@ class TestTransaction(ModuleTestCase):
         )
 
         # Get authorize_profile_id
-        customer = authorize.Customer.create()
-        credit_card = authorize.CreditCard.create(customer.customer_id, {
+        customer = self.client.customer.create()
+        credit_card = self.client.credit_card.create(customer.customer_id, {
             'credit_card': {
                 'card_number': '4111111111111111',
                 'card_code': '523',
@@ -532,8 +564,8 @@ class TestTransaction(ModuleTestCase):
         self.setup_defaults()
         expiry_year = str(date.today().year + 1)
 
-        customer = authorize.Customer.create()
-        authorize.CreditCard.create(customer.customer_id, {
+        customer = self.client.customer.create()
+        self.client.credit_card.create(customer.customer_id, {
             'credit_card': {
                 'card_number': '4111111111111111',
                 'card_code': '523',
@@ -603,15 +635,15 @@ class TestTransaction(ModuleTestCase):
         """
         self.setup_defaults()
 
-        customer = authorize.Customer.create()
-        authorize.Address.create(
+        customer = self.client.customer.create()
+        self.client.address.create(
             customer.customer_id,
             self.party1.addresses[0].get_authorize_address()
         )
 
         # Try creating shipping address with same address
         new_address_id = self.party2.addresses[0].send_to_authorize(
-            customer.customer_id
+            customer.customer_id, self.auth_net_gateway
         )
         self.assert_(new_address_id)
 
@@ -654,6 +686,1993 @@ class TestTransaction(ModuleTestCase):
             self.assertEqual(self.party1.payable, Decimal('0'))
             self.assertEqual(self.party1.receivable, Decimal('0'))
 
+    @with_transaction()
+    def test_0090_test_transaction_capture_batch(self):
+        """
+        Test capture of a batch of transactions
+        """
+        with mock_authorize_net():
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': amount,
+                    'credit_account': self.party1.account_receivable.id,
+                } for amount in (
+                    random.randint(1, 5), random.randint(6, 10), 0
+                )])
+                # The digits are taken from the payment profile, like a
+                # single capture
+                self.PaymentTransaction.write(
+                    [transactions[1]], {'last_four_digits': '0000'}
+                )
+
+                failures = self.PaymentTransaction.capture_authorize_net_batch(
+                    transactions
+                )
+                self.assertEqual(failures, [])
+
+                transaction1, transaction2, transaction3 = \
+                    self.PaymentTransaction.browse(transactions)
+                self.assertEqual(transaction1.state, 'posted')
+                self.assertEqual(transaction2.state, 'posted')
+                self.assertEqual(transaction3.state, 'failed')
+                self.assertEqual(transaction1.last_four_digits, '1111')
+                self.assertEqual(transaction2.last_four_digits, '1111')
+                self.assertTrue(transaction1.provider_reference)
+                self.assertEqual(len(transaction1.logs), 1)
+                self.assertEqual(len(transaction3.logs), 1)
+
+    @with_transaction()
+    def test_0100_test_transaction_settle_batch(self):
+        """
+        Test settlement of a batch of authorized transactions
+        """
+        with mock_authorize_net():
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': random.randint(6, 10),
+                    'credit_account': self.party1.account_receivable.id,
+                } for _ in range(3)])
+                self.PaymentTransaction.authorize(transactions)
+                for transaction in transactions:
+                    self.assertEqual(transaction.state, 'authorized')
+
+                # More amount than authorized amount fails on its own
+                transaction1, transaction2, transaction3 = transactions
+                self.PaymentTransaction.write([transaction3], {
+                    'amount': 20,
+                })
+                failures = self.PaymentTransaction.settle_authorize_net_batch(
+                    transactions
+                )
+                self.assertEqual(failures, [])
+                self.assertEqual(transaction1.state, 'posted')
+                self.assertEqual(transaction2.state, 'posted')
+                self.assertEqual(transaction3.state, 'failed')
+
+    @with_transaction()
+    def test_0110_test_authorize_client_reuse(self):
+        """
+        Test that the client of a gateway is reused until its credentials
+        change
+        """
+        cash_journal, = self.Journal.search([('type', '=', 'cash')], limit=1)
+        gateway, = self.PaymentGateway.create([{
+            'name': 'Authorize.net',
+            'journal': cash_journal.id,
+            'provider': 'authorize_net',
+            'method': 'credit_card',
+            'authorize_net_login': 'login',
+            'authorize_net_transaction_key': 'key',
+            'authorize_net_client_key': 'client-key',
+            'test': True,
+        }])
+
+        client = gateway.get_authorize_client()
+        self.assertIs(gateway.get_authorize_client(), client)
+        self.assertEqual(client.config.login_id, 'login')
+
+        self.PaymentGateway.write([gateway], {'name': 'Renamed'})
+        self.assertIs(gateway.get_authorize_client(), client)
+
+        self.PaymentGateway.write([gateway], {
+            'authorize_net_transaction_key': 'new-key',
+        })
+        new_client = gateway.get_authorize_client()
+        self.assertIsNot(new_client, client)
+        self.assertEqual(new_client.config.transaction_key, 'new-key')
+
+        self.PaymentGateway.write([gateway], {'test': False})
+        self.assertEqual(
+            gateway.get_authorize_client().config.environment,
+            authorize.Environment.PRODUCTION
+        )
+
+    @with_transaction()
+    def test_0120_test_concurrent_gateways(self):
+        """
+        Test that concurrent calls for many gateways are each sent with the
+        credentials of their own gateway
+        """
+        Address = POOL.get('party.address')
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+
+            gateways = [self.auth_net_gateway] + self.PaymentGateway.create([{
+                'name': 'Merchant %d' % i,
+                'journal': self.cash_journal.id,
+                'provider': 'authorize_net',
+                'method': 'credit_card',
+                'authorize_net_login': 'merchant-%d' % i,
+                'authorize_net_transaction_key': 'key-%d' % i,
+                'authorize_net_client_key': 'client-key',
+                'test': True,
+            } for i in range(7)])
+
+            address = self.party1.addresses[0]
+            Address.write([address], {'authorize_id': '1'})
+            profiles = []
+            for gateway in gateways:
+                client = gateway.get_authorize_client()
+                customer = client.customer.create()
+                credit_card = client.credit_card.create(customer.customer_id, {
+                    'credit_card': {
+                        'card_number': '4111111111111111',
+                        'expiration_date': '01/%s' % (date.today().year + 1),
+                    },
+                })
+                profiles.append(self.PaymentProfile(
+                    party=self.party1,
+                    address=address.id,
+                    gateway=gateway.id,
+                    last_4_digits='1111',
+                    expiry_month='01',
+                    expiry_year=str(date.today().year + 1),
+                    provider_reference=credit_card.payment_id,
+                    authorize_profile_id=customer.customer_id,
+                ))
+            self.PaymentProfile.save(profiles)
+
+            # Raw calls from many threads, the clients are shared between
+            # the threads
+            def sale(item):
+                login, client, customer_id, payment_id = item
+                return login, client.transaction.sale({
+                    'amount': 1,
+                    'customer_id': customer_id,
+                    'payment_id': payment_id,
+                }).transaction_response.trans_id
+
+            items = [(
+                p.gateway.authorize_net_login,
+                p.gateway.get_authorize_client(),
+                p.authorize_profile_id,
+                p.provider_reference,
+            ) for p in profiles] * 25
+            for result, exc in map_concurrently(sale, items, max_workers=32):
+                self.assertIsNone(exc)
+                login, trans_id = result
+                self.assertEqual(
+                    server.transactions[trans_id]['login'], login
+                )
+
+            # Batch of transactions of all the gateways
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': address.id,
+                    'payment_profile': profile.id,
+                    'gateway': profile.gateway.id,
+                    'amount': random.randint(1, 10),
+                    'credit_account': self.party1.account_receivable.id,
+                } for profile in profiles * 10])
+                failures = self.PaymentTransaction.capture_authorize_net_batch(
+                    transactions
+                )
+            self.assertEqual(failures, [])
+            for transaction in transactions:
+                self.assertEqual(transaction.state, 'posted')
+                self.assertEqual(
+                    server.transactions[transaction.provider_reference],
+                    {
+                        'login': transaction.gateway.authorize_net_login,
+                        'type': 'authCaptureTransaction',
+                        'amount': transaction.amount,
+                        'state': 'captured',
+                        'ref_trans_id': None,
+                        'response_code': '1',
+                        'invoice_number':
+                            transaction.get_authorize_net_invoice_number(),
+                    }
+                )
+
+    @with_transaction()
+    def test_0130_test_mock_server_outcomes(self):
+        """
+        Test declined, held and duplicate answers injected in the mock server
+        """
+        ProfileWizard = POOL.get(
+            'party.party.payment_profile.add', type="wizard"
+        )
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                transaction1, transaction2 = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': random.randint(1, 5),
+                    'credit_account': self.party1.account_receivable.id,
+                }] * 2)
+
+                server.inject('createTransactionRequest', 'declined')
+                transaction1.capture_authorize_net()
+                self.assertEqual(transaction1.state, 'failed')
+
+                server.inject('createTransactionRequest', 'held-for-review')
+                transaction2.authorize_authorize_net()
+                self.assertEqual(transaction2.state, 'in-progress')
+                self.assertEqual(
+                    server.transactions[transaction2.provider_reference][
+                        'state'], 'held'
+                )
+
+            # A payment profile left on authorize.net for the same card is
+            # deleted and the card is added again
+            address = self.party1.addresses[0]
+            orphan = self.client.credit_card.create(
+                self.payment_profile.authorize_profile_id, {
+                    'credit_card': {
+                        'card_number': self.card_data1.number,
+                        'expiration_date': '%s/%s' % (
+                            self.card_data1.expiry_month,
+                            self.card_data1.expiry_year,
+                        ),
+                    },
+                    'billing': address.get_authorize_address('Test User -1'),
+                }
+            )
+            profile_wizard = ProfileWizard(ProfileWizard.create()[0])
+            card_info = profile_wizard.card_info
+            card_info.owner = 'Test User -1'
+            card_info.number = self.card_data1.number
+            card_info.expiry_month = self.card_data1.expiry_month
+            card_info.expiry_year = self.card_data1.expiry_year
+            card_info.csc = self.card_data1.csc
+            card_info.gateway = self.auth_net_gateway
+            card_info.provider = self.auth_net_gateway.provider
+            card_info.address = address
+            card_info.party = self.party1
+            profile = profile_wizard.transition_add_authorize_net()
+            self.assertEqual(
+                [name for _, name in server.requests[-5:]], [
+                    'createCustomerPaymentProfileRequest',
+                    'getCustomerProfileRequest',
+                    'deleteCustomerPaymentProfileRequest',
+                    'createCustomerPaymentProfileRequest',
+                    'validateCustomerPaymentProfileRequest',
+                ]
+            )
+            customer = server.customers[profile.authorize_profile_id]
+            self.assertNotIn(orphan.payment_id, customer['payments'])
+            self.assertEqual(sorted(customer['payments']), sorted([
+                self.payment_profile.provider_reference,
+                profile.provider_reference,
+            ]))
+
+            # Too many shipping addresses, the unused ones are deleted
+            # before the address is sent again
+            address_id = address.send_to_authorize(
+                profile.authorize_profile_id, self.auth_net_gateway
+            )
+            unused_id = self.client.address.create(
+                profile.authorize_profile_id, {'first_name': 'Unused'}
+            ).address_id
+            other_address, = POOL.get('party.address').create([{
+                'party': self.party1.id,
+                'street': 'Other Street',
+            }])
+            server.inject('createCustomerShippingAddressRequest', 'E00043')
+            other_id = other_address.send_to_authorize(
+                profile.authorize_profile_id, self.auth_net_gateway
+            )
+            self.assertEqual(
+                sorted(customer['addresses']), sorted([address_id, other_id])
+            )
+            self.assertNotIn(unused_id, customer['addresses'])
+
+    @with_transaction()
+    def test_0140_test_async_submission(self):
+        """
+        Test that transactions of an asynchronous gateway are queued and sent
+        by the scheduled task
+        """
+        Cron = POOL.get('ir.cron')
+
+        self.assertTrue(Cron.search([
+            ('model', '=', 'payment_gateway.transaction'),
+            ('function', '=', 'process_authorize_net_submissions'),
+        ]))
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            self.auth_net_gateway.authorize_net_async = True
+            self.auth_net_gateway.save()
+
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': random.randint(1, 5),
+                    'credit_account': self.party1.account_receivable.id,
+                }] * 4)
+                auth, capture, held, cancelled = transactions
+
+                # Held for review by authorize.net
+                self.PaymentTransaction.authorize([held])
+                self.assertEqual(held.state, 'pending-submission')
+                server.inject('createTransactionRequest', 'held-for-review')
+                self.PaymentTransaction.process_authorize_net_submissions(
+                    commit=False
+                )
+                self.assertEqual(held.state, 'in-progress')
+
+                self.PaymentTransaction.authorize([auth, cancelled])
+                self.PaymentTransaction.capture([capture])
+                for transaction in (auth, capture, cancelled):
+                    self.assertEqual(transaction.state, 'pending-submission')
+                self.assertEqual(
+                    [name for _, name in server.requests].count(
+                        'createTransactionRequest'
+                    ), 1
+                )
+
+                self.PaymentTransaction.cancel([cancelled])
+                self.assertEqual(cancelled.state, 'cancel')
+
+                self.PaymentTransaction.process_authorize_net_submissions(
+                    commit=False
+                )
+
+            self.assertEqual(auth.state, 'authorized')
+            self.assertEqual(capture.state, 'posted')
+            self.assertEqual(
+                [name for _, name in server.requests].count(
+                    'createTransactionRequest'
+                ), 3
+            )
+            for transaction in (auth, capture, held):
+                self.assertEqual(
+                    server.transactions[transaction.provider_reference][
+                        'amount'], transaction.amount
+                )
+
+    @with_transaction()
+    def test_0150_test_timing(self):
+        """
+        Test the timings of the phases of the authorize.net methods
+        """
+        sink = MemorySink()
+        with mock_authorize_net():
+            self.setup_defaults()
+
+            set_sink(sink)
+            try:
+                with Transaction().set_context(company=self.company.id):
+                    transaction, = self.PaymentTransaction.create([{
+                        'party': self.party1.id,
+                        'address': self.party1.addresses[0].id,
+                        'payment_profile': self.payment_profile.id,
+                        'gateway': self.auth_net_gateway.id,
+                        'amount': random.randint(1, 5),
+                        'credit_account': self.party1.account_receivable.id,
+                    }])
+                    transaction.capture_authorize_net()
+            finally:
+                set_sink(None)
+        self.assertEqual(transaction.state, 'posted')
+
+        summary = sink.summary()
+        for phase in ('request', 'gateway', 'save', 'log', 'post'):
+            self.assertEqual(
+                summary['capture_authorize_net.%s' % phase]['count'], 1
+            )
+        # The address was sent to authorize.net to build the request
+        self.assertEqual(summary['send_to_authorize.gateway']['count'], 1)
+
+        # Nothing is timed without sink
+        with timer('capture_authorize_net.gateway'):
+            pass
+        self.assertEqual(
+            sink.summary()['capture_authorize_net.gateway']['count'], 1
+        )
+
+        # Statsd metrics
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        set_sink(StatsdSink(*server.getsockname()))
+        try:
+            with timer('capture_authorize_net.gateway'):
+                pass
+        finally:
+            set_sink(None)
+            data = server.recv(1024)
+            server.close()
+        self.assertTrue(
+            data.startswith('authorize_net.capture_authorize_net.gateway:')
+        )
+        self.assertTrue(data.endswith('|ms'))
+
+    @with_transaction()
+    def test_0160_test_customer_id_cache(self):
+        """
+        Test that the customer profile id of a party is cached until the
+        payment profiles are written
+        """
+        with mock_authorize_net():
+            self.setup_defaults()
+        gateway_id = self.auth_net_gateway.id
+        customer_id = self.payment_profile.authorize_profile_id
+
+        self.assertIsNone(self.party2._get_authorize_net_customer_id(
+            gateway_id
+        ))
+        self.assertEqual(
+            self.party1._get_authorize_net_customer_id(gateway_id),
+            customer_id
+        )
+
+        search_read = self.PaymentProfile.search_read
+        calls = []
+
+        def counting_search_read(cls, *args, **kwargs):
+            calls.append(args)
+            return search_read(*args, **kwargs)
+        self.PaymentProfile.search_read = classmethod(counting_search_read)
+        try:
+            for _ in range(3):
+                self.assertEqual(
+                    self.party1._get_authorize_net_customer_id(gateway_id),
+                    customer_id
+                )
+            self.assertEqual(calls, [])
+
+            self.PaymentProfile.write([self.payment_profile], {
+                'authorize_profile_id': 'new-customer-id',
+            })
+            self.assertEqual(
+                self.party1._get_authorize_net_customer_id(gateway_id),
+                'new-customer-id'
+            )
+            self.assertEqual(len(calls), 1)
+
+            self.PaymentProfile.delete([self.payment_profile])
+            self.assertIsNone(self.party1._get_authorize_net_customer_id(
+                gateway_id
+            ))
+        finally:
+            del self.PaymentProfile.search_read
+
+    @with_transaction()
+    def test_0170_test_create_auth_profiles(self):
+        """
+        Test the bulk creation of the customer profiles of parties
+        """
+        Customer = POOL.get('party.authorize_net.customer')
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            gateway = self.auth_net_gateway
+            parties = self.Party.create([{
+                'name': 'Imported party %d' % i,
+            } for i in range(5)])
+
+            # A previous run was interrupted after creating the profile of
+            # party2 on authorize.net
+            client = gateway.get_authorize_client()
+            remote_id = client.customer.create({
+                'merchant_id': str(self.party2.id),
+                'description': self.party2.name,
+                'email': self.party2.email,
+            }).customer_id
+
+            failures = self.Party.create_auth_profiles(
+                [self.party1, self.party2] + parties, gateway
+            )
+            self.assertEqual(failures, [])
+
+            # party1 already has a profile with its payment profile
+            customers = Customer.search([])
+            self.assertEqual(len(customers), 6)
+            self.assertFalse(Customer.search([('party', '=', self.party1)]))
+            self.assertEqual(
+                self.party2._get_authorize_net_customer_id(gateway.id),
+                remote_id
+            )
+            for party in parties:
+                customer_id = party._get_authorize_net_customer_id(gateway.id)
+                self.assertIn(customer_id, server.customers)
+
+            # Everything is skipped on a second run
+            count = len(server.customers)
+            self.assertEqual(
+                self.Party.create_auth_profiles(parties, gateway), []
+            )
+            self.assertEqual(len(server.customers), count)
+            self.assertEqual(len(Customer.search([])), 6)
+
+    @with_transaction()
+    def test_0180_test_sync_authorize_net_payments(self):
+        """
+        Test that the unused payment profiles on authorize.net are deleted
+        concurrently from a snapshot of the customer profile
+        """
+        ProfileWizard = POOL.get(
+            'party.party.payment_profile.add', type='wizard'
+        )
+
+        def add_card(party, card_data):
+            profile_wizard = ProfileWizard(ProfileWizard.create()[0])
+            card_info = profile_wizard.card_info
+            card_info.owner = 'Owner of %s' % party.name
+            card_info.number = card_data.number
+            card_info.expiry_month = card_data.expiry_month
+            card_info.expiry_year = card_data.expiry_year
+            card_info.csc = card_data.csc
+            card_info.gateway = self.auth_net_gateway
+            card_info.provider = self.auth_net_gateway.provider
+            card_info.address = party.addresses[0]
+            card_info.party = party
+            return profile_wizard.transition_add_authorize_net()
+
+        def add_orphan(customer_id, month):
+            return self.client.credit_card.create(customer_id, {
+                'credit_card': {
+                    'card_number': self.card_data1.number,
+                    'expiration_date': '%s/%s' % (
+                        month, self.card_data1.expiry_year,
+                    ),
+                },
+                'billing': {'first_name': 'Orphan %s' % month},
+            }).payment_id
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            gateway = self.auth_net_gateway
+            customer_id = self.payment_profile.authorize_profile_id
+            customer = server.customers[customer_id]
+
+            # Without snapshot the customer profile is fetched once
+            orphans = [add_orphan(customer_id, m) for m in ('01', '02', '03')]
+            del server.requests[:]
+            self.assertEqual(
+                sorted(self.party1.sync_authorize_net_payments(
+                    gateway, customer_id
+                )), sorted(orphans)
+            )
+            names = [name for _, name in server.requests]
+            self.assertEqual(names.count('getCustomerProfileRequest'), 1)
+            self.assertEqual(
+                names.count('deleteCustomerPaymentProfileRequest'), 3
+            )
+            self.assertEqual(
+                customer['payments'].keys(),
+                [self.payment_profile.provider_reference]
+            )
+
+            # A card added then deleted locally is deleted on authorize.net
+            # from the snapshot, without fetching the customer profile
+            profile = add_card(self.party1, self.card_data2)
+            payment_id = profile.provider_reference
+            self.PaymentProfile.delete([profile])
+            del server.requests[:]
+            self.assertEqual(
+                self.party1.sync_authorize_net_payments(gateway, customer_id),
+                [payment_id]
+            )
+            self.assertEqual(
+                [name for _, name in server.requests],
+                ['deleteCustomerPaymentProfileRequest']
+            )
+
+            # An outdated snapshot falls back to fetching the customer
+            # profile
+            orphan = add_orphan(customer_id, '04')
+            self.Party._authorize_net_payments_cache.set(
+                (gateway.id, customer_id), ('1',)
+            )
+            self.assertEqual(
+                self.party1.sync_authorize_net_payments(gateway, customer_id),
+                [orphan]
+            )
+
+            # A customer profile without payment profiles
+            customer_id = self.party2.create_auth_profile(gateway)
+            self.assertEqual(
+                self.party2.sync_authorize_net_payments(gateway, customer_id),
+                []
+            )
+
+    @with_transaction()
+    def test_0190_test_address_index(self):
+        """
+        Test that an address already uploaded to a customer profile is found
+        by its content instead of deleting the addresses
+        """
+        Address = POOL.get('party.address')
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            gateway = self.auth_net_gateway
+            customer_id = self.payment_profile.authorize_profile_id
+            customer = server.customers[customer_id]
+            address = self.party1.addresses[0]
+
+            address_id = address.send_to_authorize(customer_id, gateway)
+
+            # The index gives the address without any call
+            del server.requests[:]
+            self.assertEqual(
+                address.send_to_authorize(customer_id, gateway), address_id
+            )
+            self.assertEqual(server.requests, [])
+
+            # Without index the duplicate gives the address
+            Address._authorize_net_address_cache.clear()
+            self.assertEqual(
+                address.send_to_authorize(customer_id, gateway), address_id
+            )
+            self.assertEqual(
+                [name for _, name in server.requests],
+                ['createCustomerShippingAddressRequest']
+            )
+            self.assertEqual(customer['addresses'].keys(), [address_id])
+
+            # The digests of the fetched addresses match the sent ones
+            self.assertEqual(
+                address.index_authorize_addresses(customer_id, gateway), {
+                    get_address_digest(address.get_authorize_address()):
+                        address_id,
+                }
+            )
+
+    @with_transaction()
+    def test_0200_test_authorize_address_cache(self):
+        """
+        Test that the address dictionaries are cached in the transaction
+        until the address, its party, contact mechanisms or country is
+        written
+        """
+        Address = POOL.get('party.address')
+        Country = POOL.get('country.country')
+        ContactMechanism = POOL.get('party.contact_mechanism')
+
+        with mock_authorize_net():
+            self.setup_defaults()
+        address = self.party2.addresses[0]
+
+        payload = address.get_authorize_address()
+        self.assertEqual(payload['city'], 'Test City')
+        self.assertEqual(get_address_payloads()[
+            (address.id, address.write_date, None)
+        ], payload)
+        self.assertEqual(payload['first_name'], 'Test')
+        self.assertEqual(
+            address.get_authorize_address('Card Owner')['first_name'], 'Card'
+        )
+
+        # The cached dictionary is a copy
+        payload['city'] = 'Changed'
+        self.assertEqual(address.get_authorize_address()['city'], 'Test City')
+
+        Address.write([address], {'city': 'New City'})
+        self.assertEqual(
+            Address(address.id).get_authorize_address()['city'], 'New City'
+        )
+
+        country, = Country.create([{'name': 'United States', 'code': 'US'}])
+        Address.write([address], {'country': country.id})
+        self.assertEqual(
+            Address(address.id).get_authorize_address()['country'], 'US'
+        )
+
+        # The related records are read again once written
+        Country.write([country], {'code': 'CA'})
+        self.Party.write([self.party2], {'name': 'New Party'})
+        ContactMechanism.create([{
+            'party': self.party2.id,
+            'type': 'phone',
+            'value': '555-0100',
+        }])
+        payload = Address(address.id).get_authorize_address()
+        self.assertEqual(payload['country'], 'CA')
+        self.assertEqual(payload['company'], 'New Party')
+        self.assertEqual(payload['phone_number'], '555-0100')
+
+        addresses = [
+            self.party1.addresses[0], self.party2.addresses[0],
+            self.party3.addresses[0],
+        ]
+        self.assertEqual(
+            Address.get_authorize_addresses(addresses),
+            [a.get_authorize_address() for a in addresses]
+        )
+
+    @with_transaction()
+    def test_0210_test_authorize_net_payloads(self):
+        """
+        Test that the payloads of a batch of transactions are built with
+        bulk reads of the related records
+        """
+        Address = POOL.get('party.address')
+
+        with mock_authorize_net():
+            self.setup_defaults()
+            addresses = Address.create([{
+                'party': self.party1.id,
+                'street': 'Street %d' % i,
+            } for i in range(4)])
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': address.id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': random.randint(1, 100),
+                    'credit_account': self.party1.account_receivable.id,
+                } for address in addresses * 3])
+
+            read = Address.read
+            calls = []
+
+            def counting_read(cls, ids, *args, **kwargs):
+                calls.append(ids)
+                return read(ids, *args, **kwargs)
+            Address.read = classmethod(counting_read)
+            try:
+                payloads = self.PaymentTransaction.get_authorize_net_payloads(
+                    self.PaymentTransaction.browse(
+                        [t.id for t in transactions]
+                    )
+                )
+            finally:
+                del Address.read
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(payloads), len(transactions))
+        for transaction, payload in zip(transactions, payloads):
+            self.assertEqual(payload['amount'], transaction.amount)
+            self.assertEqual(
+                payload['customer_id'],
+                self.payment_profile.authorize_profile_id
+            )
+            self.assertEqual(
+                payload['shipping_id'],
+                Address(transaction.address.id).authorize_id
+            )
+
+    @with_transaction()
+    def test_0220_test_compact_deferred_logs(self):
+        """
+        Test the compact, compressed and deferred transaction logs
+        """
+        TransactionLog = POOL.get('payment_gateway.transaction.log')
+
+        def capture(amount):
+            transaction, = self.PaymentTransaction.create([{
+                'party': self.party1.id,
+                'address': self.party1.addresses[0].id,
+                'payment_profile': self.payment_profile.id,
+                'gateway': self.auth_net_gateway.id,
+                'amount': amount,
+                'credit_account': self.party1.account_receivable.id,
+            }])
+            transaction.capture_authorize_net()
+            return transaction
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            config.set('authorize_net', 'log_format', 'compact')
+            config.set('authorize_net', 'log_compress', 'True')
+            try:
+                with Transaction().set_context(company=self.company.id):
+                    transaction = capture(Decimal('10'))
+                    log, = TransactionLog.search([
+                        ('transaction', '=', transaction.id),
+                    ])
+                    data = yaml.safe_load(log.log)
+                    self.assertEqual(
+                        data['trans_id'], transaction.provider_reference
+                    )
+                    self.assertEqual(data['response_code'], '1')
+                    self.assertEqual(data['auth_code'], 'MOCK01')
+                    self.assertIn('I00001: Successful.', data['messages'])
+                    self.assertNotIn('account_number', data)
+                    self.assertIn(
+                        'account_number',
+                        TransactionLog.decompress_authorize_net_log(
+                            data['raw']
+                        )
+                    )
+
+                    server.inject('createTransactionRequest', 'declined')
+                    transaction = capture(Decimal('11'))
+                    log, = TransactionLog.search([
+                        ('transaction', '=', transaction.id),
+                    ])
+                    self.assertIn(
+                        '2: This transaction has been declined.',
+                        yaml.safe_load(log.log)['messages']
+                    )
+
+                    # Deferred logs are created at the commit
+                    config.set('authorize_net', 'log_deferred', 'True')
+                    transactions = [capture(Decimal(i)) for i in (12, 13)]
+                    domain = [('transaction', 'in', transactions)]
+                    self.assertEqual(TransactionLog.search(domain), [])
+                    buffer_ = Transaction().join(_LogBuffer())
+                    self.assertEqual(len(buffer_.logs), 2)
+                    buffer_.commit(Transaction())
+                    self.assertEqual(len(TransactionLog.search(domain)), 2)
+                    self.assertEqual(buffer_.logs, [])
+            finally:
+                for option in ('log_format', 'log_compress', 'log_deferred'):
+                    config.remove_option('authorize_net', option)
+
+    @with_transaction()
+    def test_0230_test_retry(self):
+        """
+        Test that the calls without answer are retried without charging
+        twice
+        """
+        AuthorizeConnectionError = authorize.exceptions.AuthorizeConnectionError
+
+        policy = RetryPolicy(attempts=3, base_delay=1, max_delay=2)
+        start = time.time()
+        self.assertTrue(0 <= policy.get_delay(1, start) <= 1)
+        self.assertTrue(0 <= policy.get_delay(2, start) <= 2)
+        self.assertIsNone(policy.get_delay(3, start))
+        self.assertIsNone(policy.get_delay(1, start - 10))
+
+        def create_transaction(amount):
+            transaction, = self.PaymentTransaction.create([{
+                'party': self.party1.id,
+                'address': self.party1.addresses[0].id,
+                'payment_profile': self.payment_profile.id,
+                'gateway': self.auth_net_gateway.id,
+                'amount': amount,
+                'credit_account': self.party1.account_receivable.id,
+            }])
+            return transaction
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            self.auth_net_gateway.get_authorize_client().retry_policy = \
+                RetryPolicy(base_delay=0.01)
+            with Transaction().set_context(company=self.company.id):
+                # A 503 answer is retried
+                server.inject('createTransactionRequest', 'unavailable')
+                transaction = create_transaction(Decimal('10'))
+                transaction.capture_authorize_net()
+                self.assertEqual(transaction.state, 'posted')
+
+                # The answer of a processed capture is lost, the retry is
+                # refused as duplicate and the transaction is left as is
+                count = len(server.transactions)
+                server.inject('createTransactionRequest', 'lost')
+                transaction = create_transaction(Decimal('11'))
+                batch = self.PaymentTransaction.capture_authorize_net_batch
+                (failed, exc), = batch([transaction])
+                self.assertEqual(failed, transaction)
+                self.assertIsInstance(exc, AuthorizeConnectionError)
+                self.assertEqual(transaction.state, 'draft')
+                self.assertEqual(len(server.transactions), count + 1)
+
+                # No retry once the budget is spent
+                client = self.auth_net_gateway.get_authorize_client()
+                client.retry_budget.tokens = 0
+                server.inject('createTransactionRequest', 'unavailable')
+                transaction = create_transaction(Decimal('12'))
+                self.assertRaises(
+                    AuthorizeConnectionError,
+                    transaction.capture_authorize_net
+                )
+
+                # The kept alive connection is closed without answer after
+                # the capture was processed: it is sent again on a new
+                # connection, refused as duplicate and not charged twice
+                create_transaction(Decimal('13')).capture_authorize_net()
+                count = len(server.transactions)
+                server.inject('createTransactionRequest', 'lost')
+                transaction = create_transaction(Decimal('14'))
+                self.assertRaises(
+                    AuthorizeConnectionError,
+                    transaction.capture_authorize_net
+                )
+                self.assertEqual(len(server.transactions), count + 1)
+                self.assertEqual(
+                    [name for _, name in server.requests[-2:]],
+                    ['createTransactionRequest', 'createTransactionRequest']
+                )
+
+    @with_transaction()
+    def test_0240_test_circuit_breaker(self):
+        """
+        Test that the circuit breaker of a gateway opens on failures, fails
+        fast or queues the transactions and closes after a probe
+        """
+        ProfileWizard = POOL.get(
+            'party.party.payment_profile.add', type="wizard"
+        )
+
+        breaker = CircuitBreaker(min_calls=2, open_duration=0.05)
+        breaker.record(False, 0)
+        breaker.record(True, 0)
+        self.assertEqual(breaker.get_state(), 'open')
+        self.assertFalse(breaker.allow())
+        time.sleep(0.05)
+        self.assertEqual(breaker.get_state(), 'half-open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False, 0)
+        self.assertEqual(breaker.get_state(), 'closed')
+
+        def create_transaction(amount):
+            transaction, = self.PaymentTransaction.create([{
+                'party': self.party1.id,
+                'address': self.party1.addresses[0].id,
+                'payment_profile': self.payment_profile.id,
+                'gateway': self.auth_net_gateway.id,
+                'amount': amount,
+                'credit_account': self.party1.account_receivable.id,
+            }])
+            return transaction
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            gateway = self.auth_net_gateway
+            client = gateway.get_authorize_client()
+            client.retry_policy = RetryPolicy(attempts=1)
+            client.breaker = CircuitBreaker(min_calls=2, open_duration=60)
+            self.assertEqual(gateway.authorize_net_breaker_state, 'closed')
+
+            with Transaction().set_context(company=self.company.id):
+                # Half of the calls fail: the address is sent but not the
+                # transaction
+                server.inject('createTransactionRequest', 'unavailable')
+                self.assertRaises(
+                    authorize.exceptions.AuthorizeConnectionError,
+                    create_transaction(Decimal('10')).capture_authorize_net
+                )
+                self.assertEqual(
+                    self.PaymentGateway(gateway.id).authorize_net_breaker_state,
+                    'open'
+                )
+
+                # Transactions with a payment profile are queued
+                del server.requests[:]
+                transaction = create_transaction(Decimal('12'))
+                transaction.capture_authorize_net()
+                self.assertEqual(transaction.state, 'pending-submission')
+                self.assertEqual(server.requests, [])
+
+                # Transactions with a card fail at once
+                transaction = create_transaction(Decimal('13'))
+                self.assertRaises(
+                    CircuitOpenError, transaction.capture_authorize_net,
+                    card_info=self.card_data1
+                )
+                self.assertEqual(server.requests, [])
+
+                # The actions of the users fail with an error
+                client.breaker = CircuitBreaker()
+                authorized = create_transaction(Decimal('14'))
+                authorized.authorize_authorize_net()
+                captured = create_transaction(Decimal('15'))
+                captured.capture_authorize_net()
+                refund = captured.create_refund()
+                client.breaker._open(time.time())
+                self.assertRaises(
+                    UserError, self.PaymentTransaction.cancel, [authorized]
+                )
+                self.assertRaises(
+                    UserError, self.PaymentTransaction.refund, [refund]
+                )
+                profile_wizard = ProfileWizard(ProfileWizard.create()[0])
+                card_info = profile_wizard.card_info
+                card_info.owner = self.party1.name
+                card_info.number = '4007000000027'
+                card_info.expiry_month = self.card_data1.expiry_month
+                card_info.expiry_year = self.card_data1.expiry_year
+                card_info.csc = self.card_data1.csc
+                card_info.gateway = gateway
+                card_info.provider = gateway.provider
+                card_info.address = self.party1.addresses[0]
+                card_info.party = self.party1
+                self.assertRaises(
+                    UserError, profile_wizard.transition_add_authorize_net
+                )
+                self.assertEqual(authorized.state, 'authorized')
+                self.assertEqual(refund.state, 'draft')
+
+    def test_0250_test_token_bucket(self):
+        """
+        Test that the token buckets sharing a file pace the calls together
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bucket')
+            # Two buckets on the same file, as in two processes
+            buckets = [TokenBucket(path, 100, 1), TokenBucket(path, 100, 1)]
+
+            start = time.time()
+            outcomes = map_concurrently(
+                lambda i: buckets[i % 2].acquire(), range(21), max_workers=4
+            )
+            elapsed = time.time() - start
+            self.assertEqual(outcomes, [(None, None)] * 21)
+            # The first token is in the bucket, the others come at 100/s
+            self.assertTrue(elapsed >= 0.19, elapsed)
+
+            config.set('authorize_net', 'rate_limit', '10')
+            config.set('authorize_net', 'rate_limit_dir', directory)
+            try:
+                bucket = get_token_bucket('http://example.com', 'login')
+            finally:
+                config.remove_option('authorize_net', 'rate_limit')
+                config.remove_option('authorize_net', 'rate_limit_dir')
+            self.assertEqual(os.path.dirname(bucket.path), directory)
+            self.assertEqual(bucket.rate, 10)
+            self.assertIsNone(get_token_bucket('http://example.com', 'login'))
+        finally:
+            shutil.rmtree(directory)
+
+    @with_transaction()
+    def test_0260_test_update_authorize_net_batch(self):
+        """
+        Test that the states of the transactions are updated from the pages
+        of the transaction lists
+        """
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': i + 1,
+                    'credit_account': self.party1.account_receivable.id,
+                } for i in range(6)])
+                server.inject('createTransactionRequest', 'held-for-review', 5)
+                self.PaymentTransaction.capture_authorize_net_batch(
+                    transactions[:5]
+                )
+                self.PaymentTransaction.authorize_authorize_net_batch(
+                    transactions[5:]
+                )
+                self.assertEqual(
+                    [t.state for t in transactions],
+                    ['in-progress'] * 5 + ['authorized']
+                )
+
+                server.review(transactions[3].provider_reference)
+                server.settle_batch(
+                    datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+                )
+                server.review(transactions[0].provider_reference)
+                server.review(transactions[1].provider_reference)
+                server.review(transactions[2].provider_reference, False)
+
+                del server.requests[:]
+                not_found = \
+                    self.PaymentTransaction.update_authorize_net_batch(
+                        transactions, page_size=2
+                    )
+                self.assertEqual(not_found, [])
+                # 3 pages of unsettled transactions, then the batch list and
+                # the page of the batch
+                self.assertEqual([r[1] for r in server.requests], [
+                    'getUnsettledTransactionListRequest',
+                ] * 3 + [
+                    'getSettledBatchListRequest',
+                    'getTransactionListRequest',
+                ])
+                self.assertEqual(
+                    [
+                        self.PaymentTransaction(t.id).state
+                        for t in transactions
+                    ],
+                    ['posted', 'posted', 'failed', 'posted', 'in-progress',
+                        'authorized']
+                )
+                self.assertEqual(
+                    len(self.PaymentTransaction(transactions[0].id).logs), 2
+                )
+
+                server.review(transactions[4].provider_reference)
+                self.PaymentTransaction.update_status([transactions[4]])
+                self.assertEqual(transactions[4].state, 'posted')
+
+    @with_transaction()
+    def test_0270_test_reconcile_authorize_net(self):
+        """
+        Test the reconciliation of the settled batches with the transactions
+        """
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': i + 1,
+                    'credit_account': self.party1.account_receivable.id,
+                } for i in range(5)])
+                server.inject('createTransactionRequest', 'held-for-review', 2)
+                self.PaymentTransaction.capture_authorize_net_batch(
+                    transactions[:2]
+                )
+                self.PaymentTransaction.capture_authorize_net_batch(
+                    transactions[2:]
+                )
+                server.review(transactions[0].provider_reference)
+                server.review(transactions[1].provider_reference, False)
+                # A transaction unknown locally
+                client = self.auth_net_gateway.get_authorize_client()
+                client.transaction.sale({
+                    'amount': Decimal('9'),
+                    'customer_id': self.payment_profile.authorize_profile_id,
+                    'payment_id': self.payment_profile.provider_reference,
+                })
+                server.settle_batch()
+                self.PaymentTransaction.write(
+                    [transactions[4]], {'amount': Decimal('4')}
+                )
+
+                now = datetime.datetime.utcnow()
+                report = self.PaymentTransaction.reconcile_authorize_net(
+                    self.auth_net_gateway, now - datetime.timedelta(days=1),
+                    now + datetime.timedelta(hours=1), page_size=2
+                )
+                self.assertEqual(report, {
+                    'settled': 6, 'fixed': 2, 'missing': 1, 'amount': 1,
+                })
+                self.assertEqual(
+                    [
+                        self.PaymentTransaction(t.id).state
+                        for t in transactions
+                    ],
+                    ['posted', 'failed', 'posted', 'posted', 'posted']
+                )
+
+                # Nothing left to fix
+                report = self.PaymentTransaction.reconcile_authorize_net(
+                    self.auth_net_gateway, now - datetime.timedelta(days=1),
+                    now + datetime.timedelta(hours=1)
+                )
+                self.assertEqual(report['fixed'], 0)
+
+                self.PaymentTransaction.reconcile_authorize_net_settlements()
+
+    @with_transaction()
+    def test_0280_test_lookup_indexes(self):
+        """
+        Test that the columns on which transactions and profiles are looked
+        up are indexed
+        """
+        TableHandler = backend.get('TableHandler')
+
+        table = TableHandler(self.PaymentTransaction)
+        self.assertIn(
+            'payment_gateway_transaction_provider_reference_index',
+            table._indexes
+        )
+        table = TableHandler(POOL.get('party.payment_profile'))
+        self.assertIn(
+            'party_payment_profile_authorize_profile_id_index',
+            table._indexes
+        )
+        self.assertIn(
+            'party_payment_profile_party_gateway_authorize_profile_id_index',
+            table._indexes
+        )
+
+    @with_transaction()
+    def test_0290_test_webhook_events(self):
+        """
+        Test that the webhook notifications are checked, deduplicated and
+        applied to the transactions in bulk
+        """
+        Event = POOL.get('payment_gateway.authorize_net.event')
+
+        def notify(notification_id, event_type, trans_id, key='S' * 128,
+                   **payload):
+            payload.update({'entityName': 'transaction', 'id': trans_id})
+            body = json.dumps({
+                'notificationId': notification_id,
+                'eventType': event_type,
+                'payload': payload,
+            })
+            Event.receive(
+                self.auth_net_gateway.id, body,
+                'sha512=' + hmac.new(
+                    key, body, hashlib.sha512
+                ).hexdigest().upper()
+            )
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            self.auth_net_gateway.authorize_net_signature_key = 'S' * 128
+            self.auth_net_gateway.save()
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': i + 1,
+                    'credit_account': self.party1.account_receivable.id,
+                } for i in range(3)])
+                server.inject('createTransactionRequest', 'held-for-review', 3)
+                self.PaymentTransaction.capture_authorize_net_batch(
+                    transactions
+                )
+                t0, t1, t2 = [t.provider_reference for t in transactions]
+
+                with self.assertRaises(UserError):
+                    notify(
+                        'n0', 'net.authorize.payment.fraud.declined', t1,
+                        key='K' * 128
+                    )
+                server.review(t0)
+                notify('n1', 'net.authorize.payment.fraud.approved', t0)
+                notify('n2', 'net.authorize.payment.fraud.declined', t1)
+                notify('n2', 'net.authorize.payment.fraud.declined', t1)
+                notify(
+                    'n3', 'net.authorize.payment.authcapture.created', t2,
+                    responseCode=4
+                )
+                notify('n4', 'net.authorize.payment.fraud.held', t2)
+                # Its transaction is not saved yet
+                notify('n5', 'net.authorize.payment.authcapture.created', '1')
+                notify('n6', 'net.authorize.customer.created', None)
+                self.assertEqual(Event.search([], count=True), 6)
+
+                del server.requests[:]
+                Event.process_authorize_net_events(batch_size=4)
+                self.assertEqual(
+                    [
+                        self.PaymentTransaction(t.id).state
+                        for t in transactions
+                    ],
+                    ['posted', 'failed', 'in-progress']
+                )
+                # Only the approval needs the status of the transaction
+                self.assertEqual(
+                    [r[1] for r in server.requests],
+                    ['getTransactionDetailsRequest']
+                )
+                self.assertEqual(
+                    [(e.notification_id, e.state) for e in Event.search(
+                        [], order=[('notification_id', 'ASC')]
+                    )], [
+                        ('n1', 'done'), ('n2', 'done'), ('n3', 'done'),
+                        ('n4', 'done'), ('n5', 'pending'), ('n6', 'ignored'),
+                    ]
+                )
+
+    @with_transaction()
+    def test_0300_test_refund_authorize_net_batch(self):
+        """
+        Test that the settled transactions are refunded and the unsettled
+        ones voided together, that the refunds which got no answer are
+        reported and that a refund processed before is not sent again
+        """
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            with Transaction().set_context(company=self.company.id):
+                charges = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': Decimal(10 + i),
+                    'credit_account': self.party1.account_receivable.id,
+                } for i in range(4)])
+                self.PaymentTransaction.capture_authorize_net_batch(
+                    charges[:2]
+                )
+                server.settle_batch()
+                self.PaymentTransaction.capture_authorize_net_batch(
+                    charges[2:]
+                )
+                refunds = [
+                    charges[0].create_refund(),
+                    charges[1].create_refund(Decimal('5')),
+                    charges[2].create_refund(),
+                    charges[3].create_refund(Decimal('5')),
+                ]
+
+                # The partial refund of an unsettled charge is refused
+                # before anything is sent
+                del server.requests[:]
+                with self.assertRaises(UserError):
+                    self.PaymentTransaction.refund(refunds)
+                self.assertEqual(
+                    [r[1] for r in server.requests],
+                    ['getUnsettledTransactionListRequest']
+                )
+
+                del server.requests[:]
+                self.PaymentTransaction.refund(refunds[:3])
+                self.assertEqual(
+                    [r[1] for r in server.requests].count(
+                        'createTransactionRequest'
+                    ), 3
+                )
+                self.assertEqual(
+                    [self.PaymentTransaction(r.id).state for r in refunds],
+                    ['posted', 'posted', 'posted', 'draft']
+                )
+                self.assertEqual(server.transactions[
+                    self.PaymentTransaction(refunds[2].id).provider_reference
+                ]['type'], 'voidTransaction')
+
+                # A refund processed whose outcome was rolled back, and the
+                # void of an origin already voided, are not sent again
+                self.PaymentTransaction.write(
+                    [refunds[0], refunds[2]], {
+                        'state': 'draft', 'provider_reference': None,
+                    }
+                )
+                count = len(server.transactions)
+                del server.requests[:]
+                self.PaymentTransaction.refund([refunds[0], refunds[2]])
+                self.assertNotIn(
+                    'createTransactionRequest',
+                    [r[1] for r in server.requests]
+                )
+                self.assertEqual(len(server.transactions), count)
+                self.assertEqual(
+                    [self.PaymentTransaction(r.id).state
+                        for r in [refunds[0], refunds[2]]],
+                    ['posted', 'posted']
+                )
+
+                # Once settled it is refunded, unless it gets no answer: it
+                # is then left in progress and reported
+                server.settle_batch()
+                config.set('authorize_net', 'retry_base_delay', '0')
+                server.inject('createTransactionRequest', 'unavailable', 3)
+                try:
+                    with self.assertRaises(UserError) as cm:
+                        self.PaymentTransaction.refund(refunds[3:])
+                finally:
+                    config.remove_option('authorize_net', 'retry_base_delay')
+                self.assertIn(refunds[3].rec_name, cm.exception.message)
+                self.assertEqual(
+                    self.PaymentTransaction(refunds[3].id).state,
+                    'in-progress'
+                )
+                self.PaymentTransaction.refund(refunds[3:])
+                self.assertEqual(
+                    self.PaymentTransaction(refunds[3].id).state, 'posted'
+                )
+                references = [
+                    self.PaymentTransaction(r.id).provider_reference
+                    for r in refunds[:2]
+                ]
+                self.assertEqual(
+                    [server.transactions[r]['type'] for r in references],
+                    ['refundTransaction', 'refundTransaction']
+                )
+                self.assertEqual(
+                    server.transactions[charges[2].provider_reference][
+                        'state'
+                    ], 'voided'
+                )
+                self.assertEqual(
+                    server.transactions[charges[1].provider_reference][
+                        'refunded'
+                    ], Decimal('5')
+                )
+
+    @with_transaction()
+    def test_0310_test_void_stale_authorizations(self):
+        """
+        Test that the old authorizations are voided together and the
+        failures are counted
+        """
+        Date = POOL.get('ir.date')
+
+        table = backend.get('TableHandler')(self.PaymentTransaction)
+        self.assertIn(
+            'payment_gateway_transaction_state_date_index', table._indexes
+        )
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            today = Date.today()
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': i + 1,
+                    'date': today - datetime.timedelta(days=days),
+                    'credit_account': self.party1.account_receivable.id,
+                } for i, days in enumerate([40, 40, 40, 40, 5])])
+                self.PaymentTransaction.authorize_authorize_net_batch(
+                    transactions
+                )
+
+                config.set('authorize_net', 'max_workers', '1')
+                config.set('authorize_net', 'retry_base_delay', '0')
+                server.inject('createTransactionRequest', 'E00027')
+                server.inject('createTransactionRequest', 'unavailable', 3)
+                try:
+                    report = self.PaymentTransaction.\
+                        void_stale_authorize_net_authorizations()
+                finally:
+                    config.remove_option('authorize_net', 'max_workers')
+                    config.remove_option('authorize_net', 'retry_base_delay')
+
+        self.assertEqual(report, {'voided': 2, 'refused': 1, 'failed': 1})
+        self.assertEqual(
+            [self.PaymentTransaction(t.id).state for t in transactions],
+            ['authorized', 'authorized', 'cancel', 'cancel', 'authorized']
+        )
+
+    @with_transaction()
+    def test_0320_test_import_cards(self):
+        """
+        Test that the cards of a file are imported by chunks, that the
+        import resumes from its checkpoint and that the rows imported again
+        after a crash before the checkpoint are not duplicated
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'cards.csv')
+        checkpoint = os.path.join(directory, 'cards.checkpoint')
+        try:
+            with mock_authorize_net() as server:
+                self.setup_defaults()
+                party3, = self.Party.create([{
+                    'name': 'Party Three',
+                    'addresses': [],
+                }])
+                with open(path, 'wb') as file_:
+                    file_.write(
+                        'party,name,number,csc,expiry_month,expiry_year\n'
+                        '%s,Party One,4111111111111111,123,1,30\n'
+                        '%s,Party Two,4007000000027,,12,2031\n'
+                        'unknown,Nobody,4012888818888,,6,2030\n'
+                        '%s,Party Three,5424000000000015,,6,2030\n'
+                        % (self.party1.code, self.party2.code, party3.code)
+                    )
+                del server.requests[:]
+                with Transaction().set_context(company=self.company.id):
+                    report = import_cards(
+                        self.auth_net_gateway, path, chunk_size=2,
+                        validate=True, checkpoint=checkpoint, commit=False
+                    )
+                    # The party without address got no customer profile
+                    self.assertEqual(
+                        [r[1] for r in server.requests].count(
+                            'createCustomerProfileRequest'
+                        ), 1
+                    )
+                    resumed = import_cards(
+                        self.auth_net_gateway, path, chunk_size=2,
+                        checkpoint=checkpoint, commit=False
+                    )
+                    # Crashed after the commit of the chunks, before their
+                    # checkpoint
+                    os.remove(checkpoint)
+                    replayed = import_cards(
+                        self.auth_net_gateway, path, chunk_size=2,
+                        checkpoint=checkpoint, commit=False
+                    )
+                profiles = self.PaymentProfile.search([
+                    ('gateway', '=', self.auth_net_gateway.id),
+                    ('id', '!=', self.payment_profile.id),
+                ], order=[('party', 'ASC')])
+                with open(checkpoint) as file_:
+                    done = json.load(file_)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(report, {'imported': 2, 'failed': 2})
+        self.assertEqual(resumed, {'imported': 0, 'failed': 0})
+        self.assertEqual(replayed, {'imported': 2, 'failed': 2})
+        self.assertEqual(done, {'rows': 4})
+        self.assertEqual(
+            [(p.party.id, p.last_4_digits, p.expiry_month, p.expiry_year)
+                for p in profiles],
+            [(self.party1.id, '1111', '01', '2030'),
+                (self.party2.id, '0027', '12', '2031')]
+        )
+        self.assertTrue(all(p.authorize_profile_id for p in profiles))
+
+    @with_transaction()
+    def test_0330_test_card_validation_policy(self):
+        """
+        Test that the cards added are validated following the policy of the
+        gateway and that the deferred validations are done by the scheduled
+        task
+        """
+        ProfileWizard = POOL.get(
+            'party.party.payment_profile.add', type="wizard"
+        )
+
+        def add_card(number, policy):
+            self.auth_net_gateway.authorize_net_validation = policy
+            self.auth_net_gateway.save()
+            profile_wizard = ProfileWizard(ProfileWizard.create()[0])
+            card_info = profile_wizard.card_info
+            card_info.owner = self.party1.name
+            card_info.number = number
+            card_info.expiry_month = self.card_data1.expiry_month
+            card_info.expiry_year = self.card_data1.expiry_year
+            card_info.csc = self.card_data1.csc
+            card_info.gateway = self.auth_net_gateway
+            card_info.provider = self.auth_net_gateway.provider
+            card_info.address = self.party1.addresses[0]
+            card_info.party = self.party1
+            start = len(server.requests)
+            profile = profile_wizard.transition_add_authorize_net()
+            return profile, [name for _, name in server.requests[start:]]
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+
+            profile, requests = add_card('4111111111111111', 'sync')
+            self.assertEqual(requests, [
+                'createCustomerPaymentProfileRequest',
+                'validateCustomerPaymentProfileRequest',
+            ])
+            self.assertEqual(profile.authorize_net_validation_state, 'valid')
+
+            profile, requests = add_card('4007000000027', 'create')
+            self.assertEqual(requests, [
+                'createCustomerPaymentProfileRequest',
+            ])
+            self.assertEqual(profile.authorize_net_validation_state, 'valid')
+
+            profile, requests = add_card('5424000000000015', 'none')
+            self.assertEqual(requests, [
+                'createCustomerPaymentProfileRequest',
+            ])
+            self.assertIsNone(profile.authorize_net_validation_state)
+
+            # A declined card is not stored
+            customer_id = profile.authorize_profile_id
+            payments = sorted(server.customers[customer_id]['payments'])
+            server.inject('createCustomerPaymentProfileRequest', 'declined')
+            with self.assertRaises(UserError):
+                add_card('4012888818888', 'create')
+            self.assertEqual(
+                sorted(server.customers[customer_id]['payments']), payments
+            )
+
+            valid, _ = add_card('4012888818888', 'deferred')
+            invalid, requests = add_card('6011000000000012', 'deferred')
+            self.assertEqual(requests, [
+                'createCustomerPaymentProfileRequest',
+            ])
+            self.assertEqual(invalid.authorize_net_validation_state, 'pending')
+
+            server.inject(
+                'validateCustomerPaymentProfileRequest', None
+            )
+            server.inject(
+                'validateCustomerPaymentProfileRequest', 'declined'
+            )
+            # The injected outcomes are taken in the order of the profiles
+            config.set('authorize_net', 'max_workers', '1')
+            try:
+                self.PaymentProfile.validate_authorize_net_profiles()
+            finally:
+                config.remove_option('authorize_net', 'max_workers')
+
+        self.assertEqual(
+            [(p.authorize_net_validation_state, p.active) for p in
+                self.PaymentProfile.browse([valid.id, invalid.id])],
+            [('valid', True), ('invalid', False)]
+        )
+        self.assertFalse(self.PaymentProfile.search([
+            ('authorize_net_validation_state', '=', 'pending'),
+        ]))
+
+        # The live mode is used only when asked, never on test gateways
+        gateway = self.auth_net_gateway
+        modes = []
+        for test, live in [
+                (True, False), (False, False), (True, True), (False, True)]:
+            gateway.test = test
+            gateway.authorize_net_live_validation = live
+            modes.append(gateway.get_authorize_net_validation_mode())
+        self.assertEqual(
+            modes, ['testMode', 'testMode', 'testMode', 'liveMode']
+        )
+
+    @with_transaction()
+    def test_0340_test_default_gateway(self):
+        """
+        Test that the profile methods called without gateway use the gateway
+        of the customer profile or the only authorize.net gateway
+        """
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            address = self.party2.addresses[0]
+
+            customer_id = self.party2.create_auth_profile()
+            self.assertIn(customer_id, server.customers)
+            address_id = address.send_to_authorize(customer_id)
+            self.assertIn(
+                address_id, server.customers[customer_id]['addresses']
+            )
+
+            self.PaymentGateway.create([{
+                'name': 'Other Authorize.net',
+                'journal': self.cash_journal.id,
+                'provider': 'authorize_net',
+                'method': 'credit_card',
+                'authorize_net_login': 'other-login',
+                'authorize_net_transaction_key': 'other-key',
+                'authorize_net_client_key': 'other-client-key',
+                'test': True,
+            }])
+            self.assertRaises(UserError, self.party2.create_auth_profile)
+
+            # The gateway is found from the customer profile
+            profile_id = self.payment_profile.authorize_profile_id
+            address = self.party1.addresses[0]
+            address_id = address.send_to_authorize(profile_id)
+            self.assertEqual(
+                server.customers[profile_id]['login'],
+                self.auth_net_gateway.authorize_net_login
+            )
+            self.assertIn(
+                address_id, server.customers[profile_id]['addresses']
+            )
+            address.delete_authorize_addresses(profile_id)
+
+    @with_transaction()
+    def test_0350_test_overlapping_submissions(self):
+        """
+        Test that a run of the submissions starting while another one is
+        sending the queued transactions does not send them again
+        """
+        PaymentTransaction = self.PaymentTransaction
+        map_authorize_net = PaymentTransaction._map_authorize_net
+        overridden = PaymentTransaction.__dict__.get('_map_authorize_net')
+        overlapped = []
+
+        def overlapping(func, transactions, params, name):
+            # The second run starts while the first one is sending
+            if not overlapped:
+                overlapped.append([t.state for t in transactions])
+                PaymentTransaction.process_authorize_net_submissions(
+                    commit=False
+                )
+            return map_authorize_net(func, transactions, params, name)
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            self.auth_net_gateway.authorize_net_async = True
+            self.auth_net_gateway.save()
+
+            with Transaction().set_context(company=self.company.id):
+                transactions = PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': i + 1,
+                    'credit_account': self.party1.account_receivable.id,
+                } for i in range(3)])
+                PaymentTransaction.capture(transactions)
+
+                config.set('authorize_net', 'max_workers', '1')
+                config.set('authorize_net', 'retry_base_delay', '0')
+                server.inject('createTransactionRequest', 'unavailable', 3)
+                PaymentTransaction._map_authorize_net = \
+                    staticmethod(overlapping)
+                try:
+                    PaymentTransaction.process_authorize_net_submissions(
+                        commit=False
+                    )
+                finally:
+                    if overridden is None:
+                        del PaymentTransaction._map_authorize_net
+                    else:
+                        PaymentTransaction._map_authorize_net = overridden
+                    config.remove_option('authorize_net', 'max_workers')
+                    config.remove_option('authorize_net', 'retry_base_delay')
+
+        self.assertEqual(overlapped, [['submitting'] * 3])
+        # The first transaction got no answer and is left in progress, the
+        # others were sent once
+        self.assertEqual(
+            [name for _, name in server.requests].count(
+                'createTransactionRequest'
+            ), 5
+        )
+        self.assertEqual(
+            [PaymentTransaction(t.id).state for t in transactions],
+            ['in-progress', 'posted', 'posted']
+        )
+
+    @with_transaction()
+    def test_0360_test_status_discrepancy(self):
+        """
+        Test that only the transactions waiting for authorize.net follow
+        their status and that the details without a known status are mapped
+        from their response code and type
+        """
+        AttrDict = authorize.response_parser.AttrDict
+
+        with mock_authorize_net():
+            self.setup_defaults()
+            with Transaction().set_context(company=self.company.id):
+                transactions = self.PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': i + 1,
+                    'credit_account': self.party1.account_receivable.id,
+                } for i in range(2)])
+                self.PaymentTransaction.capture_authorize_net_batch(
+                    transactions[:1]
+                )
+                self.PaymentTransaction.authorize_authorize_net_batch(
+                    transactions[1:]
+                )
+                self.assertEqual(
+                    [t.state for t in transactions], ['posted', 'authorized']
+                )
+
+                # Both voided behind the back of tryton
+                client = self.auth_net_gateway.get_authorize_client()
+                for transaction in transactions:
+                    client.transaction.void(transaction.provider_reference)
+
+                for transaction in transactions:
+                    transaction.update_authorize_net()
+                self.assertEqual(
+                    [
+                        self.PaymentTransaction(t.id).state
+                        for t in transactions
+                    ], ['posted', 'cancel']
+                )
+
+                # Nor does the batch update move them
+                self.PaymentTransaction.update_authorize_net_batch(
+                    transactions
+                )
+                self.assertEqual(
+                    [
+                        self.PaymentTransaction(t.id).state
+                        for t in transactions
+                    ], ['posted', 'cancel']
+                )
+
+        get_state = self.PaymentTransaction._get_authorize_net_details_state
+        self.assertEqual(get_state(AttrDict({
+            'response_code': '1',
+            'transaction_type': 'priorAuthCaptureTransaction',
+        })), 'completed')
+        self.assertEqual(get_state(AttrDict({
+            'response_code': '1',
+            'transaction_type': 'authorizeOnlyTransaction',
+        })), 'authorized')
+        self.assertEqual(get_state(AttrDict({
+            'response_code': '4',
+            'transaction_type': 'authCaptureTransaction',
+        })), None)
+        self.assertEqual(get_state(AttrDict({
+            'response_code': '3',
+            'transaction_type': 'authCaptureTransaction',
+        })), 'failed')
+
+        # An unknown status falls back on the response code for the
+        # transactions still waiting for authorize.net only
+        draft = self.PaymentTransaction(state='draft')
+        self.assertEqual(
+            self.PaymentTransaction._get_authorize_net_status_state(
+                'approvedReview', draft, 'completed'
+            ), 'completed'
+        )
+        failed = self.PaymentTransaction(state='failed')
+        self.assertEqual(
+            self.PaymentTransaction._get_authorize_net_status_state(
+                'settledSuccessfully', failed
+            ), 'failed'
+        )
+
+    def test_0370_test_webhook_application(self):
+        """
+        Test that the webhook answers the unknown databases and the bad
+        signatures without loading the database, and a notification
+        received concurrently as received
+        """
+        Event = POOL.get('payment_gateway.authorize_net.event')
+        body = json.dumps({
+            'notificationId': 'n1',
+            'eventType': 'net.authorize.payment.fraud.held',
+            'payload': {},
+        })
+        signature = 'sha512=' + hmac.new(
+            'S' * 128, body, hashlib.sha512
+        ).hexdigest()
+
+        def post(path, signature, method='POST'):
+            statuses = []
+            webhook.application({
+                'REQUEST_METHOD': method,
+                'PATH_INFO': path,
+                'CONTENT_LENGTH': str(len(body)),
+                'wsgi.input': StringIO(body),
+                'HTTP_X_ANET_SIGNATURE': signature,
+            }, lambda status, headers: statuses.append(status))
+            return statuses[0]
+
+        path = '/%s/1' % DB_NAME
+        self.assertEqual(post(path, signature, 'GET'), '404 Not Found')
+        self.assertEqual(post('/unknown/1', signature), '404 Not Found')
+        self.assertEqual(post(path, 'sha512=bad'), '401 Unauthorized')
+        # No authorize.net gateway has the id
+        self.assertEqual(post(path, signature), '401 Unauthorized')
+
+        def receive(gateway_id, body, signature):
+            raise backend.get('DatabaseIntegrityError')()
+
+        get_signature_key = webhook.get_signature_key
+        overridden = Event.__dict__['receive']
+        webhook.get_signature_key = lambda gateway_id: 'S' * 128
+        Event.receive = staticmethod(receive)
+        try:
+            self.assertEqual(post(path, signature), '200 OK')
+        finally:
+            Event.receive = overridden
+            webhook.get_signature_key = get_signature_key
+
+    @with_transaction()
+    def test_0380_test_unanswered_submissions(self):
+        """
+        Test that only the queued transactions which never reached
+        authorize.net are queued again, and that those without answer and
+        those left submitting are found by their invoice number or queued
+        again when authorize.net never got them
+        """
+        PaymentTransaction = self.PaymentTransaction
+        TransactionLog = POOL.get('payment_gateway.transaction.log')
+
+        with mock_authorize_net() as server:
+            self.setup_defaults()
+            self.auth_net_gateway.authorize_net_async = True
+            self.auth_net_gateway.save()
+
+            with Transaction().set_context(company=self.company.id):
+                transactions = PaymentTransaction.create([{
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'payment_profile': self.payment_profile.id,
+                    'gateway': self.auth_net_gateway.id,
+                    'amount': i + 1,
+                    'credit_account': self.party1.account_receivable.id,
+                } for i in range(5)])
+                PaymentTransaction.capture(transactions[:4])
+                # A run stopped before writing the outcome of the last one
+                PaymentTransaction.write(
+                    [transactions[3]], {'state': 'submitting'}
+                )
+
+                config.set('authorize_net', 'max_workers', '1')
+                config.set('authorize_net', 'retry_base_delay', '0')
+                # The retries of the lost capture get no answer either
+                server.inject('createTransactionRequest', 'lost')
+                server.inject('createTransactionRequest', 'unavailable', 5)
+                try:
+                    PaymentTransaction.process_authorize_net_submissions(
+                        commit=False
+                    )
+                    self.assertEqual(
+                        [PaymentTransaction(t.id).state
+                            for t in transactions[:4]],
+                        ['in-progress', 'in-progress', 'posted', 'submitting']
+                    )
+                    self.assertIsNone(
+                        PaymentTransaction(transactions[0].id)
+                        .provider_reference
+                    )
+                    log, = TransactionLog.search([
+                        ('transaction', '=', transactions[1].id),
+                    ])
+                    self.assertIn('error', log.log)
+
+                    # Nothing is resolved before the delay
+                    PaymentTransaction.process_authorize_net_submissions(
+                        commit=False
+                    )
+                    self.assertEqual(
+                        [PaymentTransaction(t.id).state
+                            for t in transactions[:4]],
+                        ['in-progress', 'in-progress', 'posted', 'submitting']
+                    )
+
+                    table = PaymentTransaction.__table__()
+                    cursor = Transaction().connection.cursor()
+                    cursor.execute(*table.update(
+                        [table.write_date],
+                        [datetime.datetime.utcnow() -
+                            datetime.timedelta(hours=1)],
+                        where=table.id.in_([t.id for t in transactions])
+                    ))
+                    PaymentTransaction.process_authorize_net_submissions(
+                        commit=False
+                    )
+                    # The lost capture is found, the others are sent again
+                    self.assertEqual(
+                        [PaymentTransaction(t.id).state
+                            for t in transactions[:4]],
+                        ['posted'] * 4
+                    )
+                    captured = [
+                        x for x in server.transactions.itervalues()
+                        if x['type'] == 'authCaptureTransaction'
+                    ]
+                    self.assertEqual(len(captured), 4)
+                    reference = PaymentTransaction(
+                        transactions[0].id
+                    ).provider_reference
+                    self.assertEqual(
+                        server.transactions[reference]['invoice_number'],
+                        transactions[0].get_authorize_net_invoice_number()
+                    )
+
+                    # A submission which could not connect is queued again
+                    closed = socket.socket()
+                    closed.bind(('127.0.0.1', 0))
+                    config.set(
+                        'authorize_net', 'test_url',
+                        'http://%s:%s/' % closed.getsockname()
+                    )
+                    closed.close()
+                    PaymentTransaction.capture(transactions[4:])
+                    PaymentTransaction.process_authorize_net_submissions(
+                        commit=False
+                    )
+                    self.assertEqual(
+                        PaymentTransaction(transactions[4].id).state,
+                        'pending-submission'
+                    )
+                finally:
+                    config.remove_option('authorize_net', 'max_workers')
+                    config.remove_option('authorize_net', 'retry_base_delay')
+
 
 def suite():
     "Define suite"
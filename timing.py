@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    timing
+
+    Timers of the phases of the authorize.net methods: building the request,
+    the round trip to the gateway, the database writes, the logs and the
+    posting.
+
+    The timings are sent to the sink set by the `timing` option of the
+    `authorize_net` section of the configuration (`memory`, `statsd` or
+    `log`) or by `set_sink`. Without sink the timers do nothing.
+
+    :license: see LICENSE for details.
+"""
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from trytond.config import config
+
+__all__ = [
+    'timer', 'get_sink', 'set_sink',
+    'MemorySink', 'StatsdSink', 'LogSink',
+]
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySink(object):
+    """
+    Keep the timings in memory, by name
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = defaultdict(list)
+
+    def add(self, name, duration):
+        with self.lock:
+            self.timings[name].append(duration)
+
+    def clear(self):
+        with self.lock:
+            self.timings.clear()
+
+    def summary(self):
+        """
+        Return a dictionary with the count, total, p50, p99 and max of the
+        durations of every name
+        """
+        with self.lock:
+            timings = dict(
+                (name, sorted(durations))
+                for name, durations in self.timings.iteritems()
+            )
+        result = {}
+        for name, durations in timings.iteritems():
+            count = len(durations)
+            result[name] = {
+                'count': count,
+                'total': sum(durations),
+                'p50': durations[int(0.50 * (count - 1))],
+                'p99': durations[int(0.99 * (count - 1))],
+                'max': durations[-1],
+            }
+        return result
+
+
+class StatsdSink(object):
+    """
+    Send the timings in milliseconds to a statsd server over UDP
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='authorize_net'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def add(self, name, duration):
+        try:
+            self.socket.sendto(
+                '%s.%s:%.3f|ms' % (self.prefix, name, duration * 1000),
+                self.address
+            )
+        except socket.error:
+            # Metrics must never break a payment
+            pass
+
+
+class LogSink(object):
+    """
+    Write a log line for every timing
+    """
+
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def add(self, name, duration):
+        self.logger.log(self.level, '%s took %.3f ms', name, duration * 1000)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class _Timer(object):
+    __slots__ = ('sink', 'name', 'start')
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.sink.add(self.name, time.time() - self.start)
+
+
+_NULL_TIMER = _NullTimer()
+_UNSET = object()
+_sink = _UNSET
+
+
+def _configure():
+    """
+    Return the sink configured in the trytond configuration file
+    """
+    kind = config.get('authorize_net', 'timing', default=None)
+    if kind == 'memory':
+        return MemorySink()
+    elif kind == 'statsd':
+        return StatsdSink(
+            config.get('authorize_net', 'statsd_host', default='localhost'),
+            config.getint('authorize_net', 'statsd_port', default=8125),
+            config.get(
+                'authorize_net', 'statsd_prefix', default='authorize_net'
+            ),
+        )
+    elif kind == 'log':
+        return LogSink()
+    return None
+
+
+def get_sink():
+    """
+    Return the sink of the timings, None if timing is disabled
+    """
+    global _sink
+    if _sink is _UNSET:
+        _sink = _configure()
+    return _sink
+
+
+def set_sink(sink):
+    """
+    Send the timings to the sink, an object with an `add(name, duration)`
+    method, or disable timing with None
+    """
+    global _sink
+    _sink = sink
+
+
+def timer(name):
+    """
+    Return a context manager timing its block under the name
+    """
+    sink = _sink
+    if sink is _UNSET:
+        sink = get_sink()
+    if sink is None:
+        return _NULL_TIMER
+    return _Timer(sink, name)
@@ -1,16 +1,86 @@
 # -*- coding: utf-8 -*-
+import base64
+import datetime
+import logging
+import zlib
+from collections import defaultdict
+from decimal import Decimal
+from itertools import islice
+
+import yaml
 import authorize
+from sql.functions import CurrentTimestamp
 from authorize.exceptions import AuthorizeInvalidError, \
     AuthorizeResponseError
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
-from trytond.model import fields
+from trytond.model import ModelView, fields
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .breaker import CircuitOpenError
+from .client import AuthorizeNotSentError, get_client, drop_client
+from .timing import timer
+from .utils import map_concurrently
 
 __all__ = [
-    'PaymentGatewayAuthorize', 'AddPaymentProfile', 'AuthorizeNetTransaction'
+    'PaymentGatewayAuthorize', 'AddPaymentProfile', 'AuthorizeNetTransaction',
+    'TransactionLog',
 ]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+AUTHORIZE_NET_CREDENTIALS = {
+    'authorize_net_login', 'authorize_net_transaction_key', 'test',
+}
+
+# Fields of the responses kept by the compact logs
+COMPACT_LOG_FIELDS = (
+    'trans_id', 'response_code', 'transaction_status', 'auth_code',
+    'avs_result_code', 'cvv_result_code',
+)
+
+# States of the transactions from the statuses given by authorize.net, the
+# transactions with another status are left alone
+AUTHORIZE_NET_STATUS_STATES = {
+    'authorizedPendingCapture': 'authorized',
+    'capturedPendingSettlement': 'completed',
+    'settledSuccessfully': 'completed',
+    'refundPendingSettlement': 'completed',
+    'refundSettledSuccessfully': 'completed',
+    'FDSPendingReview': 'in-progress',
+    'FDSAuthorizedPendingReview': 'in-progress',
+    'underReview': 'in-progress',
+    'voided': 'cancel',
+    'expired': 'cancel',
+    'declined': 'failed',
+    'failedReview': 'failed',
+    'generalError': 'failed',
+    'communicationError': 'failed',
+    'settlementError': 'failed',
+}
+
+# States of the transactions which can still follow their status at
+# authorize.net, a change of the others is a discrepancy left to an operator
+AUTHORIZE_NET_UPDATABLE_STATES = (
+    'draft', 'in-progress', 'authorized', 'pending-submission',
+)
+
+# Validation state of the payment profiles added by validation policy
+VALIDATION_STATES = {
+    'sync': 'valid',
+    'create': 'valid',
+    'deferred': 'pending',
+    'none': None,
+}
+
+# Statuses of the unsettled transactions which can be voided
+VOIDABLE_STATUSES = ('authorizedPendingCapture', 'capturedPendingSettlement')
+
 
 class PaymentGatewayAuthorize:
     "Authorize.net Gateway Implementation"
@@ -37,6 +107,72 @@ class PaymentGatewayAuthorize:
             'readonly': ~Eval('active', True),
         }, depends=['provider', 'active']
     )
+    authorize_net_async = fields.Boolean(
+        'Asynchronous Submission', states={
+            'invisible': Eval('provider') != 'authorize_net',
+            'readonly': ~Eval('active', True),
+        }, depends=['provider', 'active'],
+        help='Queue the authorizations and captures made with a payment '
+        'profile, they are sent to Authorize.net by a scheduled task.'
+    )
+    authorize_net_validation = fields.Selection([
+        ('sync', 'Synchronous'),
+        ('create', 'On Creation'),
+        ('deferred', 'Deferred'),
+        ('none', 'None'),
+    ], 'Card Validation', states={
+        'required': Eval('provider') == 'authorize_net',
+        'invisible': Eval('provider') != 'authorize_net',
+        'readonly': ~Eval('active', True),
+    }, depends=['provider', 'active'],
+        help='How the cards added are validated by Authorize.net: with a '
+        'second call, within the call storing the card, later by a '
+        'scheduled task, or not at all.'
+    )
+    authorize_net_live_validation = fields.Boolean(
+        'Live Validation', states={
+            'invisible': Eval('provider') != 'authorize_net',
+            'readonly': ~Eval('active', True),
+        }, depends=['provider', 'active'],
+        help='Validate the cards with a $0 or $0.01 authorization instead '
+        'of the test mode, which only checks the card number and expiration '
+        'date. Test gateways always use the test mode.'
+    )
+    authorize_net_signature_key = fields.Char(
+        'Signature Key', states={
+            'invisible': Eval('provider') != 'authorize_net',
+            'readonly': ~Eval('active', True),
+        }, depends=['provider', 'active'],
+        help='The key with which Authorize.net signs the webhook '
+        'notifications.'
+    )
+    authorize_net_breaker_state = fields.Function(
+        fields.Selection([
+            (None, ''),
+            ('closed', 'Closed'),
+            ('open', 'Open'),
+            ('half-open', 'Half Open'),
+        ], 'Circuit Breaker', states={
+            'invisible': Eval('provider') != 'authorize_net',
+        }, depends=['provider'],
+            help='Open when Authorize.net fails or is slow: the calls fail '
+            'at once and the transactions made with a payment profile are '
+            'queued. Every server process has its own breaker, this is the '
+            'state in the process which answered.'),
+        'get_authorize_net_breaker_state'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentGatewayAuthorize, cls).__setup__()
+        cls._error_messages.update({
+            'authorize_net_gateway_required': 'The Authorize.net gateway '
+            'must be given as there is more than one.',
+        })
+
+    @staticmethod
+    def default_authorize_net_validation():
+        return 'sync'
 
     @classmethod
     def view_attributes(cls):
@@ -63,17 +199,102 @@ class PaymentGatewayAuthorize:
             ]
         return super(PaymentGatewayAuthorize, self).get_methods()
 
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        to_drop = []
+        for gateways, values in zip(actions, actions):
+            if AUTHORIZE_NET_CREDENTIALS & set(values):
+                to_drop.extend(gateways)
+        super(PaymentGatewayAuthorize, cls).write(*args)
+        for gateway in to_drop:
+            drop_client(gateway._get_authorize_client_key())
+
+    @classmethod
+    def delete(cls, gateways):
+        keys = [g._get_authorize_client_key() for g in gateways]
+        super(PaymentGatewayAuthorize, cls).delete(gateways)
+        for key in keys:
+            drop_client(key)
+
+    def _get_authorize_client_key(self):
+        return (Transaction().database.name, self.id)
+
     def get_authorize_client(self):
         """
         Return an authenticated authorize.net client.
+
+        The client is kept for the gateway, so that its connections are
+        reused, until the credentials of the gateway change. It does not
+        use the global configuration of the authorize package, so clients
+        of different gateways can be used at the same time.
         """
         assert self.provider == 'authorize_net', 'Invalid provider'
-        authorize.Configuration.configure(
-            authorize.Environment.TEST if self.test else authorize.Environment.PRODUCTION,  # noqa
+        return get_client(
+            self._get_authorize_client_key(),
+            self.get_authorize_net_environment(),
             self.authorize_net_login,
             self.authorize_net_transaction_key,
         )
 
+    @classmethod
+    def get_default_authorize_net_gateway(cls, customer_id=None):
+        """
+        Return the gateway of the methods called without one, like before
+        every gateway had its own client: the gateway of the customer
+        profile when it is known, otherwise the only authorize.net gateway.
+        """
+        pool = Pool()
+        PaymentProfile = pool.get('party.payment_profile')
+        Customer = pool.get('party.authorize_net.customer')
+
+        if customer_id:
+            records = PaymentProfile.search([
+                ('authorize_profile_id', '=', customer_id),
+            ], limit=1) or Customer.search([
+                ('customer_id', '=', customer_id),
+            ], limit=1)
+            if records:
+                return records[0].gateway
+        gateways = cls.search([
+            ('provider', '=', 'authorize_net'),
+        ], limit=2)
+        if len(gateways) != 1:
+            cls.raise_user_error('authorize_net_gateway_required')
+        return gateways[0]
+
+    def get_authorize_net_validation_mode(self):
+        """
+        Return the validation mode of the cards added to the gateway
+        """
+        if self.authorize_net_live_validation and not self.test:
+            return 'liveMode'
+        return 'testMode'
+
+    def get_authorize_net_breaker_state(self, name=None):
+        """
+        Return the state of the circuit breaker of the gateway in this
+        process
+        """
+        if self.provider != 'authorize_net' or not self.id or self.id < 0:
+            return None
+        return self.get_authorize_client().breaker.get_state()
+
+    def get_authorize_net_environment(self):
+        """
+        Return the URL of the authorize.net API used by the gateway.
+
+        The URL of the test environment can be changed with the `test_url`
+        option of the `authorize_net` section of the configuration, for
+        example to use a local mock server.
+        """
+        if self.test:
+            return config.get(
+                'authorize_net', 'test_url',
+                default=authorize.Environment.TEST
+            )
+        return authorize.Environment.PRODUCTION
+
 
 class AuthorizeNetTransaction:
     """
@@ -81,6 +302,22 @@ class AuthorizeNetTransaction:
     """
     __name__ = 'payment_gateway.transaction'
 
+    authorize_net_submission = fields.Selection([
+        (None, ''),
+        ('authorize', 'Authorize'),
+        ('capture', 'Capture'),
+    ], 'Authorize.net Submission', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(AuthorizeNetTransaction, cls).__register__(module_name)
+
+        # The stale authorizations are searched by state and date
+        table = TableHandler(cls, module_name)
+        table.index_action(['state', 'date'], action='add')
+
     @classmethod
     def __setup__(cls):
         super(AuthorizeNetTransaction, cls).__setup__()
@@ -88,129 +325,343 @@ class AuthorizeNetTransaction:
         cls._error_messages.update({
             'cancel_only_authorized': 'Only authorized transactions can be' + (
                 ' cancelled.'),
+            'authorize_net_unavailable': 'Authorize.net is temporarily '
+            'unavailable, please try again in a few minutes.',
+            'refund_not_settled': 'Refund "%s" can be sent once its origin '
+            'is settled by Authorize.net, only the whole amount can be '
+            'refunded before.',
+            'refund_failed': 'The following refunds got no answer from '
+            'Authorize.net, they are looked up at Authorize.net before '
+            'being sent again:\n%s',
         })
+        # The transactions are matched on their reference by the status
+        # updates and the reconciliation
+        cls.provider_reference.select = True
+        for state in [
+                ('pending-submission', 'Pending Submission'),
+                ('submitting', 'Submitting')]:
+            if state not in cls.state.selection:
+                cls.state.selection.append(state)
+        cls._transitions |= set((
+            ('draft', 'pending-submission'),
+            ('pending-submission', 'in-progress'),
+            ('pending-submission', 'failed'),
+            ('pending-submission', 'authorized'),
+            ('pending-submission', 'completed'),
+            ('pending-submission', 'cancel'),
+            ('pending-submission', 'submitting'),
+            ('submitting', 'pending-submission'),
+            ('submitting', 'in-progress'),
+            ('submitting', 'failed'),
+            ('submitting', 'authorized'),
+            ('submitting', 'completed'),
+            ('in-progress', 'pending-submission'),
+            ('in-progress', 'draft'),
+        ))
+        cls._buttons['cancel']['invisible'] = ~Eval('state').in_([
+            'in-progress', 'authorized', 'pending-submission'
+        ])
+
+    def _queue_authorize_net(self, submission):
+        """
+        Queue the transaction, instead of sending it now, if it uses a
+        payment profile and its gateway submits asynchronously or its
+        circuit breaker is open. The card information can not be stored, so
+        transactions paid with a card are always sent at once.
+
+        Returns True if the transaction was queued.
+        """
+        if not self.payment_profile:
+            return False
+        if not self.gateway.authorize_net_async and \
+                self.gateway.get_authorize_net_breaker_state() != 'open':
+            return False
+        self.state = 'pending-submission'
+        self.authorize_net_submission = submission
+        self.save()
+        return True
 
     def authorize_authorize_net(self, card_info=None):
         """
         Authorize using authorize.net for the specific transaction.
+
+        If the gateway submits asynchronously, a transaction using a payment
+        profile is only queued.
         """
-        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        if not card_info and self._queue_authorize_net('authorize'):
+            return
 
         # Initialize authorize client
-        self.gateway.get_authorize_client()
+        client = self.gateway.get_authorize_client()
 
-        auth_data = self.get_authorize_net_request_data()
-        if card_info:
-            billing_address = self.address.get_authorize_address(
-                card_info.owner)
-            shipping_address = {}
-            if self.shipping_address:
-                shipping_address = self.shipping_address.get_authorize_address(
-                    card_info.owner)
-
-            auth_data.update({
-                'email': self.party.email,
-                'credit_card': {
-                    'card_number': card_info.number,
-                    'card_code': str(card_info.csc),
-                    'expiration_date': "%s/%s" % (
-                        card_info.expiry_month, card_info.expiry_year
-                    ),
-                },
-                'billing': billing_address,
-                'shipping': shipping_address,
-            })
-
-        elif self.payment_profile:
-            if self.shipping_address:
-                if self.shipping_address.authorize_id:
-                    address_id = self.shipping_address.authorize_id
-                else:
-                    address_id = self.shipping_address.send_to_authorize(
-                        self.payment_profile.authorize_profile_id)
-            else:
-                if self.address.authorize_id:
-                    address_id = self.address.authorize_id
-                else:
-                    address_id = self.address.send_to_authorize(
-                        self.payment_profile.authorize_profile_id)
-            auth_data.update({
-                'customer_id': self.payment_profile.authorize_profile_id,
-                'payment_id': self.payment_profile.provider_reference,
-                'shipping_id': address_id,
-            })
-        else:
-            self.raise_user_error('no_card_or_profile')
+        with timer('authorize_authorize_net.request'):
+            auth_data = self._get_authorize_net_payload(card_info)
 
         try:
-            result = authorize.Transaction.auth(auth_data)
+            with timer('authorize_authorize_net.gateway'):
+                result = client.transaction.auth(auth_data)
         except AuthorizeResponseError as exc:
             self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.full_response)
+            self._save_authorize_net_response(
+                'authorize_authorize_net', exc.full_response
+            )
         else:
-            # Following response codes are given:
-            # 1 -- Approved
-            # 2 -- Declined
-            # 3 -- Error
-            # 4 -- Held for Review
             self.provider_reference = str(result.transaction_response.trans_id)
             self.last_four_digits = card_info.number[-4:] if card_info else \
                 self.payment_profile.last_4_digits
-            if result.transaction_response.response_code == '1':
-                self.state = 'authorized'
-            elif result.transaction_response.response_code == '4':
-                self.state = 'in-progress'
-            else:
-                self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, result)
+            self.state = self._get_authorize_net_state(
+                result.transaction_response.response_code, 'authorized'
+            )
+            self._save_authorize_net_response(
+                'authorize_authorize_net', result
+            )
 
     def settle_authorize_net(self):
         """
         Settles this transaction if it is a previous authorization.
         """
-        TransactionLog = Pool().get('payment_gateway.transaction.log')
-
         # Initialize authorize.net client
-        self.gateway.get_authorize_client()
+        client = self.gateway.get_authorize_client()
 
         try:
-            result = authorize.Transaction.settle(
-                self.provider_reference, self.amount
-            )
+            with timer('settle_authorize_net.gateway'):
+                result = client.transaction.settle(
+                    self.provider_reference, self.amount
+                )
         except AuthorizeResponseError as exc:
             self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.full_response)
+            self._save_authorize_net_response(
+                'settle_authorize_net', exc.full_response
+            )
         else:
-            # Following response codes are given:
-            # 1 -- Approved
-            # 2 -- Declined
-            # 3 -- Error
-            # 4 -- Held for Review
             self.provider_reference = str(result.transaction_response.trans_id)
-            if result.transaction_response.response_code == '1':
-                self.state = 'completed'
-            elif result.transaction_response.response_code == '4':
-                self.state = 'in-progress'
-            else:
-                self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, result)
+            self.state = self._get_authorize_net_state(
+                result.transaction_response.response_code, 'completed'
+            )
+            self._save_authorize_net_response('settle_authorize_net', result)
             if self.state == 'completed':
-                self.safe_post()
+                with timer('settle_authorize_net.post'):
+                    self.safe_post()
 
     def capture_authorize_net(self, card_info=None):
         """
         Capture using authorize.net for the specific transaction.
+
+        If the gateway submits asynchronously, a transaction using a payment
+        profile is only queued.
         """
-        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        if not card_info and self._queue_authorize_net('capture'):
+            return
 
         # Initialize authorize client
-        self.gateway.get_authorize_client()
+        client = self.gateway.get_authorize_client()
+
+        with timer('capture_authorize_net.request'):
+            capture_data = self._get_authorize_net_payload(card_info)
+
+        try:
+            with timer('capture_authorize_net.gateway'):
+                result = client.transaction.sale(capture_data)
+        except AuthorizeResponseError as exc:
+            self.state = 'failed'
+            self._save_authorize_net_response(
+                'capture_authorize_net', exc.full_response
+            )
+        else:
+            self.provider_reference = str(result.transaction_response.trans_id)
+            self.last_four_digits = card_info.number[-4:] if card_info else \
+                self.payment_profile.last_4_digits
+            self.state = self._get_authorize_net_state(
+                result.transaction_response.response_code, 'completed'
+            )
+            self._save_authorize_net_response('capture_authorize_net', result)
+            if self.state == 'completed':
+                with timer('capture_authorize_net.post'):
+                    self.safe_post()
+
+    def retry_authorize_net(self, credit_card=None):  # pragma: no cover
+        """
+        Authorize using Authorize.net for the specific transaction.
+
+        :param credit_card: An instance of CreditCardView
+        """
+        raise self.raise_user_error('feature_not_available')
+
+    def update_authorize_net(self):
+        """
+        Update the status of the transaction from Authorize.net
+        """
+        client = self.gateway.get_authorize_client()
+        with timer('update_authorize_net.gateway'):
+            result = client.transaction.details(self.provider_reference)
+        self.state = self._get_authorize_net_status_state(
+            result.transaction.transaction_status, self,
+            self._get_authorize_net_details_state(result.transaction)
+        )
+        self._save_authorize_net_response('update_authorize_net', result)
+        if self.state == 'completed':
+            with timer('update_authorize_net.post'):
+                self.safe_post()
+
+    def cancel_authorize_net(self):
+        """
+        Cancel this authorization or request
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        if self.state == 'pending-submission':
+            # Nothing was sent to authorize.net yet
+            self.state = 'cancel'
+            self.save()
+            return
+
+        if self.state != 'authorized':
+            self.raise_user_error('cancel_only_authorized')
+
+        # Initialize authurize.net client
+        client = self.gateway.get_authorize_client()
+
+        # Try to void the transaction
+        try:
+            with timer('cancel_authorize_net.gateway'):
+                result = client.transaction.void(self.provider_reference)
+        except CircuitOpenError:
+            self.raise_user_error('authorize_net_unavailable')
+        except AuthorizeResponseError as exc:
+            with timer('cancel_authorize_net.log'):
+                TransactionLog.create_authorize_net_logs([
+                    (self, exc.full_response)
+                ])
+        else:
+            self.state = 'cancel'
+            self._save_authorize_net_response('cancel_authorize_net', result)
+
+    @classmethod
+    def cancel_authorize_net_batch(cls, transactions):
+        """
+        Void the given authorizations, those in another state are ignored.
+        The calls are sent concurrently, paced by the rate limit of the
+        client, and the outcome is written back in bulk. A void refused by
+        authorize.net is logged and leaves the transaction authorized.
+
+        Returns the number of transactions `voided` and `refused` and the
+        list of `(transaction, exception)` for the calls which got no
+        answer.
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        name = 'cancel_authorize_net_batch'
+
+        transactions = [t for t in transactions if t.state == 'authorized']
+        outcomes = cls._map_authorize_net(
+            lambda client, reference: client.transaction.void(reference),
+            transactions, [t.provider_reference for t in transactions],
+            name
+        )
+        voided, logs, failures = [], [], []
+        refused = 0
+        for transaction, (result, exc) in outcomes:
+            if isinstance(exc, AuthorizeResponseError):
+                refused += 1
+                logs.append((transaction, exc.full_response))
+            elif exc is not None:
+                failures.append((transaction, exc))
+            else:
+                voided.append(transaction)
+                logs.append((transaction, result))
+        if voided:
+            with timer('%s.save' % name):
+                cls.write(voided, {'state': 'cancel'})
+        if logs:
+            with timer('%s.log' % name):
+                TransactionLog.create_authorize_net_logs(logs)
+        return {'voided': len(voided), 'refused': refused}, failures
 
-        capture_data = self.get_authorize_net_request_data()
+    @classmethod
+    def void_stale_authorize_net_authorizations(cls, batch_size=1000):
+        """
+        Void the authorizations made with authorize.net more than
+        `stale_authorization_days` days ago, an option of the
+        `authorize_net` section of the configuration, 30 by default. It is
+        called by a scheduled task and reports the counts in the log.
+        """
+        Date = Pool().get('ir.date')
+
+        days = config.getint(
+            'authorize_net', 'stale_authorization_days', default=30
+        )
+        domain = [
+            ('state', '=', 'authorized'),
+            ('date', '<', Date.today() - datetime.timedelta(days=days)),
+            ('gateway.provider', '=', 'authorize_net'),
+        ]
+        report = {'voided': 0, 'refused': 0, 'failed': 0}
+        last_id = 0
+        while True:
+            transactions = cls.search(
+                domain + [('id', '>', last_id)], order=[('id', 'ASC')],
+                limit=batch_size
+            )
+            if not transactions:
+                break
+            counts, failures = cls.cancel_authorize_net_batch(transactions)
+            report['voided'] += counts['voided']
+            report['refused'] += counts['refused']
+            report['failed'] += len(failures)
+            for transaction, exc in failures:
+                logger.warning(
+                    'Void of transaction %s to authorize.net failed: %s',
+                    transaction.id, exc
+                )
+            last_id = transactions[-1].id
+        logger.info(
+            'Stale authorize.net authorizations: %(voided)s voided, '
+            '%(refused)s refused, %(failed)s without answer', report
+        )
+        return report
+
+    def get_authorize_net_request_data(self):
+        """
+        Downstream modules can modify this method to send extra data to
+        authorize.net
+
+        Ref: http://vcatalano.github.io/py-authorize/transaction.html
+        """
+        return {
+            'amount': self.amount
+        }
+
+    def _save_authorize_net_response(self, method, response):
+        """
+        Save the transaction and log the response of authorize.net, timing
+        both under the name of the method
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        with timer('%s.save' % method):
+            self.save()
+        with timer('%s.log' % method):
+            TransactionLog.create_authorize_net_logs([(self, response)])
+
+    def get_authorize_net_invoice_number(self):
+        """
+        Return the invoice number sent with the transaction, by which the
+        transaction is found at authorize.net when its call got no answer.
+
+        The id is prefixed to the UUID as the transactions created together
+        get the same UUID. Downstream modules which send their own invoice
+        number must return it here.
+        """
+        return '%s-%s' % (self.id, self.uuid.replace('-', '')[:10])
+
+    def _get_authorize_net_payload(self, card_info=None):
+        """
+        Return the data sent to authorize.net to authorize or capture this
+        transaction, either with the given card or with the payment profile.
+        """
+        data = self.get_authorize_net_request_data()
+        data.setdefault('order', {}).setdefault(
+            'invoice_number', self.get_authorize_net_invoice_number()
+        )
         if card_info:
             billing_address = self.address.get_authorize_address(
                 card_info.owner)
@@ -219,7 +670,7 @@ class AuthorizeNetTransaction:
                 shipping_address = self.shipping_address.get_authorize_address(
                     card_info.owner)
 
-            capture_data.update({
+            data.update({
                 'email': self.party.email,
                 'credit_card': {
                     'card_number': card_info.number,
@@ -238,131 +689,819 @@ class AuthorizeNetTransaction:
                     address_id = self.shipping_address.authorize_id
                 else:
                     address_id = self.shipping_address.send_to_authorize(
-                        self.payment_profile.authorize_profile_id)
+                        self.payment_profile.authorize_profile_id,
+                        self.gateway)
             else:
                 if self.address.authorize_id:
                     address_id = self.address.authorize_id
                 else:
                     address_id = self.address.send_to_authorize(
-                        self.payment_profile.authorize_profile_id)
-            capture_data.update({
+                        self.payment_profile.authorize_profile_id,
+                        self.gateway)
+            data.update({
                 'customer_id': self.payment_profile.authorize_profile_id,
                 'payment_id': self.payment_profile.provider_reference,
                 'shipping_id': address_id,
             })
         else:
             self.raise_user_error('no_card_or_profile')
+        return data
+
+    @classmethod
+    def get_authorize_net_payloads(cls, transactions):
+        """
+        Return the data sent to authorize.net for each of the transactions,
+        which must use a payment profile.
+
+        The transactions are browsed together so that reading a field of
+        one of them reads it for all, which loads their gateways, parties,
+        addresses and payment profiles in bulk. The addresses still to send
+        to authorize.net are built at once with their parties, countries and
+        subdivisions.
+        """
+        Address = Pool().get('party.address')
+
+        transactions = cls.browse([t.id for t in transactions])
+        with timer('get_authorize_net_payloads.prefetch'):
+            Address.get_authorize_addresses([
+                t.shipping_address or t.address for t in transactions
+                if t.payment_profile and not (
+                    t.shipping_address or t.address
+                ).authorize_id
+            ])
+        return [t._get_authorize_net_payload() for t in transactions]
+
+    @staticmethod
+    def _get_authorize_net_state(response_code, approved_state):
+        """
+        Return the state of a transaction from the response code given by
+        authorize.net:
+
+            1 -- Approved
+            2 -- Declined
+            3 -- Error
+            4 -- Held for Review
+        """
+        if response_code == '1':
+            return approved_state
+        elif response_code == '4':
+            return 'in-progress'
+        return 'failed'
+
+    @classmethod
+    def authorize_authorize_net_batch(cls, transactions):
+        """
+        Authorize the given transactions, which must use a payment profile.
+
+        The calls are sent like in `capture_authorize_net_batch`.
+        """
+        name = 'authorize_authorize_net_batch'
+        with timer('%s.request' % name):
+            payloads = cls.get_authorize_net_payloads(transactions)
+        return cls._apply_authorize_net_outcomes(
+            cls._map_authorize_net(
+                lambda client, payload: client.transaction.auth(payload),
+                transactions, payloads, name
+            ), 'authorized', name
+        )
+
+    @classmethod
+    def capture_authorize_net_batch(cls, transactions):
+        """
+        Capture the given transactions, which must use a payment profile.
+
+        The calls to authorize.net are sent concurrently, at most
+        `max_workers` at a time, and the outcome is written back in bulk.
+
+        Returns the list of `(transaction, exception)` for the calls which
+        got no answer from authorize.net. Those transactions are left
+        untouched as it is not known whether they were charged or not.
+        """
+        name = 'capture_authorize_net_batch'
+        with timer('%s.request' % name):
+            payloads = cls.get_authorize_net_payloads(transactions)
+        return cls._apply_authorize_net_outcomes(
+            cls._map_authorize_net(
+                lambda client, payload: client.transaction.sale(payload),
+                transactions, payloads, name
+            ), 'completed', name
+        )
+
+    @classmethod
+    def settle_authorize_net_batch(cls, transactions):
+        """
+        Settle the given authorizations. Transactions which are not
+        authorized are ignored.
+
+        The calls to authorize.net are sent concurrently and the outcome is
+        written back in bulk, a failing settlement does not stop the others.
+
+        Returns the list of `(transaction, exception)` for the calls which
+        got no answer from authorize.net.
+        """
+        transactions = [t for t in transactions if t.state == 'authorized']
+        name = 'settle_authorize_net_batch'
+        return cls._apply_authorize_net_outcomes(
+            cls._map_authorize_net(
+                lambda client, params: client.transaction.settle(*params),
+                transactions,
+                [(t.provider_reference, t.amount) for t in transactions],
+                name
+            ), 'completed', name
+        )
+
+    @classmethod
+    def process_authorize_net_submissions(cls, commit=True):
+        """
+        Send the transactions queued by the gateways which submit
+        asynchronously. It is called by a scheduled task and the calls are
+        sent by a pool of `max_workers` threads.
+
+        The transactions are claimed first, see
+        `_claim_authorize_net_submissions`, so that runs working at the same
+        time never send a transaction twice. With `commit` the claim is
+        committed before any call to authorize.net.
+
+        Only the transactions which never reached authorize.net, as the
+        circuit breaker was open or no connection could be opened, are
+        queued again. The others got no answer and may have been processed:
+        they are left in progress until `resolve_authorize_net_unanswered`
+        finds them at authorize.net.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
 
         try:
-            result = authorize.Transaction.sale(capture_data)
-        except AuthorizeResponseError as exc:
-            self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.full_response)
-        else:
-            # Following response codes are given:
-            # 1 -- Approved
-            # 2 -- Declined
-            # 3 -- Error
-            # 4 -- Held for Review
-            self.provider_reference = str(result.transaction_response.trans_id)
-            self.last_four_digits = card_info.number[-4:] if card_info else \
-                self.payment_profile.last_4_digits
-            if result.transaction_response.response_code == '1':
-                self.state = 'completed'
-            elif result.transaction_response.response_code == '4':
-                self.state = 'in-progress'
-            else:
-                self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, result)
-            if self.state == 'completed':
-                self.safe_post()
+            cls.resolve_authorize_net_unanswered()
+            transactions = cls._claim_authorize_net_submissions()
+        except DatabaseOperationalError:
+            if not commit:
+                raise
+            transactions = None
+        if transactions is None:
+            if commit:
+                Transaction().rollback()
+            logger.info(
+                'Queued authorize.net transactions claimed by another run'
+            )
+            return
+        if commit:
+            Transaction().commit()
 
-    def retry_authorize_net(self, credit_card=None):  # pragma: no cover
+        by_submission = defaultdict(list)
+        for transaction in transactions:
+            by_submission[transaction.authorize_net_submission].append(
+                transaction
+            )
+        failures = []
+        if by_submission['authorize']:
+            failures.extend(cls.authorize_authorize_net_batch(
+                by_submission['authorize']
+            ))
+        if by_submission['capture']:
+            failures.extend(cls.capture_authorize_net_batch(
+                by_submission['capture']
+            ))
+        for transaction, exc in failures:
+            logger.warning(
+                'Submission of transaction %s to authorize.net failed: %s',
+                transaction.id, exc
+            )
+        not_sent = [
+            t for t, exc in failures
+            if isinstance(exc, (CircuitOpenError, AuthorizeNotSentError))
+        ]
+        if not_sent:
+            cls.write(not_sent, {'state': 'pending-submission'})
+        cls._set_authorize_net_unanswered([
+            (t, exc) for t, exc in failures if t not in not_sent
+        ], 'process_authorize_net_submissions')
+
+    @classmethod
+    def _set_authorize_net_unanswered(cls, failures, name):
         """
-        Authorize using Authorize.net for the specific transaction.
+        Move the transactions whose call got no answer from authorize.net
+        in progress and log the error, as it is not known whether they were
+        processed
 
-        :param credit_card: An instance of CreditCardView
+        :param failures: List of `(transaction, exception)`
+        :param name: Name under which the phases are timed
         """
-        raise self.raise_user_error('feature_not_available')
+        by_state = defaultdict(list)
+        for transaction, _ in failures:
+            by_state['in-progress'].append(transaction)
+        cls._set_authorize_net_states(by_state, [
+            (transaction, {'error': unicode(exc)})
+            for transaction, exc in failures
+        ], name)
 
-    def update_authorize_net(self):  # pragma: no cover
+    @classmethod
+    def resolve_authorize_net_unanswered(cls):
         """
-        Update the status of the transaction from Authorize.net
+        Resolve the transactions whose outcome at authorize.net is unknown:
+        those in progress without reference, whose call got no answer, and
+        those left submitting by a run which stopped before writing the
+        outcome. Only the transactions unchanged for the `unanswered_delay`
+        seconds of the `authorize_net` section, 900 by default, are
+        resolved, so that authorize.net lists them and the running
+        submissions are left alone.
+
+        The transactions are searched at authorize.net by their invoice
+        number with `update_authorize_net_batch`. Those not found were never
+        processed: the submissions are queued again and the others are
+        reset to draft.
+        """
+        name = 'resolve_authorize_net_unanswered'
+
+        delay = config.getint(
+            'authorize_net', 'unanswered_delay', default=900
+        )
+        before = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=delay
+        )
+        transactions = cls.search([
+            ('gateway.provider', '=', 'authorize_net'),
+            ('provider_reference', '=', None),
+            ('state', 'in', ['in-progress', 'submitting']),
+            ('write_date', '<', before),
+        ])
+        if not transactions:
+            return
+        submitting = [t for t in transactions if t.state == 'submitting']
+        if submitting:
+            logger.warning(
+                'Transactions %s left submitting to authorize.net',
+                ', '.join(str(t.id) for t in submitting)
+            )
+            cls._set_authorize_net_unanswered([
+                (t, 'Left submitting') for t in submitting
+            ], name)
+
+        by_state = defaultdict(list)
+        for transaction in cls.update_authorize_net_batch(
+                cls.browse(transactions)):
+            by_state[
+                'pending-submission' if transaction.authorize_net_submission
+                else 'draft'
+            ].append(transaction)
+        cls._set_authorize_net_states(by_state, [
+            (t, {'error': 'Not found at authorize.net'})
+            for records in by_state.itervalues() for t in records
+        ], name)
+
+    @classmethod
+    def _claim_authorize_net_submissions(cls):
+        """
+        Move the queued transactions to the submitting state and return
+        them, or None when another run claimed some of them meanwhile.
+
+        The rows are claimed by an update conditioned on their state, so
+        only the claimed rows are locked. The database refuses, or does not
+        count, the update of a row claimed by a concurrent run.
+        """
+        transaction = Transaction()
+        table = cls.__table__()
+        cursor = transaction.connection.cursor()
+
+        ids = [t.id for t in cls.search([
+            ('state', '=', 'pending-submission'),
+        ], order=[('id', 'ASC')])]
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.update(
+                [table.state, table.write_uid, table.write_date],
+                ['submitting', transaction.user, CurrentTimestamp()],
+                where=reduce_ids(table.id, sub_ids) &
+                (table.state == 'pending-submission')
+            ))
+            if cursor.rowcount != len(sub_ids):
+                return None
+        # The records read before the update are not read from the cache
+        for cache in transaction.cache.itervalues():
+            if cls.__name__ in cache:
+                for id_ in ids:
+                    cache[cls.__name__].pop(id_, None)
+        return cls.browse(ids)
+
+    @classmethod
+    def _map_authorize_net(cls, func, transactions, params, name):
+        """
+        Call `func` with the client of the gateway and the params of every
+        transaction. The calls are sent concurrently, whatever their gateway,
+        and each of them is timed under `name`.
+
+        :return: List of `(transaction, (result, exception))`
+        """
+        # Initialize authorize clients
+        clients = dict(
+            (t.gateway.id, t.gateway.get_authorize_client())
+            for t in transactions
+        )
+
+        def call(item):
+            gateway_id, params = item
+            with timer('%s.gateway' % name):
+                return func(clients[gateway_id], params)
+
+        return zip(transactions, map_concurrently(
+            call, [(t.gateway.id, p) for t, p in zip(transactions, params)]
+        ))
+
+    @classmethod
+    def _apply_authorize_net_outcomes(cls, outcomes, approved_state, name):
+        """
+        Write the states and logs of a batch of transactions from the
+        outcomes of their calls to authorize.net, and post the completed
+        ones.
+
+        :param outcomes: List of `(transaction, (result, exception))`
+        :param approved_state: State of the approved transactions
+        :param name: Name under which the phases are timed
+        :return: List of `(transaction, exception)` for the calls which did
+            not get an answer from authorize.net
         """
         TransactionLog = Pool().get('payment_gateway.transaction.log')
-        result = authorize.Transaction.details(self.provider_reference)
-        if result.transaction.response_code == '1':
-            if result.transaction.transaction_type in (
-                    'authCaptureTransaction', 'priorAuthCaptureTransaction'
-            ):
-                self.state = 'completed'
-            elif result.transaction.transaction_type == 'authorizeOnlyTransaction':  # noqa
-                self.state = 'authorized'
-        elif result.transaction.response_code == '4':
-            pass
-        else:
-            self.state = 'failed'
-        self.save()
-        TransactionLog.serialize_and_create(self, result)
-        if self.state == 'completed':
-            self.safe_post()
 
-    def cancel_authorize_net(self):
+        by_state = defaultdict(list)
+        references = []
+        logs = []
+        failures = []
+        for transaction, (result, exc) in outcomes:
+            if isinstance(exc, AuthorizeResponseError):
+                by_state['failed'].append(transaction)
+                logs.append((transaction, exc.full_response))
+            elif exc is not None:
+                failures.append((transaction, exc))
+            else:
+                response = result.transaction_response
+                by_state[cls._get_authorize_net_state(
+                    response.response_code, approved_state
+                )].append(transaction)
+                values = {'provider_reference': str(response.trans_id)}
+                if transaction.payment_profile:
+                    values['last_four_digits'] = \
+                        transaction.payment_profile.last_4_digits
+                references.extend([[transaction], values])
+                logs.append((transaction, result))
+
+        to_write = list(references)
+        for state, transactions in by_state.iteritems():
+            to_write.extend([transactions, {'state': state}])
+        if to_write:
+            with timer('%s.save' % name):
+                cls.write(*to_write)
+        if logs:
+            with timer('%s.log' % name):
+                TransactionLog.create_authorize_net_logs(logs)
+        if by_state.get('completed'):
+            with timer('%s.post' % name):
+                cls.safe_post_authorize_net(by_state['completed'])
+        return failures
+
+    @classmethod
+    @ModelView.button
+    def update_status(cls, transactions):
         """
-        Cancel this authorization or request
+        Update the authorize.net transactions together with
+        `update_authorize_net_batch`, those it does not find one by one.
+        """
+        authorize_net = [
+            t for t in transactions if t.gateway.provider == 'authorize_net'
+        ]
+        if authorize_net:
+            for transaction in cls.update_authorize_net_batch(authorize_net):
+                if transaction.provider_reference:
+                    transaction.update_authorize_net()
+        super(AuthorizeNetTransaction, cls).update_status([
+            t for t in transactions if t.gateway.provider != 'authorize_net'
+        ])
+
+    @classmethod
+    def update_authorize_net_batch(cls, transactions, page_size=1000):
+        """
+        Update the state of the transactions from the transaction lists of
+        the reporting API of authorize.net, fetched a page of `page_size`
+        at a time: first the unsettled transactions, then the batches
+        settled since the oldest transaction, the most recent first, until
+        all the transactions are found.
+
+        The transactions without reference, whose call got no answer or
+        whose outcome was rolled back, are found by their invoice number
+        and get the reference of authorize.net.
+
+        The new states are written and logged in bulk and the completed
+        transactions are posted.
+
+        Returns the transactions which were not found.
+        """
+        name = 'update_authorize_net_batch'
+
+        # The transactions of every gateway by their reference, or their
+        # invoice number
+        pending = defaultdict(dict)
+        not_found = []
+        for transaction in transactions:
+            if transaction.provider_reference:
+                pending[transaction.gateway][
+                    transaction.provider_reference
+                ] = transaction
+            elif transaction.state in ('draft', 'in-progress'):
+                pending[transaction.gateway][(
+                    'invoice', transaction.get_authorize_net_invoice_number()
+                )] = transaction
+            else:
+                not_found.append(transaction)
+
+        by_state = defaultdict(list)
+        found = []
+        logs = []
+        for gateway, references in pending.iteritems():
+            start = min(
+                t.create_date for t in references.itervalues()
+            ) - datetime.timedelta(days=1)
+            with timer('%s.gateway' % name):
+                for item in cls._list_authorize_net_transactions(
+                        gateway, start, page_size):
+                    transaction = references.pop(item.trans_id, None)
+                    if transaction is None:
+                        transaction = references.pop(
+                            ('invoice', item.get('invoice_number')), None
+                        )
+                        if transaction is None:
+                            continue
+                        found.extend([[transaction], {
+                            'provider_reference': str(item.trans_id),
+                        }])
+                    state = cls._get_authorize_net_status_state(
+                        item.transaction_status, transaction
+                    )
+                    if state != transaction.state:
+                        by_state[state].append(transaction)
+                        logs.append((transaction, {'transaction': item}))
+                    if not references:
+                        break
+            not_found.extend(references.itervalues())
+        if found:
+            with timer('%s.save' % name):
+                cls.write(*found)
+        cls._set_authorize_net_states(by_state, logs, name)
+        return not_found
+
+    @staticmethod
+    def _get_authorize_net_status_state(status, transaction, default=None):
+        """
+        Return the state of the transaction from its status at authorize.net
+
+        Only the transactions still waiting for authorize.net follow their
+        status, a change of the others is logged as a discrepancy and their
+        state is kept.
+
+        :param default: State given by an unknown status, the current state
+                        of the transaction by default
+        """
+        state = AUTHORIZE_NET_STATUS_STATES.get(
+            status, default or transaction.state
+        )
+        if state == transaction.state or (
+                transaction.state in AUTHORIZE_NET_UPDATABLE_STATES):
+            return state
+        if not (state == 'completed' and transaction.state == 'posted'):
+            logger.warning(
+                'Transaction %s is %s but %s at authorize.net, left as is',
+                transaction.id, transaction.state, status
+            )
+        return transaction.state
+
+    @staticmethod
+    def _get_authorize_net_details_state(details):
+        """
+        Return the state of a transaction from the response code and type of
+        its details at authorize.net, for the statuses without a state
+        """
+        if details.response_code == '1':
+            if details.transaction_type in (
+                    'authCaptureTransaction', 'priorAuthCaptureTransaction'):
+                return 'completed'
+            elif details.transaction_type == 'authorizeOnlyTransaction':
+                return 'authorized'
+        elif details.response_code != '4':
+            return 'failed'
+
+    @classmethod
+    def _set_authorize_net_states(cls, by_state, logs, name):
+        """
+        Write the new states of the transactions in bulk, create the logs of
+        the changes and post the completed transactions
+
+        :param by_state: Dictionary of the transactions by their new state
+        :param logs: List of `(transaction, data)` logged
+        :param name: Name under which the phases are timed
         """
         TransactionLog = Pool().get('payment_gateway.transaction.log')
 
-        if self.state != 'authorized':
-            self.raise_user_error('cancel_only_authorized')
+        to_write = []
+        for state, records in by_state.iteritems():
+            to_write.extend([records, {'state': state}])
+        if to_write:
+            with timer('%s.save' % name):
+                cls.write(*to_write)
+        if logs:
+            with timer('%s.log' % name):
+                TransactionLog.create_authorize_net_logs(logs)
+        if by_state.get('completed'):
+            with timer('%s.post' % name):
+                cls.safe_post_authorize_net(by_state['completed'])
 
-        # Initialize authurize.net client
-        self.gateway.get_authorize_client()
+    @classmethod
+    def reconcile_authorize_net_settlements(cls):
+        """
+        Reconcile the batches settled in the last days with the transactions
+        of every authorize.net gateway. It is called every night by a
+        scheduled task, the days are set by the `reconcile_days` option of
+        the `authorize_net` section of the configuration.
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
 
-        # Try to void the transaction
+        end = datetime.datetime.utcnow()
+        start = end - datetime.timedelta(
+            days=config.getint('authorize_net', 'reconcile_days', default=2)
+        )
+        for gateway in Gateway.search([('provider', '=', 'authorize_net')]):
+            report = cls.reconcile_authorize_net(gateway, start, end)
+            logger.info(
+                'Reconciliation of authorize.net gateway %s: %s',
+                gateway.id, ', '.join(
+                    '%s %s' % (number, key)
+                    for key, number in sorted(report.iteritems())
+                )
+            )
+
+    @classmethod
+    def reconcile_authorize_net(cls, gateway, start, end, page_size=1000):
+        """
+        Reconcile the transactions of the batches settled by the gateway
+        between the UTC datetimes with the local transactions. The batch and
+        transaction lists are streamed a page of `page_size` at a time, so
+        the memory used does not depend on the size of the batches.
+
+        The transactions settled which are missing locally or have another
+        amount are reported in the log, the states which differ are fixed.
+
+        Returns the number of transactions settled, `fixed` in state,
+        `missing` and with another `amount`.
+        """
+        report = dict.fromkeys(('settled', 'fixed', 'missing', 'amount'), 0)
+        client = gateway.get_authorize_client()
+        for batch in client.list_settled_batches(start, end):
+            items = client.list_transactions(batch.batch_id, page_size)
+            while True:
+                page = list(islice(items, page_size))
+                if not page:
+                    break
+                cls._reconcile_authorize_net_page(
+                    gateway, batch.batch_id, page, report
+                )
+        return report
+
+    @classmethod
+    def _reconcile_authorize_net_page(cls, gateway, batch_id, page, report):
+        """
+        Reconcile a page of the transactions of a settled batch and add the
+        outcome to the report
+        """
+        name = 'reconcile_authorize_net'
+
+        with timer('%s.read' % name):
+            index = dict((t.provider_reference, t) for t in cls.search([
+                ('gateway', '=', gateway.id),
+                ('provider_reference', 'in', [i.trans_id for i in page]),
+            ]))
+        by_state = defaultdict(list)
+        logs = []
+        for item in page:
+            report['settled'] += 1
+            transaction = index.get(item.trans_id)
+            if transaction is None:
+                report['missing'] += 1
+                logger.warning(
+                    'Transaction %s of the authorize.net batch %s is missing',
+                    item.trans_id, batch_id
+                )
+                continue
+            state = cls._get_authorize_net_status_state(
+                item.transaction_status, transaction
+            )
+            if state in ('completed', 'posted') and \
+                    Decimal(item.settle_amount) != transaction.amount:
+                report['amount'] += 1
+                logger.warning(
+                    'Transaction %s settled %s by authorize.net instead of '
+                    '%s', transaction.id, item.settle_amount,
+                    transaction.amount
+                )
+            if state != transaction.state:
+                report['fixed'] += 1
+                logger.warning(
+                    'Transaction %s is %s instead of %s at authorize.net',
+                    transaction.id, transaction.state, state
+                )
+                by_state[state].append(transaction)
+                logs.append((transaction, {'transaction': item}))
+        cls._set_authorize_net_states(by_state, logs, name)
+
+    @staticmethod
+    def _list_authorize_net_transactions(gateway, start, page_size):
+        """
+        Iterate over the unsettled transactions of the gateway and then over
+        the transactions of the batches settled since `start`
+        """
+        client = gateway.get_authorize_client()
+        for item in client.list_transactions(page_size=page_size):
+            yield item
+        end = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        for batch in client.list_settled_batches(start, end):
+            for item in client.list_transactions(batch.batch_id, page_size):
+                yield item
+
+    @classmethod
+    def safe_post_authorize_net(cls, transactions):
+        """
+        Post the transactions together and fall back on `safe_post` for each
+        of them if that fails.
+        """
         try:
-            result = authorize.Transaction.void(self.provider_reference)
-        except AuthorizeResponseError as exc:
-            TransactionLog.serialize_and_create(self, exc.full_response)
-        else:
-            self.state = 'cancel'
-            self.save()
-            TransactionLog.serialize_and_create(self, result)
+            cls.post(transactions)
+        except UserError:
+            for transaction in transactions:
+                transaction.safe_post()
 
-    def get_authorize_net_request_data(self):
+    @classmethod
+    @ModelView.button
+    def refund(cls, transactions):
         """
-        Downstream modules can modify this method to send extra data to
-        authorize.net
+        Refund the authorize.net transactions together with
+        `refund_authorize_net_batch`, the refunds which got no answer are
+        all reported by an error
+        """
+        authorize_net = [
+            t for t in transactions if t.gateway.provider == 'authorize_net'
+        ]
+        if authorize_net:
+            try:
+                failures = cls.refund_authorize_net_batch(
+                    authorize_net, check_settled=True
+                )
+            except CircuitOpenError:
+                cls.raise_user_error('authorize_net_unavailable')
+            if failures:
+                if all(isinstance(exc, CircuitOpenError)
+                        for _, exc in failures):
+                    cls.raise_user_error('authorize_net_unavailable')
+                cls.raise_user_error('refund_failed', '\n'.join(
+                    '%s: %s' % (transaction.rec_name, exc)
+                    for transaction, exc in failures
+                ))
+        super(AuthorizeNetTransaction, cls).refund([
+            t for t in transactions if t.gateway.provider != 'authorize_net'
+        ])
 
-        Ref: http://vcatalano.github.io/py-authorize/transaction.html
+    @classmethod
+    def refund_authorize_net_batch(cls, transactions, check_settled=False):
         """
-        return {
-            'amount': self.amount
-        }
+        Refund the given refund transactions. The origins are read together
+        and their status is checked in one pass over the unsettled
+        transactions of their gateways: the origins not settled yet are
+        voided instead of refunded, which needs the refund of their whole
+        amount. The calls are sent concurrently and the outcome is written
+        back in bulk.
 
-    def refund_authorize_net(self):
-        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        A refund may have been processed by an earlier attempt whose answer
+        was lost or whose outcome was rolled back: the refunds found at
+        authorize.net by their invoice number, and the voids of origins
+        already voided, are completed without being sent again. The refunds
+        which got no answer are left in progress with the error logged,
+        `resolve_authorize_net_unanswered` finds them later.
+
+        Returns the list of `(transaction, exception)` for the refunds which
+        got no answer from authorize.net, the exception is None for the
+        partial refunds of origins not settled yet: they can be refunded
+        after the settlement.
+
+        :param check_settled: Raise an error for the partial refunds of
+                              origins not settled yet before sending any
+                              refund
+        """
+        name = 'refund_authorize_net_batch'
+        for transaction in transactions:
+            assert transaction.type == 'refund', \
+                "Transaction type must be refund"
+
+        with timer('%s.request' % name):
+            origins = cls.browse([t.origin.id for t in transactions])
+            unsettled = cls._get_authorize_net_unsettled(origins)
+        to_refund, voided, to_send, params, failures = [], [], [], [], []
+        for transaction, origin in zip(transactions, origins):
+            key = (origin.gateway.id, origin.provider_reference)
+            full = transaction.amount == origin.amount
+            if key not in unsettled:
+                to_refund.append((transaction, origin))
+            elif unsettled[key] in VOIDABLE_STATUSES and full:
+                to_send.append(transaction)
+                params.append(('void', (origin.provider_reference,)))
+            elif unsettled[key] == 'voided' and full:
+                voided.append(transaction)
+            elif check_settled:
+                cls.raise_user_error('refund_not_settled', transaction.rec_name)
+            else:
+                failures.append((transaction, None))
+        if voided:
+            cls._set_authorize_net_states({'completed': voided}, [
+                (t, {'transaction': {'transaction_status': 'voided'}})
+                for t in voided
+            ], name)
+
+        to_lookup = [t for t, _ in to_refund if not t.provider_reference]
+        found = set(to_lookup) - set(
+            cls.update_authorize_net_batch(to_lookup)
+        )
+        for transaction, origin in to_refund:
+            if transaction not in found:
+                to_send.append(transaction)
+                params.append(('refund', ({
+                    'amount': transaction.amount,
+                    'last_four': transaction.last_four_digits,
+                    'transaction_id': origin.provider_reference,
+                }, transaction.get_authorize_net_invoice_number())))
+
+        def call(client, params):
+            method, args = params
+            if method == 'void':
+                return client.transaction.void(*args)
+            return client.refund_transaction(*args)
+
+        unanswered = cls._apply_authorize_net_outcomes(
+            cls._map_authorize_net(call, to_send, params, name),
+            'completed', name
+        )
+        cls._set_authorize_net_unanswered([
+            (t, exc) for t, exc in unanswered
+            if not isinstance(exc, (CircuitOpenError, AuthorizeNotSentError))
+        ], name)
+        return failures + unanswered
 
+    @staticmethod
+    def _get_authorize_net_unsettled(transactions):
+        """
+        Return the status of the transactions which are not settled yet by
+        their gateway id and reference, from the unsettled transaction lists
+        of their gateways
+        """
+        references = defaultdict(set)
+        gateways = {}
+        for transaction in transactions:
+            references[transaction.gateway.id].add(
+                transaction.provider_reference
+            )
+            gateways[transaction.gateway.id] = transaction.gateway
+        unsettled = {}
+        for gateway_id, gateway_references in references.iteritems():
+            client = gateways[gateway_id].get_authorize_client()
+            try:
+                for item in client.list_transactions():
+                    if item.trans_id in gateway_references:
+                        unsettled[(gateway_id, item.trans_id)] = \
+                            item.transaction_status
+            except AuthorizeResponseError as exc:
+                # Without the reporting API all the transactions are
+                # refunded, as before
+                logger.warning(
+                    'Unsettled transactions of gateway %s not listed: %s',
+                    gateway_id, exc
+                )
+        return unsettled
+
+    def refund_authorize_net(self):
         # Initialize authorize.net client
-        self.gateway.get_authorize_client()
+        client = self.gateway.get_authorize_client()
 
         try:
-            result = authorize.Transaction.refund({
-                'amount': self.amount,
-                'last_four': self.last_four_digits,
-                'transaction_id': self.origin.provider_reference,
-            })
+            with timer('refund_authorize_net.gateway'):
+                result = client.transaction.refund({
+                    'amount': self.amount,
+                    'last_four': self.last_four_digits,
+                    'transaction_id': self.origin.provider_reference,
+                })
+        except CircuitOpenError:
+            self.raise_user_error('authorize_net_unavailable')
         except AuthorizeResponseError as exc:
             self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.full_response)
+            self._save_authorize_net_response(
+                'refund_authorize_net', exc.full_response
+            )
         else:
             self.state = 'completed'
-            self.save()
-            TransactionLog.serialize_and_create(self, result)
-            self.safe_post()
+            self._save_authorize_net_response('refund_authorize_net', result)
+            with timer('refund_authorize_net.post'):
+                self.safe_post()
 
 
 class AddPaymentProfile:
@@ -371,75 +1510,206 @@ class AddPaymentProfile:
     """
     __name__ = 'party.party.payment_profile.add'
 
+    @classmethod
+    def __setup__(cls):
+        super(AddPaymentProfile, cls).__setup__()
+        cls._error_messages.update({
+            'authorize_net_unavailable': 'Authorize.net is temporarily '
+            'unavailable, please try again in a few minutes.',
+        })
+
     def transition_add_authorize_net(self):
         """
         Handle the case if the profile should be added for authorize.net
+
+        The card is validated following the validation policy of the gateway:
+        by a second call, by the call storing it, later by a scheduled task
+        or not at all.
         """
         card_info = self.card_info
+        policy = card_info.gateway.authorize_net_validation
+        validation_mode = card_info.gateway.get_authorize_net_validation_mode()
 
         # Initialize authorize.net client
-        card_info.gateway.get_authorize_client()
+        client = card_info.gateway.get_authorize_client()
 
-        customer_id = card_info.party._get_authorize_net_customer_id(
-            card_info.gateway.id
-        )
+        with timer('transition_add_authorize_net.request'):
+            customer_id = card_info.party._get_authorize_net_customer_id(
+                card_info.gateway.id
+            )
         # Create new customer profile if no old profile is there
         if not customer_id:
-            customer_id = self.card_info.party.create_auth_profile()
+            customer_id = self.card_info.party.create_auth_profile(
+                card_info.gateway
+            )
 
         # Now create new credit card and associate it with the above
         # created customer
-        credit_card_data = {
-            'credit_card': {
-                'card_number': card_info.number,
-                'card_code': str(card_info.csc),
-                'expiration_date': "%s/%s" % (
-                    card_info.expiry_month, card_info.expiry_year
+        with timer('transition_add_authorize_net.request'):
+            credit_card_data = {
+                'credit_card': {
+                    'card_number': card_info.number,
+                    'card_code': str(card_info.csc),
+                    'expiration_date': "%s/%s" % (
+                        card_info.expiry_month, card_info.expiry_year
+                    ),
+                },
+                'billing': card_info.address.get_authorize_address(
+                    card_info.owner
                 ),
-            },
-            'billing': card_info.address.get_authorize_address(card_info.owner)
-        }
-        for try_count in range(2):
+            }
+        for try_count in range(3):
             try:
-                credit_card = authorize.CreditCard.create(
-                    customer_id, credit_card_data
-                )
-                # Validate newly created credit card
-                authorize.CreditCard.validate(
-                    customer_id, credit_card.payment_id, {
-                        'card_code':
-                            credit_card_data['credit_card']['card_code'],
-                        'validationMode': 'testMode' if card_info.gateway.test
-                        else 'liveMode'
-                    }
+                with timer('transition_add_authorize_net.gateway'):
+                    credit_card = client.create_credit_card(
+                        customer_id, credit_card_data,
+                        validation_mode if policy == 'create' else None
+                    )
+                card_info.party.add_authorize_net_payment_id(
+                    card_info.gateway, customer_id, credit_card.payment_id
                 )
+                if policy == 'sync':
+                    # Validate newly created credit card
+                    with timer('transition_add_authorize_net.gateway'):
+                        client.credit_card.validate(
+                            customer_id, credit_card.payment_id, {
+                                'card_code': credit_card_data[
+                                    'credit_card']['card_code'],
+                                'validation_mode': validation_mode,
+                            }
+                        )
                 break
+            except CircuitOpenError:
+                self.raise_user_error('authorize_net_unavailable')
             except AuthorizeInvalidError as exc:
                 self.raise_user_error(unicode(exc))
             except AuthorizeResponseError as exc:
-                if try_count == 0 and 'E00039' in unicode(exc):
-                    # Delete all unused payment profiles on authorize.net
-                    customer_details = authorize.Customer.details(customer_id)
-                    auth_payment_ids = set([
-                        p.payment_id for p in customer_details.profile.payments
-                    ])
-                    if card_info.party.payment_profiles:
-                        local_payment_ids = set([
-                            p.provider_reference for p in card_info.party.payment_profiles  # noqa
-                        ])
-                        ids_to_delete = auth_payment_ids.difference(
-                            local_payment_ids
-                        )
-                    else:
-                        ids_to_delete = auth_payment_ids
-
-                    if ids_to_delete:
-                        for payment_id in ids_to_delete:
-                            authorize.CreditCard.delete(customer_id, payment_id)
+                # Delete the unused payment profiles on authorize.net, from
+                # the snapshot first then from the fetched customer profile
+                if try_count < 2 and 'E00039' in unicode(exc) and \
+                        card_info.party.sync_authorize_net_payments(
+                            card_info.gateway, customer_id,
+                            refresh=try_count > 0):
                     continue
-                self.raise_user_error(unicode(exc.message))
+                self.raise_user_error(unicode(exc))
+
+        with timer('transition_add_authorize_net.save'):
+            return self.create_profile(
+                credit_card.payment_id,
+                authorize_profile_id=customer_id,
+                authorize_net_validation_state=VALIDATION_STATES[policy]
+            )
+
 
-        return self.create_profile(
-            credit_card.payment_id,
-            authorize_profile_id=customer_id
+class TransactionLog:
+    __name__ = 'payment_gateway.transaction.log'
+
+    @classmethod
+    def get_authorize_net_log(cls, data):
+        """
+        Return the text of the log of a response from authorize.net.
+
+        With the `log_format` option of the `authorize_net` section set to
+        `compact` only the fields reconciled on are kept, and the whole
+        response is added compressed when `log_compress` is set.
+        """
+        if config.get('authorize_net', 'log_format', default='full') \
+                != 'compact':
+            return yaml.dump(data, default_flow_style=False)
+
+        response = data.get('transaction_response') or \
+            data.get('transaction') or {}
+        log = dict(
+            (name, response[name]) for name in COMPACT_LOG_FIELDS
+            if response.get(name) is not None
+        )
+        messages = [
+            '%s: %s' % (m.message.code, m.message.text)
+            for m in data.get('messages', []) if 'message' in m
+        ]
+        messages.extend(
+            '%s: %s' % (m.message.code, m.message.description)
+            for m in response.get('messages', []) if 'message' in m
         )
+        messages.extend(
+            '%s: %s' % (e.error_code, e.error_text)
+            for e in response.get('errors', [])
+        )
+        if messages:
+            log['messages'] = messages
+        if data.get('error'):
+            log['error'] = data['error']
+        if config.getboolean('authorize_net', 'log_compress', default=False):
+            log['raw'] = base64.b64encode(zlib.compress(
+                yaml.dump(data, default_flow_style=False)
+            ))
+        return yaml.safe_dump(log, default_flow_style=False)
+
+    @staticmethod
+    def decompress_authorize_net_log(raw):
+        """
+        Return the whole response kept compressed in a compact log
+        """
+        return zlib.decompress(base64.b64decode(raw))
+
+    @classmethod
+    def create_authorize_net_logs(cls, logs):
+        """
+        Create the logs of the responses from authorize.net given as a list
+        of `(transaction, data)`.
+
+        With the `log_deferred` option of the `authorize_net` section set,
+        the logs are kept in a buffer and created in bulk at the commit of
+        the transaction.
+        """
+        if config.getboolean('authorize_net', 'log_deferred', default=False):
+            buffer_ = Transaction().join(_LogBuffer())
+            buffer_.logs.extend((t.id, data) for t, data in logs)
+            return
+        cls._create_authorize_net_logs([(t.id, data) for t, data in logs])
+
+    @classmethod
+    def _create_authorize_net_logs(cls, logs):
+        if logs:
+            cls.create([{
+                'transaction': transaction_id,
+                'log': cls.get_authorize_net_log(data),
+            } for transaction_id, data in logs])
+
+
+class _LogBuffer(object):
+    """
+    Data manager creating the buffered logs when the transaction is
+    committed
+    """
+
+    def __init__(self):
+        self.logs = []
+
+    def __eq__(self, other):
+        return isinstance(other, _LogBuffer)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def flush(self):
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        logs, self.logs = self.logs, []
+        with timer('transaction_log.flush'):
+            TransactionLog._create_authorize_net_logs(logs)
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        self.flush()
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        pass
+
+    def tpc_abort(self, trans):
+        self.logs = []
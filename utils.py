@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+    utils
+
+    :license: see LICENSE for details.
+"""
+from multiprocessing.pool import ThreadPool
+
+from trytond.config import config
+
+__all__ = ['get_max_workers', 'map_concurrently']
+
+
+def get_max_workers():
+    """
+    Return the maximum number of requests sent to authorize.net at the same
+    time by the batch methods. It can be set with the `max_workers` option of
+    the `authorize_net` section of the trytond configuration file.
+    """
+    return config.getint('authorize_net', 'max_workers', default=8)
+
+
+def map_concurrently(func, items, max_workers=None):
+    """
+    Call `func` on every item using a bounded pool of threads.
+
+    Returns a list of `(result, exception)` tuples in the same order as
+    `items`. Only one of them is set for any item.
+
+    Records and the Tryton transaction belong to the calling thread, so
+    `func` must not use them: prepare the data before and apply the results
+    after.
+    """
+    items = list(items)
+    if not items:
+        return []
+    if max_workers is None:
+        max_workers = get_max_workers()
+
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as exc:
+            return None, exc
+
+    pool = ThreadPool(max(1, min(max_workers, len(items))))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+    webhook
+
+    Receive the webhook notifications of authorize.net and apply the state
+    changes of the transactions they carry.
+
+    The notifications are posted to the WSGI `application` of this module at
+    `/<database>/<gateway id>`, which can be served next to the trytond
+    server, for example by gunicorn::
+
+        gunicorn trytond.modules.payment_gateway_authorize_net.webhook
+
+    :license: see LICENSE for details.
+"""
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+from collections import defaultdict
+
+from sql import Table
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model import ModelSQL, Unique, fields
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+from .timing import timer
+from .transaction import AUTHORIZE_NET_UPDATABLE_STATES
+
+__all__ = ['AuthorizeNetEvent', 'application']
+
+logger = logging.getLogger(__name__)
+
+# Event types giving the state of the transaction they were sent for, from
+# the response code of their payload when it has one
+EVENT_STATES = {
+    'net.authorize.payment.authorization.created': 'authorized',
+    'net.authorize.payment.authcapture.created': 'completed',
+    'net.authorize.payment.capture.created': 'completed',
+    'net.authorize.payment.priorAuthCapture.created': 'completed',
+    'net.authorize.payment.refund.created': 'completed',
+    'net.authorize.payment.void.created': 'cancel',
+    'net.authorize.payment.fraud.held': 'in-progress',
+    'net.authorize.payment.fraud.declined': 'failed',
+}
+
+# States a transaction is not brought back from by an older event delivered
+# late
+LATE_STATES = {
+    'authorized': ('completed', 'posted', 'cancel', 'failed'),
+    'in-progress': ('authorized', 'completed', 'posted', 'cancel', 'failed'),
+}
+
+# An approval does not say whether the transaction was authorized or
+# captured, its status is asked to authorize.net
+APPROVED_EVENT = 'net.authorize.payment.fraud.approved'
+
+
+class AuthorizeNetEvent(ModelSQL):
+    'Authorize.net Webhook Event'
+    __name__ = 'payment_gateway.authorize_net.event'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', ondelete='CASCADE',
+        select=True, required=True
+    )
+    notification_id = fields.Char('Notification ID', required=True)
+    event_type = fields.Char('Event Type', required=True)
+    provider_reference = fields.Char('Provider Reference', select=True)
+    payload = fields.Text('Payload')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('ignored', 'Ignored'),
+    ], 'State', required=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AuthorizeNetEvent, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('notification_uniq', Unique(t, t.gateway, t.notification_id),
+                'A notification can only be received once per gateway.'),
+        ]
+        cls._error_messages.update({
+            'invalid_signature': 'The signature of the authorize.net '
+            'notification is invalid.',
+        })
+        cls.__rpc__.update({
+            'receive': RPC(readonly=False),
+        })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def check_signature(cls, gateway, body, signature):
+        """
+        Raise an error unless the signature is the HMAC-SHA512 of the body
+        with the signature key of the gateway, as sent by authorize.net in
+        the `X-ANET-Signature` header: `sha512=<hex digest>`
+        """
+        key = gateway and gateway.authorize_net_signature_key
+        if gateway and gateway.provider != 'authorize_net' or \
+                not is_signed(key, body, signature):
+            cls.raise_user_error('invalid_signature')
+
+    @classmethod
+    def receive(cls, gateway_id, body, signature):
+        """
+        Check the signature of the notification posted to the gateway and
+        queue its event, unless it was already received.
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        gateway = (Gateway.search([('id', '=', gateway_id)]) or [None])[0]
+        cls.check_signature(gateway, body, signature)
+        notification = json.loads(body)
+        received = cls.search([
+            ('gateway', '=', gateway.id),
+            ('notification_id', '=', notification['notificationId']),
+        ], limit=1)
+        if received:
+            return
+        payload = notification.get('payload') or {}
+        cls.create([{
+            'gateway': gateway.id,
+            'notification_id': notification['notificationId'],
+            'event_type': notification['eventType'],
+            'provider_reference': payload.get('id') if
+            payload.get('entityName') == 'transaction' else None,
+            'payload': json.dumps(payload),
+        }])
+
+    @classmethod
+    def process_authorize_net_events(cls, batch_size=1000):
+        """
+        Apply the pending events to their transactions, `batch_size` events
+        at a time. It is called by a scheduled task.
+
+        The events received before their transaction was saved stay pending
+        for a day, then they are ignored.
+        """
+        last_id = 0
+        while True:
+            events = cls.search([
+                ('state', '=', 'pending'),
+                ('id', '>', last_id),
+            ], order=[('id', 'ASC')], limit=batch_size)
+            if not events:
+                break
+            cls._process_events(events)
+            last_id = events[-1].id
+
+    @classmethod
+    def _process_events(cls, events):
+        """
+        Write in bulk the states given by the events to their transactions
+        and mark the events processed
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+        name = 'process_authorize_net_events'
+
+        with timer('%s.read' % name):
+            index = cls._index_transactions(events)
+        states, approved, done, ignored = cls._sort_events(events, index)
+        for event in cls._get_approved_states(approved, states, name):
+            # Processed again at the next run
+            done.remove(event)
+
+        by_state = defaultdict(list)
+        logs = []
+        for transaction, (state, event) in states.iteritems():
+            if state != transaction.state:
+                by_state[state].append(transaction)
+                logs.append((transaction, {
+                    'notification_id': event.notification_id,
+                    'event_type': event.event_type,
+                }))
+        PaymentTransaction._set_authorize_net_states(by_state, logs, name)
+
+        to_write = []
+        if done:
+            to_write.extend([done, {'state': 'done'}])
+        if ignored:
+            to_write.extend([ignored, {'state': 'ignored'}])
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def _sort_events(cls, events, index):
+        """
+        Return the `(state, event)` by transaction given by the last event of
+        every transaction, the approval events by transaction, and the
+        events done and ignored.
+
+        The events which would bring a transaction back to an earlier state,
+        or change a transaction no longer waiting for authorize.net, are
+        skipped and the approvals are left to `_get_approved_states`.
+        """
+        states = {}
+        approved = {}
+        done, ignored = [], []
+        expiry = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        for event in events:
+            transaction = index.get(
+                (event.gateway.id, event.provider_reference)
+            )
+            if transaction is None:
+                if event.create_date < expiry or (
+                        event.event_type not in EVENT_STATES and
+                        event.event_type != APPROVED_EVENT):
+                    ignored.append(event)
+                continue
+            done.append(event)
+            if event.event_type in EVENT_STATES:
+                states[transaction] = (cls._get_event_state(event), event)
+                approved.pop(transaction, None)
+            elif event.event_type == APPROVED_EVENT:
+                approved[transaction] = event
+                states.pop(transaction, None)
+        for transaction, (state, event) in states.items():
+            if transaction.state not in AUTHORIZE_NET_UPDATABLE_STATES:
+                if state != transaction.state and not (
+                        state == 'completed' and
+                        transaction.state == 'posted'):
+                    logger.warning(
+                        'Transaction %s is %s but the notification %s is %s, '
+                        'left as is', transaction.id, transaction.state,
+                        event.notification_id, event.event_type
+                    )
+                del states[transaction]
+            elif transaction.state in LATE_STATES.get(state, ()):
+                del states[transaction]
+        return states, approved, done, ignored
+
+    @staticmethod
+    def _index_transactions(events):
+        """
+        Return the transactions of the events by gateway and reference
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        references = defaultdict(set)
+        for event in events:
+            if event.provider_reference:
+                references[event.gateway.id].add(event.provider_reference)
+        index = {}
+        for gateway_id, gateway_references in references.iteritems():
+            index.update(
+                ((gateway_id, t.provider_reference), t)
+                for t in PaymentTransaction.search([
+                    ('gateway', '=', gateway_id),
+                    ('provider_reference', 'in', list(gateway_references)),
+                ])
+            )
+        return index
+
+    @staticmethod
+    def _get_event_state(event):
+        """
+        Return the state of the transaction given by the event
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        payload = json.loads(event.payload or '{}')
+        return PaymentTransaction._get_authorize_net_state(
+            str(payload.get('responseCode', '1')),
+            EVENT_STATES[event.event_type]
+        )
+
+    @staticmethod
+    def _get_approved_states(approved, states, name):
+        """
+        Add to the states those of the approved transactions, from their
+        status at authorize.net asked concurrently, and return the events
+        of the transactions whose status could not be found.
+
+        :param approved: Dictionary of the approval event by transaction
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        failed = []
+        if not approved:
+            return failed
+        outcomes = PaymentTransaction._map_authorize_net(
+            lambda client, reference: client.transaction.details(reference),
+            approved.keys(), [t.provider_reference for t in approved], name
+        )
+        for transaction, (result, exc) in outcomes:
+            if exc is not None:
+                logger.warning(
+                    'Status of transaction %s not found: %s',
+                    transaction.id, exc
+                )
+                failed.append(approved[transaction])
+                continue
+            states[transaction] = (
+                PaymentTransaction._get_authorize_net_status_state(
+                    result.transaction.transaction_status, transaction
+                ), approved[transaction]
+            )
+        return failed
+
+
+def is_signed(key, body, signature):
+    """
+    Return whether the signature is the HMAC-SHA512 of the body with the
+    signature key
+    """
+    algorithm, _, digest = (signature or '').partition('=')
+    if not key or algorithm.lower() != 'sha512' or len(digest) != 128:
+        return False
+    expected = hmac.new(str(key), body, hashlib.sha512).hexdigest()
+    return hmac.compare_digest(str(digest.lower()), expected)
+
+
+def get_signature_key(gateway_id):
+    """
+    Return the signature key of the authorize.net gateway, read with the
+    connection of the current transaction as the pool of the database may
+    not be initialised yet
+    """
+    gateway = Table('payment_gateway_gateway')
+    cursor = Transaction().connection.cursor()
+    cursor.execute(*gateway.select(
+        gateway.authorize_net_signature_key,
+        where=(gateway.id == gateway_id) &
+        (gateway.provider == 'authorize_net')
+    ))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def application(environ, start_response):
+    """
+    WSGI application receiving the notifications posted to
+    `/<database>/<gateway id>`
+    """
+    def respond(status, text=''):
+        start_response(status, [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(text))),
+        ])
+        return [text]
+
+    parts = environ.get('PATH_INFO', '').strip('/').split('/')
+    if environ['REQUEST_METHOD'] != 'POST' or len(parts) != 2 or \
+            not parts[1].isdigit():
+        return respond('404 Not Found')
+    database_name, gateway_id = parts[0], int(parts[1])
+    body = environ['wsgi.input'].read(
+        int(environ.get('CONTENT_LENGTH') or 0)
+    )
+    signature = environ.get('HTTP_X_ANET_SIGNATURE')
+
+    with Transaction().start(None, 0, close=True) as transaction:
+        databases = transaction.database.list()
+    if database_name not in databases:
+        return respond('404 Not Found')
+
+    # The notifications are checked before initialising the pool, which
+    # loads every module of the database
+    with Transaction().start(database_name, 0, readonly=True):
+        key = get_signature_key(gateway_id)
+    if not is_signed(key, body, signature):
+        return respond('401 Unauthorized')
+
+    if database_name not in Pool.database_list():
+        Pool(database_name).init()
+    try:
+        with Transaction().start(database_name, 0):
+            Pool().get('payment_gateway.authorize_net.event').receive(
+                gateway_id, body, signature
+            )
+    except UserError:
+        return respond('401 Unauthorized')
+    except (ValueError, KeyError):
+        return respond('400 Bad Request')
+    except backend.get('DatabaseIntegrityError'):
+        # The same notification was received concurrently
+        return respond('200 OK')
+    return respond('200 OK')